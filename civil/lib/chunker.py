@@ -0,0 +1,124 @@
+from __future__ import annotations
+import os, re
+from dataclasses import dataclass
+from typing import List, Tuple
+
+# Chunker por estructura del escrito: corta en EN LO PRINCIPAL / OTROSÍ / secciones numeradas / saltos de página
+# y arma chunks por presupuesto de tokens (misma estimación que el batcher de embeddings).
+RAG_CHUNK_TOKENS = int(os.getenv("RAG_CHUNK_TOKENS", "300"))
+RAG_CHUNK_OVERLAP_TOKENS = int(os.getenv("RAG_CHUNK_OVERLAP_TOKENS", "40"))  # solo al partir un bloque largo
+CHUNKER_VERSION = "struct1"  # en documents.meta_json: la reingesta incremental no reutiliza chunks de otro chunker
+PAGE_SEP = "\n\n"  # separador de páginas en el texto del documento (char_start/char_end se miden sobre ese texto)
+
+# encabezados que abren una parte nueva del escrito: inician chunk (si el actual no es muy chico)
+_HARD_HEADING = re.compile(
+    r"^[ \t]*(?:EN\s+LO\s+PRINCIPAL|(?:PRIMER|SEGUNDO|TERCER|CUARTO|QUINTO|SEXTO|S[EÉ]PTIMO|OCTAVO|NOVENO|D[EÉ]CIMO)?"
+    r"\s*OTROS[IÍ]|POR\s+TANTO|VISTOS|CONSIDERANDO|SE\s+RESUELVE|RESUELVO)\b",
+    re.MULTILINE | re.IGNORECASE,
+)
+# secciones numeradas: "1.", "2)", "IV.-", "PRIMERO:", "a)"; cortan si el chunk ya tiene algo de cuerpo
+_SECTION = re.compile(
+    r"^[ \t]*(?:\d{1,3}[\.\)]|[IVXLC]{1,6}[\.\)]-?|[a-z]\)|(?:PRIMERO|SEGUNDO|TERCERO|CUARTO|QUINTO|SEXTO|"
+    r"S[EÉ]PTIMO|OCTAVO|NOVENO|D[EÉ]CIMO)\s*[:\.\-])(?=\s)",
+    re.MULTILINE,
+)
+_SENTENCE_END = re.compile(r"[\.;:](?=\s+[\"“(]?[A-ZÁÉÍÓÚÑ0-9])|\n\s*\n")
+
+@dataclass
+class Chunk:
+    text: str
+    page: int        # página (1..n) donde empieza
+    page_end: int    # página donde termina
+    char_start: int  # offsets en el texto del documento (páginas unidas con PAGE_SEP)
+    char_end: int
+
+def _tokens_to_chars(tokens: int) -> int:
+    # inversa de embed_batcher.estimate_tokens (len // 3 + 1)
+    return max(1, tokens * 3)
+
+def _blocks(pages: List[str]) -> Tuple[str, List[Tuple[int, int, int, bool]], List[int]]:
+    """Texto del documento, bloques (start, end, página, es_encabezado_fuerte) y offset de inicio de cada página."""
+    doc = PAGE_SEP.join(pages)
+    page_starts, pos = [], 0
+    for p in pages:
+        page_starts.append(pos)
+        pos += len(p) + len(PAGE_SEP)
+    blocks = []
+    for pno, (start, page) in enumerate(zip(page_starts, pages), 1):
+        cuts = {0: False}
+        for m in _HARD_HEADING.finditer(page):
+            cuts[m.start()] = True
+        for m in _SECTION.finditer(page):
+            cuts.setdefault(m.start(), False)
+        bounds = sorted(cuts)
+        for i, b in enumerate(bounds):
+            e = bounds[i + 1] if i + 1 < len(bounds) else len(page)
+            if page[b:e].strip():
+                blocks.append((start + b, start + e, pno, cuts[b]))
+    return doc, blocks, page_starts
+
+def _split_long(doc: str, start: int, end: int, max_chars: int, overlap_chars: int) -> List[Tuple[int, int]]:
+    # un bloque sobre el presupuesto se parte en fin de oración (o en espacio) con un poco de solape
+    out = []
+    while end - start > max_chars:
+        limit = start + max_chars
+        cut = None
+        for m in _SENTENCE_END.finditer(doc, start + max_chars // 2, limit):
+            cut = m.end()
+        if cut is None:
+            ws = doc.rfind(" ", start + max_chars // 2, limit)
+            cut = ws if ws > start else limit
+        out.append((start, cut))
+        nxt = cut - overlap_chars
+        if overlap_chars:
+            ws = doc.find(" ", nxt, cut)
+            nxt = ws + 1 if ws != -1 else nxt
+        start = max(nxt, start + 1)
+    out.append((start, end))
+    return out
+
+def _page_of(page_starts: List[int], offset: int) -> int:
+    lo, hi = 0, len(page_starts) - 1
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if page_starts[mid] <= offset:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo + 1
+
+def chunk_pages(pages: List[str], max_tokens: int = RAG_CHUNK_TOKENS,
+                overlap_tokens: int = RAG_CHUNK_OVERLAP_TOKENS) -> List[Chunk]:
+    """
+    Chunks de a lo más ~max_tokens. Los bloques (encabezados, secciones) de una página se juntan mientras quepan;
+    un salto de página siempre cierra el chunk y un encabezado fuerte lo cierra si ya lleva un cuarto del presupuesto.
+    """
+    doc, blocks, page_starts = _blocks(pages)
+    max_chars, min_chars = _tokens_to_chars(max_tokens), _tokens_to_chars(max_tokens) // 4
+    overlap_chars = min(_tokens_to_chars(overlap_tokens), max_chars // 4) if overlap_tokens > 0 else 0
+    spans: List[Tuple[int, int]] = []
+    cur_start = cur_end = None
+    cur_page = 0
+    for b_start, b_end, pno, hard in blocks:
+        if cur_start is not None:
+            # salto de página: siempre corta (la cita queda en una página); encabezado: si el chunk ya tiene cuerpo
+            if pno != cur_page or (hard and cur_end - cur_start >= min_chars) or (b_end - cur_start) > max_chars:
+                spans.append((cur_start, cur_end))
+                cur_start = None
+        if cur_start is None:
+            cur_start = b_start
+        cur_end, cur_page = b_end, pno
+    if cur_start is not None:
+        spans.append((cur_start, cur_end))
+
+    out: List[Chunk] = []
+    for s, e in spans:
+        for cs, ce in _split_long(doc, s, e, max_chars, overlap_chars) if e - s > max_chars else [(s, e)]:
+            raw = doc[cs:ce]
+            text = raw.strip()
+            if not text:
+                continue
+            cs += len(raw) - len(raw.lstrip())
+            ce = cs + len(text)
+            out.append(Chunk(text, _page_of(page_starts, cs), _page_of(page_starts, ce - 1), cs, ce))
+    return out
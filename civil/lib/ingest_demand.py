@@ -1,14 +1,27 @@
 from __future__ import annotations
-import os, re, json, math, argparse, sqlite3
+import os, re, json, math, argparse, shutil, tempfile, time
+from contextlib import closing
 from pathlib import Path
 from typing import List, Optional
 from tqdm import tqdm
-from pypdf import PdfReader
 from django.contrib.auth import get_user_model
 from django.db import transaction
 from civil.models import Causa
-from civil.rag.sqlite_db import ensure_schema, insert_document, insert_chunk, insert_embedding
-from civil.rag.utils_embed import embed_texts
+from civil.rag.sqlite_db import (ensure_schema, connect, is_corpus_path, embedder_for, vector_codec, RAG_STORE,
+                                 RAG_CORPUS_FILE)
+from civil.rag.utils_embed import get_embedder
+from civil.rag.corpus_store import corpus_path, import_demand_db
+from civil.rag.bulk_writer import BulkWriter, install_db, RAG_INGEST_TMP
+from civil.rag.embed_cache import EmbeddingCache
+from civil.rag.embed_batcher import EMBED_MAX_INPUTS
+from civil.rag.dedup import ChunkItem, write_deduplicated
+from civil.rag.matrix_cache import matrix_cache
+from civil.rag.ann import build_ann_index, evict_ivf
+from civil.lib.chunker import chunk_pages, CHUNKER_VERSION, RAG_CHUNK_TOKENS, RAG_CHUNK_OVERLAP_TOKENS, PAGE_SEP
+from civil.lib.pdf_extract import extract_pages, iter_pdf_texts, ocr_available, ExtractMetrics
+from civil.rag.incremental import (document_meta, previous_documents, carried_chunks, find_previous_db, open_previous,
+                                   folio_of, reusable_vectors)
+from civil.rag.case_card import build_case_card, save_case_card, load_case_card
 import logging
 from datetime import datetime
 from chatbot.services.progress import new_progress, set_state, get_state
@@ -16,25 +29,17 @@ from chatbot.services.progress import new_progress, set_state, get_state
 logger = logging.getLogger('civil')
 User = get_user_model()
 
-# naive chunking by characters (replace with token-based if needed)
-def chunk_text(text: str, chunk_size: int = 1200, overlap: int = 150) -> List[str]:
-    out = []
-    i = 0
-    n = len(text)
-    while i < n:
-        out.append(text[i:i + chunk_size])
-        i += max(1, chunk_size - overlap)
-    return [s.strip() for s in out if s.strip()]
-
 def extract_pdf_text(pdf_path: str) -> str:
-    reader = PdfReader(pdf_path)
-    pages = []
-    for p in reader.pages:
-        try:
-            pages.append(p.extract_text() or "")
-        except Exception:
-            pages.append("")
-    return "\n\n".join(pages)
+    # un solo PDF en este proceso; la ingesta usa iter_pdf_texts (pool de procesos)
+    return "\n\n".join(extract_pages(pdf_path))
+
+def first_filing(files: List[Path]) -> Optional[str]:
+    # get_demanda baja la demanda aparte como demanda.pdf; si no está, el folio más bajo
+    for p in files:
+        if p.name == "demanda.pdf":
+            return str(p)
+    numbered = [p for p in files if folio_of(str(p)).isdigit()]
+    return str(min(numbered, key=lambda p: int(folio_of(str(p))))) if numbered else None
 
 def resolve_or_create_demand(
     demand_id: Optional[int],
@@ -105,9 +110,12 @@ def ingest_demand(self, *args, **options):
     pdf_dir = Path(options["pdf_dir"]).resolve()
     create_if_missing = options.get("create_if_missing", False)
     created_by_id = options.get("created_by")
-    chunk_size = options.get("chunk_size")
-    overlap = options.get("overlap")
+    chunk_tokens = options.get("chunk_tokens") or RAG_CHUNK_TOKENS
+    overlap_tokens = options.get("overlap_tokens", RAG_CHUNK_OVERLAP_TOKENS)
+    chunker = f"{CHUNKER_VERSION}-{chunk_tokens}-{overlap_tokens}"
     batch = options.get("batch")
+    incremental = options.get("incremental", True)  # False = reextraer y reembeber todo
+    detalle = options.get("detalle")  # filas de loadDetalleCausa (get_demanda): trámites de la ficha de la causa
 
     if not pdf_dir.exists():
         logger.error(f"El directorio {pdf_dir} no existe.")
@@ -116,9 +124,17 @@ def ingest_demand(self, *args, **options):
     demand = resolve_or_create_demand(demand_id, title, pdf_dir, create_if_missing, created_by_id)
     
     # Preparar el destino del SQLite
-    download_dir = Path(os.getenv("SQLITE_LOCAL_PATH")) / datetime.now().strftime("%Y-%m-%d")
-    download_dir.mkdir(parents=True, exist_ok=True)
-    db_path = download_dir / f"demand_{demand.id}.db"
+    if RAG_STORE == "corpus":
+        # corpus consolidado: una partición por demand_id dentro de un solo archivo
+        db_path = Path(corpus_path())
+        scope = demand.id
+        sqlite_path = os.path.join('/', RAG_CORPUS_FILE)
+    else:
+        download_dir = Path(os.getenv("SQLITE_LOCAL_PATH")) / datetime.now().strftime("%Y-%m-%d")
+        download_dir.mkdir(parents=True, exist_ok=True)
+        db_path = download_dir / f"demand_{demand.id}.db"
+        scope = None
+        sqlite_path = os.path.join('/', datetime.now().strftime("%Y-%m-%d"), f"demand_{demand.id}.db")
 
     files = sorted([p for p in pdf_dir.rglob("*.pdf")])
     if not files:
@@ -126,42 +142,131 @@ def ingest_demand(self, *args, **options):
 
     logger.info(f"Ingestando demanda id={demand.id}, título='{demand.titulo}', {len(files)} PDFs desde {pdf_dir} → {db_path}")
 
+    # base de la ingesta anterior (antes de pisar sqlite_path): de ahí se copian los documentos sin cambios
+    prev_db, prev_scope = None, None
+    if incremental:
+        if scope is not None:
+            prev_db, prev_scope = str(db_path), scope
+        else:
+            prev_db = find_previous_db(os.getenv("SQLITE_LOCAL_PATH") or "", demand.id,
+                                       None if is_corpus_path(demand.sqlite_path) else demand.sqlite_path)
+
     # Estado → processing
     with transaction.atomic():
         demand.status = "processing"
-        demand.sqlite_path = os.path.join('/', datetime.now().strftime("%Y-%m-%d"), f"demand_{demand.id}.db")
+        demand.sqlite_path = sqlite_path
         demand.pdf_dir = os.path.join('/', datetime.now().strftime("%Y-%m-%d"), f"demand_{demand.id}")
         demand.save(update_fields=["status", "sqlite_path", "pdf_dir"])
 
+    # se escribe en una base temporal local y recién al final se instala (per_demand) o se importa (corpus):
+    # una ingesta a medias nunca queda visible y el SQLite destino no se toca durante la espera de la API
+    tmp_dir = tempfile.mkdtemp(prefix=f"ingest_{demand.id}_", dir=RAG_INGEST_TMP)
+    tmp_db = os.path.join(tmp_dir, f"demand_{demand.id}.db")
     try:
-        ensure_schema(str(db_path))
-        total_chunks = 0
-        with sqlite3.connect(str(db_path)) as con:
-            for pdf in tqdm(files):
-                logger.info(f"Procesando PDF: {pdf}")
-                text = extract_pdf_text(str(pdf))
-                chunks = chunk_text(text, chunk_size, overlap)
-                if not chunks:
-                    continue
-                doc_id = insert_document(con, str(pdf), meta={"size": os.path.getsize(pdf)})
-                # embeddings por lotes
-                for i in range(0, len(chunks), batch):
-                    batch_texts = chunks[i:i + batch]
-                    vecs = embed_texts(batch_texts)
-                    for j, (chunk_text_i, vec) in enumerate(zip(batch_texts, vecs)):
-                        cid = insert_chunk(con, doc_id, chunk_text_i, seq=i + j)
-                        insert_embedding(con, cid, vec)
-                total_chunks += len(chunks)
+        t0 = time.perf_counter()
+        ensure_schema(tmp_db)
+        embedder = get_embedder()  # RAG_EMBEDDER; queda en meta de la base y las consultas lo usan
+        prev = open_previous(prev_db, prev_scope)
+        prev_card = load_case_card(prev) if prev is not None else None
+        if prev is not None and embedder_for(prev).model != embedder.model:
+            logger.info(f"[INGEST] la base anterior usa {embedder_for(prev).model}, ahora {embedder.model}: se reembebe todo")
+            prev.close()
+            prev = None
+        with EmbeddingCache(model=embedder.model) as embed_cache, closing(connect(tmp_db)) as con:
+            writer = BulkWriter(con, embedder=embedder)
+            known = previous_documents(prev, prev_scope, chunker) if prev is not None else {}
+            if known and not reusable_vectors(prev, writer):
+                # p.ej. la anterior guardó vector_dim=512 y ahora se guarda completo: se copia el texto y se reembebe
+                logger.info(f"[INGEST] los vectores de la base anterior ({vector_codec(prev).dim} dims) no alcanzan: "
+                            "se reembeben los chunks copiados")
+            items = []  # ChunkItem de todos los PDFs: primero los copiados (traen vector), después los nuevos
+            carried_docs = 0
+            first, first_ref, first_text = first_filing(files), None, ""
+            try:
+                to_extract = {}  # pdf -> meta, en el orden de files
+                for pdf in files:
+                    meta = document_meta(str(pdf))
+                    old_id = known.get((meta["folio"], meta["sha256"]))
+                    if old_id is not None:
+                        # mismo folio y mismo PDF: chunks y vectores se copian tal cual
+                        doc_ref = writer.add_document(str(pdf), meta)
+                        if str(pdf) == first:
+                            first_ref = doc_ref
+                        items.extend(ChunkItem(doc_ref, seq, content, span, blob, norm)
+                                     for content, seq, norm, blob, span in carried_chunks(prev, writer, old_id))
+                        carried_docs += 1
+                    else:
+                        to_extract[str(pdf)] = meta
+            finally:
+                if prev is not None:
+                    prev.close()  # antes de install_db, que puede reemplazar esa misma base
+            # extracción en paralelo (pool de procesos); las páginas llegan en orden y cada PDF se trocea al completarse
+            # las páginas sin texto (escaneos) pasan por OCR, cacheado por hash de página
+            pdf_metrics = ExtractMetrics()
+            ocr = bool(to_extract) and ocr_available()
+            for pdf, pages in tqdm(iter_pdf_texts(to_extract, ocr=ocr, metrics=pdf_metrics), total=len(to_extract)):
+                logger.info(f"Procesando PDF: {pdf} ({len(pages)} páginas)")
+                # chunks por estructura (EN LO PRINCIPAL, OTROSÍ, secciones, páginas) con página y offsets
+                chunks = chunk_pages(pages, chunk_tokens, overlap_tokens)
+                if pdf == first:
+                    first_text = PAGE_SEP.join(pages)
+                # se registra aunque no tenga texto: la próxima ingesta lo reconoce y no lo vuelve a extraer
+                # (salvo que esta vez no hubo OCR: ver previous_documents)
+                doc_ref = writer.add_document(pdf, meta={**to_extract[pdf], "ocr": ocr, "chunker": chunker,
+                                                         "pages": len(pages)})
+                items.extend(ChunkItem(doc_ref, seq, c.text, (c.page, c.page_end, c.char_start, c.char_end))
+                             for seq, c in enumerate(chunks))
+            if known:
+                n_carried = sum(1 for it in items if it.vector is not None)
+                logger.info(f"[INGEST] incremental: {carried_docs}/{len(files)} PDFs sin cambios "
+                            f"({n_carried} chunks copiados), {len(files) - carried_docs} a procesar")
+            t_extract = time.perf_counter()
+            if to_extract:
+                logger.info(f"[PDF] {pdf_metrics.summary()}")
+            # casi-duplicados (MinHash/LSH): un chunk canónico por grupo, el resto como apariciones;
+            # solo los canónicos nuevos se embeben (batch = tope de chunks por request)
+            dedup = write_deduplicated(writer, items, lambda texts: embed_cache.embed(texts, embedder.embed),
+                                       max_items=batch or EMBED_MAX_INPUTS)
+            logger.info(f"[DEDUP] {dedup['chunks']} chunks -> {dedup['canonical']} canónicos, "
+                        f"{dedup['duplicates']} casi-duplicados; {dedup['embedded']} embebidos")
+            t_embed = time.perf_counter()
+            total_chunks = writer.finish()
+            # ficha de la causa: primer escrito (extraído ahora o rearmado desde sus chunks copiados) + trámites;
+            # si esta vez no vino el detalle se conservan los trámites de la ficha anterior
+            if first_ref is not None and not first_text:
+                first_text = "\n".join(it.text for it in items if it.doc_ref == first_ref)
+            card = build_case_card(first_text, detalle, title=demand.titulo, source=first,
+                                   tramites=(prev_card or {}).get("tramites"))
+            if card is not None:
+                with con:
+                    save_case_card(con, demand.id, card)
+                logger.info(f"[INGEST] ficha de la causa: {len(card['partes'])} partes, {len(card['montos'])} montos, "
+                            f"{len(card['tramites'])} trámites")
+        if scope is not None:
+            import_demand_db(str(db_path), scope, tmp_db)  # reemplaza la partición en una transacción
+        else:
+            install_db(tmp_db, str(db_path))
+            matrix_cache.invalidate(str(db_path))
+            evict_ivf(str(db_path))
+            build_ann_index(str(db_path))
+        t_end = time.perf_counter()
+        logger.info(f"[INGEST] extracción {t_extract - t0:.2f}s, embeddings {t_embed - t_extract:.2f}s, "
+                    f"escritura {t_end - t_embed:.2f}s ({total_chunks / max(t_end - t0, 1e-9):.1f} chunks/s)")
 
         # Estado → ready y ruta sqlite
         with transaction.atomic():
             demand.status = "ready"
             demand.save(update_fields=["status"])
 
+        cache_stats = embed_cache.stats()
         logger.info(f"Ingesta completada: {total_chunks} chunks insertados en {db_path}")
+        logger.info(f"Cache de embeddings: {cache_stats['hits']} hits / {cache_stats['misses']} misses "
+                    f"(hit ratio {cache_stats['hit_ratio']:.1%})")
 
     except Exception as e:
         with transaction.atomic():
             demand.status = "error"
             demand.save(update_fields=["status"])
         raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
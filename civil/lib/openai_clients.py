@@ -0,0 +1,91 @@
+from __future__ import annotations
+import os, threading, asyncio, weakref, logging
+from typing import Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger('civil')
+
+# Clientes OpenAI de larga vida por proceso: reutilizan el pool HTTP (keep-alive) en vez de
+# pagar un handshake TLS por cada llamada. Seguro ante fork (gunicorn --preload, celery prefork).
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "600"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "32"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "16"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "90"))
+
+# base_url=DEFAULT_ENDPOINT pide el endpoint por defecto de OpenAI aunque OPENAI_BASE_URL esté definido
+# (p.ej. Assistants/threads, que no existen en un proxy o servidor compatible usado para embeddings)
+DEFAULT_ENDPOINT = object()
+
+_lock = threading.Lock()
+_sync_clients: dict = {}
+# httpx.AsyncClient queda atado al event loop donde abrió sus conexiones: un cliente por loop
+_async_clients: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_pid = os.getpid()
+
+def _limits():
+    import httpx
+    return httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+    )
+
+def _reset_after_fork() -> None:
+    # las conexiones heredadas del padre comparten sockets: el hijo arma sus propios clientes
+    global _lock, _sync_clients, _async_clients, _pid
+    _lock = threading.Lock()
+    _sync_clients = {}
+    _async_clients = weakref.WeakKeyDictionary()
+    _pid = os.getpid()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _check_pid() -> None:
+    if os.getpid() != _pid:
+        _reset_after_fork()
+
+def _resolve_base_url(base_url) -> Optional[str]:
+    if base_url is DEFAULT_ENDPOINT:
+        return None
+    return base_url or OPENAI_BASE_URL
+
+def get_client(api_key: Optional[str] = None, base_url: Optional[str] = None):
+    """openai.OpenAI compartido del proceso para (api_key, base_url); base_url None = OPENAI_BASE_URL."""
+    from openai import OpenAI, DefaultHttpxClient
+    _check_pid()
+    key = (api_key or OPENAI_API_KEY, _resolve_base_url(base_url))
+    with _lock:
+        client = _sync_clients.get(key)
+        if client is None:
+            client = OpenAI(
+                api_key=key[0], base_url=key[1],
+                timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES,
+                http_client=DefaultHttpxClient(limits=_limits()),
+            )
+            _sync_clients[key] = client
+            logger.debug("[openai] nuevo cliente sync pid=%s base_url=%s", _pid, key[1] or "(default)")
+        return client
+
+def get_async_client(api_key: Optional[str] = None, base_url: Optional[str] = None):
+    """openai.AsyncOpenAI compartido dentro del event loop actual (debe llamarse desde código async)."""
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+    _check_pid()
+    loop = asyncio.get_running_loop()
+    key = (api_key or OPENAI_API_KEY, _resolve_base_url(base_url))
+    with _lock:
+        per_loop = _async_clients.setdefault(loop, {})
+        client = per_loop.get(key)
+        if client is None:
+            client = AsyncOpenAI(
+                api_key=key[0], base_url=key[1],
+                timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES,
+                http_client=DefaultAsyncHttpxClient(limits=_limits()),
+            )
+            per_loop[key] = client
+        return client
@@ -0,0 +1,337 @@
+from __future__ import annotations
+import os, signal, sqlite3, hashlib, importlib.util, logging, multiprocessing, threading, time
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from pypdf import PdfReader
+
+logger = logging.getLogger('civil')
+
+# Extracción de texto en paralelo: PDFs (y tramos de páginas de los PDFs grandes) repartidos en un pool de procesos.
+# Los resultados vuelven por página y en orden; cada página tiene un tope de tiempo.
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(8, os.cpu_count() or 1))))
+PDF_PAGE_TIMEOUT = float(os.getenv("PDF_PAGE_TIMEOUT", "30"))  # segundos por página; vencido => página vacía
+PDF_SPLIT_BYTES = int(os.getenv("PDF_SPLIT_BYTES", str(2 * 1024 * 1024)))  # desde este tamaño se reparte por páginas
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "16"))
+
+# OCR de las páginas sin texto (escaneos): pdf2image + pytesseract en el mismo pool, cacheado por hash de página
+OCR_ENABLED = os.getenv("OCR_ENABLED", "1") == "1"
+OCR_DPI = min(int(os.getenv("OCR_DPI", "200")), 300)  # tope: a más DPI la imagen crece al cuadrado y no mejora el texto
+OCR_LANG = os.getenv("OCR_LANG", "spa")
+OCR_MIN_CHARS = int(os.getenv("OCR_MIN_CHARS", "20"))  # menos caracteres útiles que esto = página sin texto
+OCR_PAGE_TIMEOUT = float(os.getenv("OCR_PAGE_TIMEOUT", "120"))
+OCR_CACHE_PATH = os.getenv("OCR_CACHE_PATH") or os.path.join(os.getenv("SQLITE_LOCAL_PATH") or ".", "ocr_cache.db")
+
+Task = Tuple[str, int, Optional[int]]  # (pdf, primera página, última+1 | None = hasta el final)
+
+class PageTimeout(Exception):
+    pass
+
+@contextmanager
+def _page_deadline(seconds: float):
+    # SIGALRM solo existe en POSIX y solo en el hilo principal (el de cada proceso del pool); si no, sin tope
+    if seconds <= 0 or not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def _expired(signum, frame):
+        raise PageTimeout()
+    previous = signal.signal(signal.SIGALRM, _expired)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+def _page_hash(page) -> str:
+    # hash del contenido de la página y de sus imágenes: el mismo escaneo en otro PDF (o re-descargado) coincide
+    h = hashlib.sha256()
+    try:
+        contents = page.get_contents()
+        if contents is not None:
+            h.update(contents.get_data())
+        xobjects = (page.get("/Resources") or {}).get("/XObject") or {}
+        for name in sorted(xobjects):
+            h.update(getattr(xobjects[name].get_object(), "_data", b"") or b"")
+    except Exception:
+        return ""
+    return h.hexdigest()
+
+def _needs_ocr(text: str) -> bool:
+    return sum(1 for c in text if c.isalnum()) < OCR_MIN_CHARS
+
+def _extract_task(pdf_path: str, start: int, stop: Optional[int], page_timeout: float,
+                  want_hash: bool) -> List[Tuple[str, float, Optional[str]]]:
+    # corre en el pool: (texto, segundos, hash de página si no tiene texto y hay OCR) por página
+    try:
+        reader = PdfReader(pdf_path)
+        pages = reader.pages[start:stop]
+    except Exception as e:
+        logger.warning(f"[PDF] no se pudo abrir {pdf_path}: {e}")
+        return []
+    out = []
+    for i, page in enumerate(pages, start):
+        t0 = time.perf_counter()
+        try:
+            with _page_deadline(page_timeout):
+                text = page.extract_text() or ""
+        except PageTimeout:
+            logger.warning(f"[PDF] {pdf_path} página {i + 1}: más de {page_timeout:.0f}s, se omite")
+            text = ""
+        except Exception:
+            text = ""
+        page_hash = (_page_hash(page) or None) if want_hash and _needs_ocr(text) else None
+        out.append((text, time.perf_counter() - t0, page_hash))
+    return out
+
+def extract_pages(pdf_path: str, start: int = 0, stop: Optional[int] = None,
+                  page_timeout: float = PDF_PAGE_TIMEOUT) -> List[str]:
+    """Texto de las páginas [start, stop), sin OCR. Una página que falla o excede page_timeout queda como ""."""
+    return [text for text, _, _ in _extract_task(pdf_path, start, stop, page_timeout, False)]
+
+def ocr_page(pdf_path: str, page_no: int, dpi: int = OCR_DPI, lang: str = OCR_LANG,
+             timeout: float = OCR_PAGE_TIMEOUT) -> str:
+    """Rasteriza una página (pdftoppm vía pdf2image) y la pasa por tesseract. Corre en el pool."""
+    from pdf2image import convert_from_path
+    import pytesseract
+    images = convert_from_path(pdf_path, dpi=min(dpi, 300), first_page=page_no + 1, last_page=page_no + 1,
+                               timeout=int(timeout) or None)
+    if not images:
+        return ""
+    return pytesseract.image_to_string(images[0], lang=lang, timeout=timeout or 0)
+
+def _ocr_task(ocr_fn: Callable[..., str], pdf_path: str, page_no: int, dpi: int, lang: str,
+              timeout: float) -> Tuple[str, float]:
+    t0 = time.perf_counter()
+    try:
+        text = ocr_fn(pdf_path, page_no, dpi, lang, timeout) or ""
+    except Exception as e:
+        logger.warning(f"[OCR] {pdf_path} página {page_no + 1}: {e}")
+        text = None  # None = falló (no se cachea); "" = tesseract no encontró texto (sí se cachea)
+    return text, time.perf_counter() - t0
+
+OCR_CACHE_SCHEMA_SQL = """
+PRAGMA journal_mode=WAL;
+CREATE TABLE IF NOT EXISTS ocr_cache(
+  page_hash TEXT NOT NULL,
+  lang TEXT NOT NULL,
+  dpi INTEGER NOT NULL,
+  text TEXT NOT NULL,
+  seconds REAL NOT NULL,      -- lo que costó el OCR original
+  created_at REAL NOT NULL,
+  PRIMARY KEY(page_hash, lang, dpi)
+);
+"""
+
+class OcrCache:
+    """Texto OCR por (hash de página, idioma, DPI), compartido entre demandas: una reingesta no repite OCR."""
+
+    def __init__(self, path: str = OCR_CACHE_PATH, lang: str = OCR_LANG, dpi: int = OCR_DPI):
+        self.lang, self.dpi = lang, dpi
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._con = sqlite3.connect(path, timeout=30)
+        self._con.executescript(OCR_CACHE_SCHEMA_SQL)
+
+    def close(self) -> None:
+        self._con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_many(self, hashes: List[str]) -> Dict[str, str]:
+        out: Dict[str, str] = {}
+        uniq = list(dict.fromkeys(hashes))
+        for s in range(0, len(uniq), 500):
+            part = uniq[s:s + 500]
+            rows = self._con.execute(
+                f"SELECT page_hash, text FROM ocr_cache WHERE lang=? AND dpi=? AND page_hash IN ({','.join('?' * len(part))})",
+                [self.lang, self.dpi, *part],
+            ).fetchall()
+            out.update(rows)
+        return out
+
+    def put_many(self, items: Dict[str, Tuple[str, float]]) -> None:
+        if not items:
+            return
+        now = time.time()
+        with self._con:
+            self._con.executemany(
+                "INSERT OR REPLACE INTO ocr_cache(page_hash, lang, dpi, text, seconds, created_at) VALUES(?,?,?,?,?,?)",
+                [(h, self.lang, self.dpi, text, secs, now) for h, (text, secs) in items.items()],
+            )
+
+def _pct(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+class ExtractMetrics:
+    """Tiempos por página de extracción y OCR de una ingesta (ms), y contadores del cache OCR."""
+
+    def __init__(self):
+        self.extract_s: List[float] = []
+        self.ocr_s: List[float] = []
+        self.ocr_pages = self.ocr_cache_hits = self.ocr_failed = 0
+
+    def summary(self) -> dict:
+        return {
+            "pages": len(self.extract_s),
+            "extract_ms_p50": round(_pct(self.extract_s, 0.5) * 1000, 1),
+            "extract_ms_p95": round(_pct(self.extract_s, 0.95) * 1000, 1),
+            "ocr_pages": self.ocr_pages,
+            "ocr_cache_hits": self.ocr_cache_hits,
+            "ocr_failed": self.ocr_failed,
+            "ocr_ms_p50": round(_pct(self.ocr_s, 0.5) * 1000, 1),
+            "ocr_ms_p95": round(_pct(self.ocr_s, 0.95) * 1000, 1),
+            "ocr_s_total": round(sum(self.ocr_s), 2),
+        }
+
+class _InlineExecutor:
+    # misma interfaz que el pool para la extracción en serie
+    def submit(self, fn, *args) -> Future:
+        fut: Future = Future()
+        try:
+            fut.set_result(fn(*args))
+        except Exception as e:
+            fut.set_exception(e)
+        return fut
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False) -> None:
+        pass
+
+def _page_count(pdf_path: str) -> int:
+    try:
+        return len(PdfReader(pdf_path).pages)
+    except Exception:
+        return 0
+
+def plan_tasks(files: Iterable[str], split_bytes: int = PDF_SPLIT_BYTES,
+               pages_per_task: int = PDF_PAGES_PER_TASK) -> List[Task]:
+    # los PDFs chicos van enteros (abrirlos dos veces cuesta más que extraerlos); los grandes, por tramos
+    tasks: List[Task] = []
+    for path in files:
+        path = str(path)
+        if os.path.getsize(path) < split_bytes:
+            tasks.append((path, 0, None))
+            continue
+        n = _page_count(path)
+        if n <= pages_per_task:
+            tasks.append((path, 0, None))
+            continue
+        tasks.extend((path, s, min(s + pages_per_task, n)) for s in range(0, n, pages_per_task))
+    return tasks
+
+def ocr_available() -> bool:
+    if not OCR_ENABLED:
+        return False
+    # find_spec no importa los módulos: el probe no carga PIL ni pytesseract en el proceso que solo coordina
+    if all(importlib.util.find_spec(m) is not None for m in ("pdf2image", "pytesseract")):
+        return True
+    logger.warning("[OCR] pdf2image/pytesseract no instalados: las páginas escaneadas quedan sin texto")
+    return False
+
+def _wait(fut: Future, timeout: float, what: str):
+    try:
+        return fut.result(timeout=timeout if timeout > 0 else None)
+    except FutureTimeout:
+        logger.error(f"[PDF] {what}: sin respuesta en {timeout:.0f}s, se omite")
+        fut.cancel()
+    except Exception as e:
+        logger.error(f"[PDF] {what}: {e}")
+    return None
+
+def iter_pdf_pages(files: Iterable[str], workers: int = PDF_WORKERS, page_timeout: float = PDF_PAGE_TIMEOUT,
+                   split_bytes: int = PDF_SPLIT_BYTES, pages_per_task: int = PDF_PAGES_PER_TASK,
+                   ocr: bool = OCR_ENABLED, ocr_fn: Optional[Callable[..., str]] = None,
+                   ocr_cache: Optional[OcrCache] = None, metrics: Optional[ExtractMetrics] = None,
+                   ) -> Iterator[Tuple[str, int, str]]:
+    """
+    (pdf, nº de página desde 0, texto) en el orden de files y de páginas, a medida que se completan.
+    Las páginas sin texto pasan por OCR (ocr_fn, por defecto ocr_page) salvo que su hash ya esté en ocr_cache.
+    Con workers <= 1 (o si no se puede crear el pool) todo corre en este proceso.
+    """
+    tasks = plan_tasks(files, split_bytes, pages_per_task)
+    metrics = metrics if metrics is not None else ExtractMetrics()
+    ocr_fn = ocr_fn or ocr_page
+    ocr = ocr and (ocr_fn is not ocr_page or ocr_available())
+    own_cache = ocr and ocr_cache is None
+    if own_cache:
+        ocr_cache = OcrCache()
+    pool = None
+    if workers > 1 and len(tasks) > 1:
+        if multiprocessing.current_process().daemon:  # p.ej. worker prefork de celery: no puede tener hijos
+            logger.warning("[PDF] proceso daemon sin permiso para crear hijos; extracción en serie")
+        else:
+            try:
+                pool = ProcessPoolExecutor(max_workers=min(workers, len(tasks)))
+            except (OSError, AssertionError, ValueError) as e:
+                logger.warning(f"[PDF] sin pool de procesos ({e}); extracción en serie")
+    pool = pool or _InlineExecutor()
+    try:
+        try:
+            futures = [pool.submit(_extract_task, path, start, stop, page_timeout, ocr) for path, start, stop in tasks]
+        except (OSError, AssertionError) as e:  # los procesos del pool recién nacen en submit
+            logger.warning(f"[PDF] sin pool de procesos ({e}); extracción en serie")
+            pool.shutdown(wait=False, cancel_futures=True)
+            pool = _InlineExecutor()
+            futures = [pool.submit(_extract_task, path, start, stop, page_timeout, ocr) for path, start, stop in tasks]
+        for (path, start, stop), fut in zip(tasks, futures):
+            # el tope real está dentro del worker; este es un resguardo por si el proceso queda colgado en C
+            budget = page_timeout * ((stop - start) if stop is not None else pages_per_task * 4) + 60
+            pages = _wait(fut, budget if page_timeout > 0 else 0, f"{path} páginas {start + 1}-{stop or 'fin'}")
+            if pages is None:  # tarea vencida o caída: sus páginas salen vacías para no correr la numeración
+                n = (stop if stop is not None else _page_count(path)) - start
+                pages = [("", 0.0, None)] * max(n, 0)
+            texts = [text for text, _, _ in pages]
+            metrics.extract_s.extend(secs for _, secs, _ in pages)
+            blank = {start + j: h for j, (_, _, h) in enumerate(pages) if h}
+            if blank:
+                cached = ocr_cache.get_many(list(blank.values()))
+                metrics.ocr_cache_hits += sum(1 for h in blank.values() if h in cached)
+                todo: Dict[str, int] = {}  # hash -> primera página con ese hash (p.ej. la misma carátula repetida)
+                for i, h in blank.items():
+                    if h not in cached:
+                        todo.setdefault(h, i)
+                ocr_futs = {i: pool.submit(_ocr_task, ocr_fn, path, i, ocr_cache.dpi, ocr_cache.lang, OCR_PAGE_TIMEOUT)
+                            for i in todo.values()}
+                fresh = {}
+                for i, ofut in ocr_futs.items():
+                    text, secs = _wait(ofut, OCR_PAGE_TIMEOUT * 2 + 60, f"OCR {path} página {i + 1}") or (None, 0.0)
+                    metrics.ocr_pages += 1
+                    metrics.ocr_s.append(secs)
+                    if text is None:
+                        metrics.ocr_failed += 1
+                        continue
+                    fresh[blank[i]] = (text, secs)
+                ocr_cache.put_many(fresh)
+                for i, h in blank.items():
+                    text = cached.get(h, fresh.get(h, (None,))[0])
+                    if text and text.strip():
+                        texts[i - start] = text
+            for i, text in enumerate(texts, start):
+                yield path, i, text
+    finally:
+        # sin esperar: un worker colgado no debe retener la ingesta (el generador también puede cerrarse antes)
+        pool.shutdown(wait=False, cancel_futures=True)
+        if own_cache:
+            ocr_cache.close()
+
+def iter_pdf_texts(files: Iterable[str], **kwargs) -> Iterator[Tuple[str, List[str]]]:
+    """(pdf, [texto por página]) en el orden de files; agrupa lo que entrega iter_pdf_pages."""
+    files = [str(f) for f in files]
+    pages: dict = {f: [] for f in files}
+    it = iter_pdf_pages(files, **kwargs)
+    for path in files:
+        # iter_pdf_pages respeta el orden: se consume hasta que aparece el PDF siguiente
+        for p, i, text in it:
+            got = pages[p]
+            got.extend([""] * (i + 1 - len(got)))  # por índice: un hueco no corre las páginas siguientes
+            got[i] = text
+            if p != path:
+                break
+        yield path, pages.pop(path)
@@ -0,0 +1,136 @@
+import json
+import os
+import re
+import sqlite3
+import time
+from django.core.management.base import BaseCommand, CommandError
+from civil.rag import bench
+from civil.rag.sqlite_db import SEARCH_MODES, embedder_for
+
+class Command(BaseCommand):
+    help = "Microbenchmarks del stack RAG. Ejemplo: python manage.py rag_bench rerank --counts 10,100,1000"
+
+    def add_arguments(self, parser):
+        parser.add_argument("suite", type=str, choices=["rerank", "quant", "fts", "traces", "write", "retrieval"], help="Benchmark a ejecutar")
+        parser.add_argument("--counts", type=str, default="10,40,100,400,1000,4000",
+                            help="Cantidad de candidatos separados por coma (rerank)")
+        parser.add_argument("--dim", type=int, default=bench.DEFAULT_DIM)
+        parser.add_argument("--k", type=int, default=8)
+        parser.add_argument("--repeats", type=int, default=5)
+        parser.add_argument("--n", type=int, default=5000, help="Tamaño del corpus sintético (quant, write)")
+        parser.add_argument("--queries", type=int, default=100, help="Cantidad de consultas (quant, retrieval)")
+        parser.add_argument("--db", type=str, default=None,
+                            help="quant: usar los vectores de un demand_<id>.db real en vez del corpus sintético; fts/traces: base a medir (requerido)")
+        parser.add_argument("--traces", type=str, default="traces",
+                            help="Directorio de traces de rag_query (traces, retrieval): preguntas reales y rondas LLM registradas")
+        parser.add_argument("--sizes", type=str, default=",".join(str(n) for n in bench.RETRIEVAL_SIZES),
+                            help="retrieval: tamaños de las bases sintéticas en chunks, separados por coma (1000..200000)")
+        parser.add_argument("--modes", type=str, default=",".join(SEARCH_MODES), help="retrieval: modos de hybrid_search")
+        parser.add_argument("--questions-file", type=str, default=None,
+                            help='retrieval con --db: JSON [{"question": ..., "relevant": [chunk_id, ...]}]')
+        parser.add_argument("--out", type=str, default=None,
+                            help="retrieval: archivo JSON de resultados (por defecto bench_results/retrieval_<commit>_<fecha>.json)")
+
+    def handle(self, *args, **options):
+        if options["suite"] == "rerank":
+            try:
+                counts = [int(c) for c in options["counts"].split(",") if c.strip()]
+            except ValueError as e:
+                raise CommandError(f"--counts inválido: {e}")
+            rows = bench.bench_rerank(counts, dim=options["dim"], k=options["k"], repeats=options["repeats"])
+            for r in rows:
+                self.stdout.write(
+                    f"n={r['candidates']:>6}  loop={r['loop_ms']:>9.3f} ms  batched={r['batched_ms']:>8.3f} ms  x{r['speedup']}"
+                )
+        elif options["suite"] == "quant":
+            if options["db"]:
+                from civil.rag.matrix_cache import load_matrix
+                with sqlite3.connect(options["db"]) as con:
+                    corpus = load_matrix(con).matrix
+                if not len(corpus):
+                    raise CommandError(f"{options['db']} no tiene embeddings")
+            else:
+                corpus = bench.synthetic_corpus(options["n"], dim=options["dim"])
+            queries = bench.query_sample(corpus, options["queries"])
+            rows = bench.bench_quantization(corpus, queries, k=options["k"])
+            for r in rows:
+                self.stdout.write(
+                    f"{r['format']:>7} dim={r['dim']:>5}  {r['bytes_per_vector']:>6} B/vec  x{r['size_ratio']:<6} "
+                    f"recall@{r['k']}={r['recall']:.4f}"
+                )
+        elif options["suite"] == "fts":
+            if not options["db"]:
+                raise CommandError("fts requiere --db")
+            rows = bench.bench_fts_layout(options["db"], n_queries=options["queries"], k=options["k"], repeats=options["repeats"])
+            for r in rows:
+                self.stdout.write(
+                    f"{r['layout']:>8}  {r['bytes'] / (1024 * 1024.0):>8.2f} MB  x{r['size_ratio']:<6} "
+                    f"bm25 p50={r['p50_ms']:.3f} ms  p95={r['p95_ms']:.3f} ms  ({r['queries']} consultas)"
+                )
+        elif options["suite"] == "traces":
+            if not options["db"]:
+                raise CommandError("traces requiere --db")
+            if not os.path.isdir(options["traces"]):
+                raise CommandError(f"no existe el directorio {options['traces']}")
+            m = re.search(r"demand_(\d+)\.db$", options["db"])
+            questions = bench.load_trace_questions(options["traces"], int(m.group(1)) if m else None)
+            if not questions:
+                questions = bench.load_trace_questions(options["traces"])  # sin traces de esa demanda: todas las preguntas
+            pipelines = bench.bench_fts_traces(options["db"], questions, k=40)
+            for r in pipelines:
+                self.stdout.write(
+                    f"{r['pipeline']:>20}  AND hit={r['and_hit_rate']:.3f} recall@{r['recall_k']}={r['and_answer_recall']}  "
+                    f"OR hit={r['or_hit_rate']:.3f} recall@{r['recall_k']}={r['or_answer_recall']}  p50={r['p50_ms']:.3f} ms  "
+                    f"({r['questions']} preguntas, {r['answered']} con respuesta)"
+                )
+            rounds = bench.trace_rounds(options["traces"])
+            for r in rounds:
+                self.stdout.write(f"{r['layout']:>20}  rondas LLM={r['mean_rounds']:.2f}  >1 ronda={r['multi_round_rate']:.3f}  ({r['traces']} traces)")
+            if not rounds:
+                self.stdout.write("ningún trace registra llm_rounds todavía")
+            rows = {"pipelines": pipelines, "rounds": rounds}
+        elif options["suite"] == "write":
+            rows = bench.bench_bulk_write(options["n"], dim=options["dim"])
+            for r in rows:
+                self.stdout.write(f"{r['writer']:>8}  {r['chunks']} chunks dim={r['dim']}  {r['seconds']:.3f}s  "
+                                  f"{r['chunks_per_s']:.0f} chunks/s  x{r['speedup']}")
+        elif options["suite"] == "retrieval":
+            rows = self._retrieval(options)
+        self.stdout.write(json.dumps(rows, ensure_ascii=False))
+
+    def _retrieval(self, options) -> dict:
+        modes = [m for m in options["modes"].split(",") if m.strip()]
+        if not modes or set(modes) - set(SEARCH_MODES):
+            raise CommandError(f"--modes debe ser una lista de {SEARCH_MODES}")
+        traces = bench.load_trace_questions(options["traces"]) if os.path.isdir(options["traces"]) else []
+        if options["db"]:
+            # base real: vectores del modelo de la ingesta, preguntas del archivo etiquetado y de traces/ (relevancia por respuesta)
+            questions = bench.load_question_file(options["questions_file"]) if options["questions_file"] else []
+            m = re.search(r"demand_(\d+)\.db$", options["db"])
+            if m and traces:
+                traces = bench.load_trace_questions(options["traces"], int(m.group(1))) or traces
+            with sqlite3.connect(options["db"]) as con:
+                questions += bench.trace_labels(con, traces)
+                embedder = embedder_for(con)  # el de la ingesta (meta), no RAG_EMBEDDER
+            if not questions:
+                raise CommandError("sin preguntas etiquetadas: use --questions-file o traces con respuestas")
+            results = [{"set": "db", "db": options["db"],
+                        **bench.bench_retrieval(options["db"], questions, lambda q: embedder.embed([q])[0], k=options["k"], modes=modes)}]
+        else:
+            try:
+                sizes = [int(n) for n in options["sizes"].split(",") if n.strip()]
+            except ValueError as e:
+                raise CommandError(f"--sizes inválido: {e}")
+            results = bench.bench_retrieval_synthetic(sizes, n_questions=options["queries"], k=options["k"],
+                                                      modes=modes, traces=traces)
+        for r in results:
+            label = f"{r['set']} n={r['chunks']}" if "chunks" in r else r["set"]
+            for mode, q in r.get("quality", {}).items():
+                self.stdout.write(f"{label:>24}  {mode:>5}  " + "  ".join(f"{k}={v}" for k, v in q.items()))
+            for stage, lat in r["latency"].items():
+                self.stdout.write(f"{label:>24}  {stage:>12}  p50={lat['p50_ms']:.3f} ms  p95={lat['p95_ms']:.3f} ms  "
+                                  f"p99={lat['p99_ms']:.3f} ms")
+        out = options["out"] or os.path.join("bench_results", f"retrieval_{bench.git_commit() or 'local'}_{time.strftime('%Y%m%d-%H%M%S')}.json")
+        path = bench.write_results({"suite": "retrieval", "k": options["k"], "modes": modes, "results": results}, out)
+        self.stdout.write(f"resultados en {path}")
+        return {"out": path}
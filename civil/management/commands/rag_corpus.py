@@ -0,0 +1,57 @@
+import os
+from django.core.management.base import BaseCommand, CommandError
+from civil.models import Causa
+from civil.rag.sqlite_db import is_corpus_path, RAG_CORPUS_FILE
+from civil.rag.corpus_store import corpus_path, import_demand_db, drop_demand, rebuild_demand
+
+class Command(BaseCommand):
+    help = ("Corpus consolidado (RAG_STORE=corpus). "
+            "Ejemplo: python manage.py rag_corpus import --switch | rag_corpus delete --demand-id 7 | rag_corpus rebuild --demand-id 7")
+
+    def add_arguments(self, parser):
+        parser.add_argument("action", type=str, choices=["import", "delete", "rebuild"])
+        parser.add_argument("--demand-id", type=int, action="append", dest="demand_ids", default=[],
+                            help="Demanda(s) a procesar; import sin --demand-id toma todas las causas con demand_<id>.db")
+        parser.add_argument("--corpus", type=str, default=None, help="Ruta del corpus (por defecto SQLITE_LOCAL_PATH/RAG_CORPUS_FILE)")
+        parser.add_argument("--switch", action="store_true",
+                            help="import: apuntar Causa.sqlite_path al corpus tras importar cada demanda")
+
+    def handle(self, *args, **options):
+        root = os.getenv("SQLITE_LOCAL_PATH")
+        db_path = options["corpus"] or corpus_path(root)
+        if not is_corpus_path(db_path):
+            raise CommandError(f"{db_path} no se llama {RAG_CORPUS_FILE}: rag_query no lo reconocería como corpus")
+        action, demand_ids = options["action"], options["demand_ids"]
+
+        if action in ("delete", "rebuild"):
+            if not demand_ids:
+                raise CommandError(f"{action} requiere --demand-id")
+            for demand_id in demand_ids:
+                if action == "delete":
+                    n = drop_demand(db_path, demand_id)
+                    self.stdout.write(f"demanda {demand_id}: {n} chunks eliminados")
+                else:
+                    index = rebuild_demand(db_path, demand_id)
+                    self.stdout.write(f"demanda {demand_id}: FTS regenerado, índice IVF {index or '(sin vectores)'}")
+            return
+
+        causas = Causa.objects.exclude(sqlite_path="")
+        if demand_ids:
+            causas = causas.filter(id__in=demand_ids)
+        imported = skipped = 0
+        for causa in causas.order_by("id"):
+            if is_corpus_path(causa.sqlite_path):
+                skipped += 1
+                continue
+            src = f"{root}{causa.sqlite_path}"
+            if not os.path.exists(src):
+                self.stderr.write(f"demanda {causa.id}: no existe {src}")
+                skipped += 1
+                continue
+            n = import_demand_db(db_path, causa.id, src)
+            if options["switch"]:
+                causa.sqlite_path = os.path.join('/', RAG_CORPUS_FILE)
+                causa.save(update_fields=["sqlite_path"])
+            imported += 1
+            self.stdout.write(f"demanda {causa.id}: {n} chunks importados desde {src}")
+        self.stdout.write(f"{imported} demandas importadas en {db_path}, {skipped} omitidas")
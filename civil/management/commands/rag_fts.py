@@ -0,0 +1,34 @@
+import os
+from django.core.management.base import BaseCommand, CommandError
+from civil.models import Causa
+from civil.rag.sqlite_db import migrate_fts
+
+class Command(BaseCommand):
+    help = ("Migra chunks_fts al esquema actual: contenido externo sobre chunks.content_norm (normalización en español). "
+            "Ejemplo: python manage.py rag_fts | rag_fts --db /data/demand_7.db --no-vacuum")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--db", type=str, action="append", dest="dbs", default=[],
+                            help="Base(s) a migrar; sin --db se migran las demand_<id>.db de todas las causas")
+        parser.add_argument("--no-vacuum", action="store_true", help="No compactar tras migrar (el archivo no se achica)")
+
+    def handle(self, *args, **options):
+        paths = options["dbs"]
+        if not paths:
+            root = os.getenv("SQLITE_LOCAL_PATH")
+            if not root:
+                raise CommandError("SQLITE_LOCAL_PATH no está definido; usa --db")
+            paths = sorted({f"{root}{p}" for p in Causa.objects.exclude(sqlite_path="").values_list("sqlite_path", flat=True)})
+        migrated = 0
+        for path in paths:
+            if not os.path.exists(path):
+                self.stderr.write(f"no existe {path}")
+                continue
+            before = os.path.getsize(path)
+            if not migrate_fts(path, vacuum=not options["no_vacuum"]):
+                self.stdout.write(f"{path}: ya migrada")
+                continue
+            migrated += 1
+            after = os.path.getsize(path)
+            self.stdout.write(f"{path}: {before / 1048576:.2f} MB -> {after / 1048576:.2f} MB")
+        self.stdout.write(f"{migrated} bases migradas")
@@ -0,0 +1,148 @@
+from __future__ import annotations
+import os, threading, logging
+import numpy as np
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+from .utils_embed import normalize_vec, normalize_rows
+
+logger = logging.getLogger('civil')
+
+ANN_N_PROBE = int(os.getenv("ANN_N_PROBE", "8"))
+ANN_MAX_LISTS = 1024
+ANN_TRAIN_PER_LIST = 64  # k-means se entrena sobre una muestra de ~64 vectores por lista
+ANN_CACHE_MB = int(os.getenv("ANN_CACHE_MB", "128"))  # índices cargados en memoria (LRU, como RAG_MATRIX_CACHE_MB)
+
+@dataclass
+class IVFIndex:
+    """Índice IVF: centroides k-means y, por lista, los chunk_ids asignados (formato CSR)."""
+    centroids: np.ndarray  # float32 (n_lists, dim), normalizados
+    list_ids: np.ndarray   # int64, chunk_ids ordenados por lista
+    offsets: np.ndarray    # int64 (n_lists + 1,)
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.centroids.nbytes + self.list_ids.nbytes + self.offsets.nbytes)
+
+    def probe(self, qvec, n_probe: int = ANN_N_PROBE) -> np.ndarray:
+        if not self.n_lists:
+            return np.empty(0, np.int64)
+        scores = self.centroids @ normalize_vec(qvec)
+        n_probe = min(max(1, n_probe), self.n_lists)
+        lists = np.argpartition(-scores, n_probe - 1)[:n_probe]
+        return np.concatenate([self.list_ids[self.offsets[c]:self.offsets[c + 1]] for c in lists])
+
+def ann_path(db_path: str, demand_id: Optional[int] = None) -> str:
+    # demand_<id>.db -> demand_<id>.ivf.npz (mismo directorio); corpus.db -> corpus.d<id>.ivf.npz
+    suffix = ".ivf.npz" if demand_id is None else f".d{demand_id}.ivf.npz"
+    return str(Path(db_path).with_suffix(suffix))
+
+def _assign(mat: np.ndarray, centroids: np.ndarray, block: int = 4096) -> np.ndarray:
+    out = np.empty(len(mat), dtype=np.int64)
+    for s in range(0, len(mat), block):
+        out[s:s + block] = np.argmax(mat[s:s + block] @ centroids.T, axis=1)
+    return out
+
+def kmeans(mat: np.ndarray, n_lists: int, iters: int = 10, seed: int = 0) -> np.ndarray:
+    # k-means esférico (similitud coseno) sobre filas ya normalizadas
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(mat), n_lists * ANN_TRAIN_PER_LIST)
+    sample = mat[rng.choice(len(mat), sample_size, replace=False)] if sample_size < len(mat) else mat
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(iters):
+        assign = _assign(sample, centroids)
+        counts = np.bincount(assign, minlength=n_lists)
+        nonempty = np.flatnonzero(counts)
+        order = np.argsort(assign, kind="stable")
+        starts = (np.cumsum(counts) - counts)[nonempty]
+        centroids[nonempty] = normalize_rows(np.add.reduceat(sample[order], starts, axis=0))
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+    return centroids
+
+def build_ivf(chunk_ids: np.ndarray, mat: np.ndarray, n_lists: Optional[int] = None, iters: int = 10, seed: int = 0) -> IVFIndex:
+    """Construye el índice a partir de una matriz normalizada (n, dim) y sus chunk_ids."""
+    n = len(chunk_ids)
+    if n == 0:
+        return IVFIndex(np.empty((0, 0), np.float32), np.empty(0, np.int64), np.zeros(1, np.int64))
+    n_lists = n_lists or int(round(np.sqrt(n)))
+    n_lists = max(1, min(n_lists, ANN_MAX_LISTS, n))
+    centroids = kmeans(mat, n_lists, iters=iters, seed=seed)
+    assign = _assign(mat, centroids)
+    order = np.argsort(assign, kind="stable")
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assign, minlength=n_lists))
+    return IVFIndex(centroids.astype(np.float32), np.asarray(chunk_ids, np.int64)[order], offsets)
+
+def save_ivf(index: IVFIndex, path: str) -> None:
+    # se escribe a un temporal y se renombra para que un lector nunca vea un archivo a medias
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, centroids=index.centroids, list_ids=index.list_ids, offsets=index.offsets)
+    os.replace(tmp, path)
+
+# LRU por ruta del índice, acotado por memoria total: sin tope, un proceso que sirve todo el corpus los retiene todos
+_loaded: "OrderedDict[str, tuple]" = OrderedDict()
+_loaded_bytes = 0
+_loaded_lock = threading.Lock()
+
+def _forget(path: str) -> None:
+    global _loaded_bytes
+    _, index = _loaded.pop(path)
+    _loaded_bytes -= index.nbytes
+
+def evict_ivf(db_path: str, demand_id: Optional[int] = None) -> None:
+    # junto con matrix_cache.invalidate: la demanda se reescribió o se borró del corpus
+    with _loaded_lock:
+        if ann_path(db_path, demand_id) in _loaded:
+            _forget(ann_path(db_path, demand_id))
+
+def load_ivf(db_path: str, demand_id: Optional[int] = None) -> Optional[IVFIndex]:
+    path = ann_path(db_path, demand_id)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    global _loaded_bytes
+    with _loaded_lock:
+        hit = _loaded.get(path)
+        if hit and hit[0] == mtime:
+            _loaded.move_to_end(path)
+            return hit[1]
+    with np.load(path) as data:
+        index = IVFIndex(data["centroids"], data["list_ids"], data["offsets"])
+    max_bytes = ANN_CACHE_MB * 1024 * 1024
+    with _loaded_lock:
+        if path in _loaded:
+            _forget(path)
+        if index.nbytes <= max_bytes:
+            _loaded[path] = (mtime, index)
+            _loaded_bytes += index.nbytes
+            while _loaded_bytes > max_bytes:
+                _forget(next(iter(_loaded)))
+    return index
+
+def build_ann_index(db_path: str, n_lists: Optional[int] = None, demand_id: Optional[int] = None) -> Optional[str]:
+    """Construye y guarda el índice IVF de una base demand_<id>.db (o de una demanda del corpus). Se llama al final de la ingesta."""
+    from .matrix_cache import load_matrix
+    from .sqlite_db import connect
+    con = connect(db_path, demand_id)
+    try:
+        dm = load_matrix(con)
+    finally:
+        con.close()
+    path = ann_path(db_path, demand_id)
+    if not len(dm.chunk_ids):
+        if os.path.exists(path):
+            os.remove(path)
+        return None
+    index = build_ivf(dm.chunk_ids, dm.matrix, n_lists=n_lists)
+    save_ivf(index, path)
+    logger.info(f"Índice IVF guardado en {path}: {len(dm.chunk_ids)} vectores, {index.n_lists} listas")
+    return path
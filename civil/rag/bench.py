@@ -0,0 +1,486 @@
+from __future__ import annotations
+import os, re, json, sqlite3, tempfile, time
+import numpy as np
+from typing import List, Dict, Iterable, Optional, Tuple
+from .utils_embed import pack_vec, unpack_vec, cosine_sim, normalize_rows, VectorCodec, Embedder, get_embedder
+from .sqlite_db import (rerank_by_embedding, top_k_indices, topk_bm25, fts_or_query, fts_layout, migrate_fts,
+                        ensure_schema, insert_document, insert_chunk, insert_embedding, connect, vector_codec,
+                        dense_candidates, hybrid_search, SEARCH_MODES)
+from .matrix_cache import matrix_cache, load_matrix
+from .bulk_writer import BulkWriter
+from .text_norm import normalize_for_fts, clear_token_cache, FTS_NORM_VERSION
+
+DEFAULT_DIM = 3072  # text-embedding-3-large
+
+QUANT_CONFIGS: List[Tuple[str, int]] = [
+    ("float32", 0), ("float16", 0), ("int8", 0),
+    ("float32", 1024), ("float16", 1024), ("int8", 1024),
+    ("float16", 256), ("int8", 256),
+]
+
+def _timeit(fn, repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def _rerank_loop(rows: List[tuple], qvec, k: int):
+    # implementación previa de hybrid_search, se mantiene solo como referencia
+    scored = []
+    for cid, content, blob in rows:
+        scored.append((cid, content, cosine_sim(qvec, unpack_vec(blob))))
+    scored.sort(key=lambda x: x[2], reverse=True)
+    return scored[:k]
+
+def bench_rerank(counts: Iterable[int] = (10, 40, 100, 400, 1000, 4000), dim: int = DEFAULT_DIM,
+                 k: int = 8, repeats: int = 5, seed: int = 0) -> List[Dict]:
+    rng = np.random.default_rng(seed)
+    qvec = rng.standard_normal(dim).astype(np.float32)
+    out = []
+    for n in counts:
+        rows = [(i, "", pack_vec(rng.standard_normal(dim).astype(np.float32))) for i in range(n)]
+        loop_s = _timeit(lambda: _rerank_loop(rows, qvec, k), repeats)
+        batch_s = _timeit(lambda: rerank_by_embedding(rows, qvec, k), repeats)
+        out.append({
+            "candidates": n,
+            "dim": dim,
+            "loop_ms": round(loop_s * 1000, 3),
+            "batched_ms": round(batch_s * 1000, 3),
+            "speedup": round(loop_s / batch_s, 1) if batch_s else None,
+        })
+    return out
+
+def synthetic_corpus(n: int, dim: int = DEFAULT_DIM, n_clusters: int = 64, decay: float = 64.0, seed: int = 0) -> np.ndarray:
+    # vectores agrupados con espectro decreciente: como en text-embedding-3 (Matryoshka),
+    # la energía se concentra en las primeras dimensiones, así truncar tiene sentido
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    points = centers[rng.integers(0, n_clusters, n)] + 0.7 * rng.standard_normal((n, dim)).astype(np.float32)
+    points *= (1.0 / np.sqrt(1.0 + np.arange(dim) / decay)).astype(np.float32)
+    return normalize_rows(points)
+
+def _topk_rows(mat: np.ndarray, queries: np.ndarray, k: int) -> List[set]:
+    scores = queries @ mat.T
+    return [set(top_k_indices(row, k).tolist()) for row in scores]
+
+def bench_quantization(corpus: np.ndarray, queries: np.ndarray, configs: Iterable[Tuple[str, int]] = QUANT_CONFIGS,
+                       k: int = 10) -> List[Dict]:
+    """recall@k de cada formato de almacenamiento frente a float32 completo (búsqueda exacta)."""
+    full_dim = corpus.shape[1]
+    truth = _topk_rows(corpus, normalize_rows(queries), k)
+    base_bytes = 4 * full_dim
+    out = []
+    for fmt, dim in configs:
+        if dim >= full_dim:
+            dim = 0
+        codec = VectorCodec(fmt, dim)
+        blobs = [codec.encode(v) for v in corpus]
+        mat = normalize_rows(codec.decode_matrix(blobs))
+        q = normalize_rows(np.vstack([codec.prepare(v) for v in queries]))
+        got = _topk_rows(mat, q, k)
+        recall = float(np.mean([len(g & t) / k for g, t in zip(got, truth)]))
+        out.append({
+            "format": fmt,
+            "dim": dim or full_dim,
+            "bytes_per_vector": len(blobs[0]),
+            "size_ratio": round(len(blobs[0]) / base_bytes, 3),
+            "corpus_mb": round(len(blobs[0]) * len(corpus) / (1024 * 1024.0), 2),
+            "k": k,
+            "recall": round(recall, 4),
+        })
+    return out
+
+def query_sample(corpus: np.ndarray, n_queries: int = 100, noise: float = 0.5, seed: int = 1) -> np.ndarray:
+    # consultas = vectores del corpus perturbados (el vecino exacto no es trivialmente el mismo vector)
+    rng = np.random.default_rng(seed)
+    picked = corpus[rng.choice(len(corpus), min(n_queries, len(corpus)), replace=False)]
+    return picked + noise * rng.standard_normal(picked.shape).astype(np.float32) / np.sqrt(corpus.shape[1])
+
+def fts_query_sample(con: sqlite3.Connection, n_queries: int = 50, seed: int = 0) -> List[str]:
+    # consultas de 1-3 palabras tomadas de chunks al azar (como las keywords de NEED_MORE_CONTEXT)
+    rng = np.random.default_rng(seed)
+    ids = [r[0] for r in con.execute("SELECT id FROM chunks").fetchall()]
+    out = []
+    for cid in rng.choice(ids, min(n_queries, len(ids)), replace=False) if ids else []:
+        words = [w for w in re.findall(r"\w+", con.execute("SELECT content FROM chunks WHERE id=?", (int(cid),)).fetchone()[0]) if len(w) > 3]
+        if words:
+            out.append(" ".join(rng.choice(words, min(len(words), int(rng.integers(1, 4))), replace=False)))
+    return out
+
+def _fts_latency(db_path: str, queries: List[str], k: int, repeats: int) -> Dict:
+    with sqlite3.connect(db_path) as con:
+        per_query = []
+        normalized = fts_layout(con) == "normalized"
+        for q in queries:
+            fq = fts_or_query(q, normalized)
+            per_query.append(_timeit(lambda: topk_bm25(con, fq, k), repeats))
+    ms = np.array(per_query) * 1000
+    return {"p50_ms": round(float(np.percentile(ms, 50)), 3), "p95_ms": round(float(np.percentile(ms, 95)), 3),
+            "mean_ms": round(float(ms.mean()), 3)}
+
+def _copy_db(db_path: str, tmp: str) -> str:
+    copy = os.path.join(tmp, os.path.basename(db_path))
+    with sqlite3.connect(db_path) as src, sqlite3.connect(copy) as dst:
+        src.backup(dst)
+    with sqlite3.connect(copy) as con:
+        con.execute("VACUUM")  # mismo punto de partida que la base migrada
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return copy
+
+def _layout_of(db_path: str) -> str:
+    with sqlite3.connect(db_path) as con:
+        return fts_layout(con)
+
+def bench_fts_layout(db_path: str, n_queries: int = 50, k: int = 40, repeats: int = 5) -> List[Dict]:
+    """Tamaño y latencia BM25 de una base con su chunks_fts actual vs el esquema actual (sobre una copia)."""
+    out = []
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = _copy_db(db_path, tmp)
+        with sqlite3.connect(copy) as con:
+            queries = fts_query_sample(con, n_queries)
+        out.append({"layout": _layout_of(copy), "bytes": os.path.getsize(copy), **_fts_latency(copy, queries, k, repeats)})
+        if migrate_fts(copy):
+            out.append({"layout": _layout_of(copy), "bytes": os.path.getsize(copy), **_fts_latency(copy, queries, k, repeats)})
+    base = out[0]["bytes"]
+    for r in out:
+        r["size_ratio"] = round(r["bytes"] / base, 3) if base else None
+        r["queries"] = len(queries)
+    return out
+
+def _legacy_fts_sanitize(q: str) -> str:
+    # fts_sanitize de rag_query antes de text_norm: solo quitaba signos
+    return " ".join(re.sub(r"[^0-9A-Za-zÁÉÍÓÚÜÑáéíóúüñ]+", " ", q or "").split())
+
+_INCONCLUSIVE = ("No fue posible", "Error")
+
+def load_trace_questions(traces_dir: str, demand_id: Optional[int] = None) -> List[Tuple[str, Optional[str]]]:
+    """(pregunta, última respuesta concluyente o None) de los traces de rag_query, opcionalmente de una demanda."""
+    out: Dict[str, Optional[str]] = {}
+    for name in sorted(os.listdir(traces_dir)):
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(traces_dir, name), encoding="utf-8") as f:
+            trace = json.load(f)
+        if not trace.get("question") or (demand_id is not None and trace.get("demand_id") != demand_id):
+            continue
+        answer = trace.get("answer")
+        conclusive = isinstance(answer, str) and answer.strip() and not answer.startswith(_INCONCLUSIVE)
+        question = trace["question"].strip()
+        out[question] = answer if conclusive else out.get(question)
+    return list(out.items())
+
+def trace_rounds(traces_dir: str) -> List[Dict]:
+    """Rondas LLM promedio por esquema FTS, de los traces que las registran (llm_rounds / fts_layout)."""
+    by_layout: Dict[str, List[int]] = {}
+    for name in sorted(os.listdir(traces_dir)):
+        if name.endswith(".json"):
+            with open(os.path.join(traces_dir, name), encoding="utf-8") as f:
+                trace = json.load(f)
+            if "llm_rounds" in trace:
+                by_layout.setdefault(trace.get("fts_layout") or "?", []).append(int(trace["llm_rounds"]))
+    return [{"layout": layout, "traces": len(r), "mean_rounds": round(float(np.mean(r)), 3),
+             "multi_round_rate": round(sum(x > 1 for x in r) / len(r), 3)} for layout, r in sorted(by_layout.items())]
+
+def answer_terms(question: str, answer: str) -> set:
+    # términos de la respuesta que no estaban en la pregunta: nombres, montos, fechas que el contexto debía traer
+    return set(normalize_for_fts(answer).split()) - set(normalize_for_fts(question).split())
+
+def _answer_recall(rows: List[Tuple[int, str]], terms: set, k: int) -> float:
+    found = set(normalize_for_fts(" ".join(content for _, content in rows[:k])).split())
+    return len(terms & found) / len(terms)
+
+def _fts_hits(db_path: str, qa: List[Tuple[str, Optional[str]]], sanitize, k: int, recall_k: int) -> Dict:
+    # AND: lo que buscan seed/_context_rows (términos saneados); OR: lo que usa rrf
+    and_hits, or_hits, and_recall, or_recall, ms = [], [], [], [], []
+    with sqlite3.connect(db_path) as con:
+        normalized = fts_layout(con) == "normalized"
+        for q, answer in qa:
+            fq = sanitize(q)
+            t0 = time.perf_counter()
+            and_rows = topk_bm25(con, fq, k) if fq else []
+            ms.append((time.perf_counter() - t0) * 1000)
+            oq = fts_or_query(fq, normalized)
+            or_rows = topk_bm25(con, oq, k) if oq else []
+            and_hits.append(len(and_rows))
+            or_hits.append(len(or_rows))
+            terms = answer_terms(q, answer) if answer else set()
+            if terms:
+                and_recall.append(_answer_recall(and_rows, terms, recall_k))
+                or_recall.append(_answer_recall(or_rows, terms, recall_k))
+    and_hits, or_hits = np.array(and_hits), np.array(or_hits)
+    return {"and_hit_rate": round(float((and_hits > 0).mean()), 3), "and_mean_hits": round(float(and_hits.mean()), 2),
+            "or_hit_rate": round(float((or_hits > 0).mean()), 3), "or_mean_hits": round(float(or_hits.mean()), 2),
+            "and_answer_recall": round(float(np.mean(and_recall)), 3) if and_recall else None,
+            "or_answer_recall": round(float(np.mean(or_recall)), 3) if or_recall else None,
+            "answered": len(or_recall), "p50_ms": round(float(np.percentile(ms, 50)), 3)}
+
+def bench_fts_traces(db_path: str, questions: List[Tuple[str, Optional[str]]], k: int = 40, recall_k: int = 8) -> List[Dict]:
+    """
+    Cobertura BM25 de las preguntas reales (traces/) con el saneado y el FTS anteriores vs. la normalización en español.
+    No hay juicios de relevancia; como aproximación de recall@recall_k se usa la fracción de términos de la respuesta
+    registrada (que no estaban en la pregunta) presentes en los primeros recall_k chunks léxicos.
+    """
+    if not questions:
+        return []
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = _copy_db(db_path, tmp)
+        out = [{"pipeline": f"{_layout_of(copy)}+sanitize", **_fts_hits(copy, questions, _legacy_fts_sanitize, k, recall_k)}]
+        migrate_fts(copy)
+        out.append({"pipeline": f"{_layout_of(copy)}+{FTS_NORM_VERSION}",
+                    **_fts_hits(copy, questions, normalize_for_fts, k, recall_k)})
+    for r in out:
+        r["questions"] = len(questions)
+        r["recall_k"] = recall_k
+    return out
+
+def _write_rowwise(db_path: str, texts: List[str], vecs: np.ndarray) -> None:
+    # camino anterior de ingest_demand: un execute por chunk, otro por FTS y otro por vector, una transacción
+    with sqlite3.connect(db_path) as con:
+        doc_id = insert_document(con, "bench.pdf")
+        for i, (t, v) in enumerate(zip(texts, vecs)):
+            cid = insert_chunk(con, doc_id, t, seq=i)
+            insert_embedding(con, cid, v)
+
+def _write_bulk(db_path: str, texts: List[str], vecs: np.ndarray) -> None:
+    with sqlite3.connect(db_path) as con:
+        writer = BulkWriter(con)
+        doc = writer.add_document("bench.pdf")
+        for i, (t, v) in enumerate(zip(texts, vecs)):
+            writer.add_chunk(doc, t, i, v)
+        writer.finish()
+
+def bench_bulk_write(n: int = 5000, dim: int = DEFAULT_DIM, chunk_chars: int = 1200, seed: int = 0) -> List[Dict]:
+    """chunks/s de escritura en SQLite: insert_chunk/insert_embedding fila a fila vs BulkWriter (sin extracción ni API)."""
+    rng = np.random.default_rng(seed)
+    vocab = [f"palabra{i}" for i in range(5000)] + ["demanda", "pagaré", "ejecutivo", "embargo", "intereses"]
+    words_per_chunk = max(1, chunk_chars // 10)
+    texts = [" ".join(rng.choice(vocab, words_per_chunk)) for _ in range(n)]
+    vecs = rng.standard_normal((n, dim)).astype(np.float32)
+    out = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, fn in (("rowwise", _write_rowwise), ("bulk", _write_bulk)):
+            path = os.path.join(tmp, f"{name}.db")
+            ensure_schema(path)
+            clear_token_cache()  # ambos caminos normalizan el texto: que ninguno parta con el caché del otro
+            t0 = time.perf_counter()
+            fn(path, texts, vecs)
+            dt = time.perf_counter() - t0
+            out.append({"writer": name, "chunks": n, "dim": dim, "seconds": round(dt, 3), "chunks_per_s": round(n / dt, 1)})
+    base = out[0]["seconds"]
+    for r in out:
+        r["speedup"] = round(base / r["seconds"], 2) if r["seconds"] else None
+    return out
+
+# --- calidad y latencia de recuperación (suite retrieval) ---
+
+RETRIEVAL_SIZES = (1000, 10000)
+RETRIEVAL_DIM = 256
+
+def local_embedder(dim: int = RETRIEVAL_DIM) -> Embedder:
+    # embedder offline determinista del registro: la misma base da los mismos números en cada commit
+    return get_embedder("local", dim=dim)
+
+_NOMBRES = ("Juan", "María", "Pedro", "Ana", "Luis", "Carmen", "José", "Rosa", "Jorge", "Elena", "Carlos", "Patricia",
+            "Manuel", "Isabel", "Francisco", "Teresa", "Diego", "Claudia", "Ricardo", "Verónica")
+_SILABAS = ("ba", "ce", "di", "fo", "gu", "la", "me", "ni", "po", "ru", "sa", "te", "vi", "zo", "mar", "quel",
+            "rran", "tor", "ven", "gal")
+_CONCEPTOS = (("adeuda la suma de", "cuánto adeuda"), ("suscribió un pagaré por", "por cuánto suscribió el pagaré"),
+              ("fue embargado por", "por qué monto fue embargado"), ("consignó en la cuenta del tribunal", "cuánto consignó"),
+              ("demanda intereses por", "qué intereses demanda"))
+_RELLENO = ("tribunal", "juzgado", "civil", "demanda", "ejecutivo", "notificación", "resolución", "plazo", "recurso",
+            "audiencia", "escrito", "abogado", "patrocinio", "poder", "mandato", "costas", "apelación", "sentencia",
+            "embargo", "bienes", "receptor", "certificado", "cuaderno", "apremio", "excepciones", "actuación", "folio",
+            "providencia", "traslado", "téngase", "presente", "acompaña", "documentos", "autos", "causa", "rol")
+
+def _apellido(i: int) -> str:
+    # único por chunk: i en base len(_SILABAS) con al menos 3 sílabas
+    sil = []
+    for _ in range(3):
+        i, r = divmod(i, len(_SILABAS))
+        sil.append(_SILABAS[r])
+    while i:
+        i, r = divmod(i, len(_SILABAS))
+        sil.append(_SILABAS[r])
+    return "".join(sil).capitalize()
+
+def _rut(i: int) -> str:
+    n = 5_000_000 + i * 37
+    return f"{n // 1_000_000}.{n // 1000 % 1000:03d}.{n % 1000:03d}-{n % 10}"
+
+def synthetic_demand(n: int, words: int = 60, seed: int = 0) -> Tuple[List[str], List[Dict]]:
+    """
+    n chunks tipo escrito judicial: relleno del vocabulario procesal (compartido por todos) más un hecho único
+    (nombre, RUT, concepto, monto). Devuelve los textos y los hechos para armar preguntas con su chunk relevante.
+    """
+    rng = np.random.default_rng(seed)
+    texts, facts = [], []
+    for i in range(n):
+        nombre, apellido = _NOMBRES[int(rng.integers(len(_NOMBRES)))], _apellido(i)
+        concepto = int(rng.integers(len(_CONCEPTOS)))
+        monto = f"{int(rng.integers(100, 99_999)) * 1000:,}".replace(",", ".")
+        filler = rng.choice(_RELLENO, words).tolist()
+        cut = int(rng.integers(0, words))
+        head, tail = " ".join(filler[:cut]), " ".join(filler[cut:])
+        texts.append(f"{head} {nombre} {apellido}, RUT {_rut(i)}, {_CONCEPTOS[concepto][0]} ${monto}. {tail}".strip())
+        facts.append({"nombre": nombre, "apellido": apellido, "rut": _rut(i), "concepto": concepto})
+    return texts, facts
+
+def synthetic_questions(facts: List[Dict], n_questions: int = 200, seed: int = 1) -> List[Dict]:
+    """Preguntas con su chunk relevante (índice en facts): por nombre y concepto, o solo por RUT."""
+    rng = np.random.default_rng(seed)
+    out = []
+    for i in rng.choice(len(facts), min(n_questions, len(facts)), replace=False):
+        f = facts[int(i)]
+        if len(out) % 3 == 2:
+            q, kind = f"¿Quién es la persona con RUT {f['rut']}?", "rut"
+        else:
+            q, kind = f"¿{_CONCEPTOS[f['concepto']][1].capitalize()} {f['nombre']} {f['apellido']}?", "nombre"
+        out.append({"question": q, "relevant": [int(i)], "kind": kind})
+    return out
+
+def build_synthetic_db(db_path: str, texts: List[str], embedder: Optional[Embedder] = None, docs: int = 0,
+                       batch: int = 2000) -> List[int]:
+    """Escribe una demand_<id>.db sintética (BulkWriter + índice IVF) y devuelve los chunk ids en el orden de texts."""
+    embedder = embedder or local_embedder()
+    ensure_schema(db_path)
+    docs = docs or max(1, len(texts) // 50)
+    per_doc = -(-len(texts) // docs)
+    with sqlite3.connect(db_path) as con:
+        writer = BulkWriter(con, embedder=embedder)
+        doc = None
+        for start in range(0, len(texts), batch):
+            vecs = embedder.embed(texts[start:start + batch])
+            for i, (t, v) in enumerate(zip(texts[start:start + batch], vecs), start):
+                if i % per_doc == 0:
+                    doc = writer.add_document(f"{i // per_doc + 1}_1.pdf")
+                writer.add_chunk(doc, t, i % per_doc, v)
+        writer.finish()
+        ids = [r[0] for r in con.execute("SELECT id FROM chunks ORDER BY document_id, seq")]
+    from .ann import build_ann_index
+    build_ann_index(db_path)
+    return ids
+
+def trace_labels(con: sqlite3.Connection, questions: List[Tuple[str, Optional[str]]], min_terms: int = 2,
+                 min_overlap: float = 0.6) -> List[Dict]:
+    """
+    Relevancia aproximada para las preguntas de traces/: chunks que contienen al menos min_overlap de los términos
+    de la respuesta registrada que no estaban en la pregunta. Preguntas sin respuesta o con pocos términos se omiten.
+    """
+    rows = con.execute("SELECT id, content FROM chunks").fetchall()
+    words = [(cid, set(normalize_for_fts(content).split())) for cid, content in rows]
+    out = []
+    for q, answer in questions:
+        terms = answer_terms(q, answer) if answer else set()
+        if len(terms) < min_terms:
+            continue
+        relevant = [cid for cid, w in words if len(terms & w) >= min_overlap * len(terms)]
+        if relevant:
+            out.append({"question": q, "relevant": relevant, "kind": "trace"})
+    return out
+
+def load_question_file(path: str) -> List[Dict]:
+    """Set etiquetado en JSON: [{"question": ..., "relevant": [chunk_id, ...]}, ...] sobre una base real (--db)."""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return [{"question": d["question"], "relevant": [int(c) for c in d["relevant"]], "kind": d.get("kind", "file")}
+            for d in data if d.get("question") and d.get("relevant")]
+
+def _percentiles(secs: List[float]) -> Dict:
+    ms = np.array(secs) * 1000 if secs else np.zeros(1)
+    return {f"p{p}_ms": round(float(np.percentile(ms, p)), 3) for p in (50, 95, 99)}
+
+def _quality(ranked: List[List[int]], relevant: List[set], k: int) -> Dict:
+    recall, rr = [], []
+    for got, rel in zip(ranked, relevant):
+        if not rel:
+            continue  # sin etiqueta (solo latencia)
+        recall.append(len(set(got[:k]) & rel) / len(rel))
+        rank = next((r for r, cid in enumerate(got[:k], 1) if cid in rel), None)
+        rr.append(1.0 / rank if rank else 0.0)
+    return {f"recall@{k}": round(float(np.mean(recall)), 4) if recall else None,
+            "mrr": round(float(np.mean(rr)), 4) if rr else None}
+
+def bench_retrieval(db_path: str, questions: List[Dict], embed_query, k: int = 8, bm25_k: int = 40,
+                    modes: Iterable[str] = SEARCH_MODES, demand_id: Optional[int] = None) -> Dict:
+    """
+    recall@k y MRR de hybrid_search por modo, y latencias p50/p95/p99 por etapa: embed (consulta), bm25 (topk_bm25),
+    dense (matriz + IVF si existe) y search_<modo> (hybrid_search completo con el vector ya calculado).
+    questions: [{"question", "relevant": [chunk_id]}].
+    """
+    stages: Dict[str, List[float]] = {"embed": [], "bm25": [], "dense": []}
+    ranked: Dict[str, List[List[int]]] = {m: [] for m in modes}
+    relevant = [set(q["relevant"]) for q in questions]
+    con = connect(db_path, demand_id)
+    try:
+        codec = vector_codec(con)
+        cached = matrix_cache.get(con) or load_matrix(con)  # carga fuera de la medición: se mide la consulta en caliente
+        for q in questions:
+            text = q["question"]
+            t0 = time.perf_counter()
+            vec = embed_query(text)
+            stages["embed"].append(time.perf_counter() - t0)
+            qvec = codec.prepare(vec)
+            t0 = time.perf_counter()
+            topk_bm25(con, text, bm25_k)
+            stages["bm25"].append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            dense_candidates(con, cached, qvec, bm25_k)
+            stages["dense"].append(time.perf_counter() - t0)
+            for mode in modes:
+                t0 = time.perf_counter()
+                rows = hybrid_search(con, text, lambda _q: vec, bm25_k=bm25_k, rerank_k=k, mode=mode)
+                stages.setdefault(f"search_{mode}", []).append(time.perf_counter() - t0)
+                ranked[mode].append([cid for cid, _, _ in rows])
+    finally:
+        con.close()
+    return {"questions": len(questions), "k": k,
+            "quality": {m: _quality(ranked[m], relevant, k) for m in modes},
+            "latency": {s: _percentiles(v) for s, v in stages.items()}}
+
+def git_commit() -> Optional[str]:
+    import subprocess
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              timeout=5, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def bench_retrieval_synthetic(sizes: Iterable[int] = RETRIEVAL_SIZES, n_questions: int = 200, k: int = 8,
+                              dim: int = RETRIEVAL_DIM, modes: Iterable[str] = SEARCH_MODES,
+                              traces: Optional[List[Tuple[str, Optional[str]]]] = None) -> List[Dict]:
+    """
+    Por cada tamaño: base sintética con el embedder local, preguntas etiquetadas y bench_retrieval.
+    traces: preguntas reales (load_trace_questions) que se corren además para latencia; no tienen chunk relevante aquí.
+    """
+    embedder = local_embedder(dim)
+    embed_query = lambda q: embedder.embed([q])[0]
+    out = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            texts, facts = synthetic_demand(n)
+            path = os.path.join(tmp, f"demand_{n}.db")
+            t0 = time.perf_counter()
+            ids = build_synthetic_db(path, texts, embedder)
+            build_s = time.perf_counter() - t0
+            questions = [{**q, "relevant": [ids[i] for i in q["relevant"]]} for q in synthetic_questions(facts, n_questions)]
+            r = bench_retrieval(path, questions, embed_query, k=k, modes=modes)
+            r.update({"set": "synthetic", "chunks": n, "dim": dim, "build_s": round(build_s, 3),
+                      "bytes": sum(os.path.getsize(f) for f in (path, path + "-wal") if os.path.exists(f))})
+            out.append(r)
+            if traces:
+                tq = [{"question": q, "relevant": []} for q, _ in traces]
+                rt = bench_retrieval(path, tq, embed_query, k=k, modes=modes)
+                out.append({"set": "traces_latency", "chunks": n, "dim": dim, "questions": rt["questions"],
+                            "latency": rt["latency"]})
+            matrix_cache.clear()
+    return out
+
+def write_results(results: Dict, out_path: str) -> str:
+    """JSON con la configuración, el commit y los resultados, para comparar corridas entre commits."""
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    payload = {"commit": git_commit(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), **results}
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+    return out_path
@@ -0,0 +1,207 @@
+from __future__ import annotations
+import os, json, shutil, sqlite3, logging
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+import numpy as np
+from .utils_embed import pack_vec, VectorCodec, Embedder, EmbedderMismatch
+from .sqlite_db import (demand_scope, fts_layout, fts_column, fts_demand_token, vector_codec, has_spans, record_embedder,
+                        SPAN_COLUMNS)
+from .text_norm import normalize_for_fts
+
+logger = logging.getLogger('civil')
+
+# Escritura masiva de la ingesta: executemany por lote, FTS poblado al final con un INSERT ... SELECT
+RAG_BULK_FLUSH_ROWS = int(os.getenv("RAG_BULK_FLUSH_ROWS", "5000"))
+RAG_INGEST_TMP = os.getenv("RAG_INGEST_TMP") or None  # directorio local para la base temporal (None = el del sistema)
+
+class BulkWriter:
+    """
+    Acumula documentos, chunks y vectores y los escribe con executemany cada flush_rows chunks.
+    Los ids se asignan en el flush, con el lock de escritura tomado, así dos ingestas al mismo corpus no chocan;
+    add_document/add_chunk devuelven referencias locales que add_chunk/add_occurrence aceptan.
+    finish() pobla chunks_fts para todo lo escrito.
+    commit=False: no abre ni cierra transacciones (el llamador ya está dentro de una, p.ej. import_demand_db).
+    embedder: el que produjo los vectores; se registra en meta y no se aceptan vectores de otra base/dimensión.
+    """
+
+    def __init__(self, con: sqlite3.Connection, codec: Optional[VectorCodec] = None,
+                 flush_rows: int = RAG_BULK_FLUSH_ROWS, commit: bool = True, embedder: Optional[Embedder] = None):
+        self.con = con
+        self.codec = codec or vector_codec(con)
+        self.embedder = embedder
+        self.flush_rows = flush_rows
+        self.commit = commit
+        self.scope = demand_scope(con)
+        self.normalized = fts_layout(con) == "normalized"
+        self.spans = has_spans(con)
+        self._docs: List[Tuple[int, str, str]] = []  # (ref, path, meta_json)
+        self._doc_ids: Dict[int, int] = {}  # ref -> documents.id ya escrito
+        self._chunks: List[tuple] = []  # (ref, doc_ref, content, seq, content_norm, vector, span)
+        self._chunk_ids: Dict[int, int] = {}  # ref -> chunks.id ya escrito
+        self._n_chunk_refs = 0
+        self._occurrences: List[tuple] = []  # (chunk_ref, doc_ref, seq, span)
+        self._ranges: List[Tuple[int, int]] = []  # ids de chunks escritos, para el FTS diferido
+        self.chunks_written = 0
+        self.occurrences_written = 0
+
+    def add_document(self, path: str, meta: Optional[dict] = None) -> int:
+        ref = len(self._doc_ids) + len(self._docs)
+        self._docs.append((ref, path, json.dumps(meta or {}, ensure_ascii=False)))
+        return ref
+
+    def add_chunk(self, doc_ref: int, content: str, seq: int, vector: Union[np.ndarray, bytes, None] = None,
+                  content_norm: Optional[str] = None, span: Optional[Sequence[Optional[int]]] = None) -> int:
+        """
+        vector: array (se empaqueta con el codec de la base) o bytes ya empaquetados con ese codec.
+        span: (page, page_end, char_start, char_end) del chunk en el documento, si se conoce.
+        Devuelve una referencia al chunk para add_occurrence.
+        """
+        if self.normalized and content_norm is None:
+            content_norm = normalize_for_fts(content)
+        if vector is not None and not isinstance(vector, (bytes, memoryview)):
+            # vale el vector completo del embedder o uno ya truncado a la dim del codec (p.ej. decodificado de otra base)
+            dim = self.embedder.dim if self.embedder is not None else 0
+            got = np.shape(vector)[-1]
+            if dim and got not in (dim, self.codec.dim):
+                raise EmbedderMismatch(f"vector de dim={got}, se esperaba {dim} ({self.embedder.model})")
+            vector = pack_vec(vector, self.codec)
+        ref = self._n_chunk_refs
+        self._n_chunk_refs += 1
+        self._chunks.append((ref, doc_ref, content, seq, content_norm, vector, span))
+        if len(self._chunks) + len(self._occurrences) >= self.flush_rows:
+            self.flush()
+        return ref
+
+    def add_occurrence(self, chunk_ref: int, doc_ref: int, seq: int,
+                       span: Optional[Sequence[Optional[int]]] = None) -> None:
+        """Registra que el chunk canónico chunk_ref también aparece en doc_ref/seq (casi-duplicado no almacenado)."""
+        self._occurrences.append((chunk_ref, doc_ref, seq, span))
+        if len(self._chunks) + len(self._occurrences) >= self.flush_rows:
+            self.flush()
+
+    def _next_id(self, table: str) -> int:
+        return int(self.con.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]) + 1
+
+    def _write(self) -> None:
+        con, scope = self.con, self.scope
+        if not con.in_transaction:
+            con.execute("BEGIN IMMEDIATE")  # lock de escritura antes de leer MAX(id)
+        if self.embedder is not None:
+            record_embedder(con, self.embedder)  # antes de los vectores: falla si la base ya tiene otros
+        if self._docs:
+            base = self._next_id("documents")
+            rows = []
+            for i, (ref, path, meta_json) in enumerate(self._docs):
+                self._doc_ids[ref] = base + i
+                rows.append((base + i, path, meta_json) if scope is None else (base + i, scope, path, meta_json))
+            if scope is None:
+                con.executemany("INSERT INTO documents(id, path, meta_json) VALUES(?,?,?)", rows)
+            else:
+                con.executemany("INSERT INTO documents(id, demand_id, path, meta_json) VALUES(?,?,?,?)", rows)
+            self._docs = []
+        if self._chunks:
+            self._write_chunks()
+        if self._occurrences:
+            self._write_occurrences()
+
+    def _write_chunks(self) -> None:
+        con, scope = self.con, self.scope
+        base = self._next_id("chunks")
+        cols = ["id", "document_id", "content", "seq"] + (["demand_id"] if scope is not None else []) \
+            + (["content_norm"] if self.normalized else []) + (list(SPAN_COLUMNS) if self.spans else [])
+        chunk_rows, vec_rows = [], []
+        for i, (ref, doc_ref, content, seq, content_norm, vector, span) in enumerate(self._chunks):
+            self._chunk_ids[ref] = base + i
+            row = [base + i, self._doc_ids[doc_ref], content, seq]
+            if scope is not None:
+                row.append(scope)
+            if self.normalized:
+                row.append(content_norm)
+            if self.spans:
+                row.extend(span or (None,) * len(SPAN_COLUMNS))
+            chunk_rows.append(row)
+            if vector is not None:
+                vec_rows.append((base + i, vector) if scope is None else (scope, base + i, vector))
+        con.executemany(f"INSERT INTO chunks({', '.join(cols)}) VALUES({', '.join('?' for _ in cols)})", chunk_rows)
+        if scope is None:
+            con.executemany("INSERT INTO embeddings(chunk_id, vector) VALUES(?, ?)", vec_rows)
+        else:
+            con.executemany("INSERT INTO embeddings(demand_id, chunk_id, vector) VALUES(?, ?, ?)", vec_rows)
+        self._ranges.append((base, base + len(self._chunks) - 1))
+        self.chunks_written += len(self._chunks)
+        self._chunks = []
+
+    def _write_occurrences(self) -> None:
+        # solo las que apuntan a chunks ya escritos; el resto espera al próximo flush
+        ready, waiting = [], []
+        for occ in self._occurrences:
+            (ready if occ[0] in self._chunk_ids else waiting).append(occ)
+        self._occurrences = waiting
+        if not ready:
+            return
+        cols = (["demand_id"] if self.scope is not None else []) + ["chunk_id", "document_id", "seq", *SPAN_COLUMNS]
+        rows = [([self.scope] if self.scope is not None else []) + [self._chunk_ids[chunk_ref], self._doc_ids[doc_ref], seq,
+                *(span or (None,) * len(SPAN_COLUMNS))] for chunk_ref, doc_ref, seq, span in ready]
+        self.con.executemany(
+            f"INSERT INTO chunk_occurrences({', '.join(cols)}) VALUES({', '.join('?' for _ in cols)})", rows)
+        self.occurrences_written += len(rows)
+
+    def flush(self) -> None:
+        if not self._docs and not self._chunks and not self._occurrences:
+            return
+        if self.commit:
+            with self.con:
+                self._write()
+        else:
+            self._write()
+
+    def _populate_fts(self) -> None:
+        col = fts_column(self.con)
+        layout = fts_layout(self.con)
+        if self.scope is not None:
+            sql = (f"INSERT INTO chunks_fts(rowid, {col}, demand) SELECT id, {col}, '{fts_demand_token(self.scope)}' "
+                   f"FROM chunks WHERE id BETWEEN ? AND ?")
+        elif layout == "legacy":
+            sql = "INSERT INTO chunks_fts(rowid, content, chunk_id) SELECT id, content, id FROM chunks WHERE id BETWEEN ? AND ?"
+        else:
+            sql = f"INSERT INTO chunks_fts(rowid, {col}) SELECT id, {col} FROM chunks WHERE id BETWEEN ? AND ?"
+        for lo, hi in self._ranges:
+            self.con.execute(sql, (lo, hi))
+        self._ranges = []
+
+    def finish(self) -> int:
+        """Escribe lo pendiente y pobla chunks_fts. Devuelve el total de chunks escritos."""
+        self.flush()
+        if self._occurrences:
+            raise ValueError(f"{len(self._occurrences)} apariciones apuntan a chunks que nunca se agregaron")
+        if self._ranges:
+            if self.commit:
+                with self.con:
+                    self._populate_fts()
+            else:
+                self._populate_fts()
+        return self.chunks_written
+
+def install_db(tmp_path: str, db_path: str) -> None:
+    """
+    Reemplaza db_path por la base temporal ya cerrada. Las conexiones abiertas a la base anterior siguen viendo
+    el inodo viejo (read_pool las descarta por el cambio de inodo).
+    """
+    with sqlite3.connect(tmp_path) as con:
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    if os.path.exists(db_path):
+        # el -wal/-shm de la base anterior no debe aplicarse sobre la nueva
+        try:
+            with sqlite3.connect(db_path) as con:
+                con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.DatabaseError as e:
+            logger.warning(f"[BULK] no se pudo hacer checkpoint de {db_path}: {e}")
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    if os.stat(tmp_path).st_dev != os.stat(os.path.dirname(db_path) or ".").st_dev:
+        # otro filesystem (p.ej. share montado): copiar al lado del destino y renombrar, que sí es atómico
+        partial = f"{db_path}.partial"
+        shutil.copyfile(tmp_path, partial)
+        tmp_path = partial
+    os.replace(tmp_path, db_path)
@@ -0,0 +1,288 @@
+from __future__ import annotations
+import os, re, json, sqlite3
+import datetime as dt
+from typing import Dict, List, Optional, Sequence
+from .sqlite_db import demand_scope, has_table
+from .text_norm import fold_accents
+
+# Ficha de la causa: resumen estructurado (partes, RUTs, montos, fechas y trámites) armado en la ingesta
+# desde el primer escrito y la tabla de loadDetalleCausa, sin LLM. rag_query lo antepone al contexto
+# y contesta directo las preguntas que se responden solo con ella.
+CASE_CARD_VERSION = "card1"
+RAG_CASE_CARD = os.getenv("RAG_CASE_CARD", "1") == "1"  # anteponer la ficha al contexto de rag_answer
+RAG_CASE_CARD_DIRECT = os.getenv("RAG_CASE_CARD_DIRECT", "1") == "1"  # responder sin LLM partes/monto/etapa/último trámite
+CARD_TRAMITES = 8  # trámites (los más recientes) que van al contexto
+CARD_MAX_ITEMS = 10  # tope de RUTs, montos y fechas guardados
+
+_RUT = re.compile(r"\b(\d{1,2})\.?(\d{3})\.?(\d{3})\s*-\s*([\dkK])\b")
+_MONTO = re.compile(r"(\$|UF)\s*(\d{1,3}(?:\.\d{3})+|\d+)(?:,(\d{1,2}))?")
+_FECHA_NUM = re.compile(r"\b(\d{1,2})[/-](\d{1,2})[/-](\d{4})\b")
+_FECHA_TXT = re.compile(r"\b(\d{1,2})\s+de\s+([a-záéíóú]+)\s+(?:de|del)\s+(\d{4})\b", re.IGNORECASE)
+_MESES = {m: i for i, m in enumerate(("enero", "febrero", "marzo", "abril", "mayo", "junio", "julio", "agosto",
+                                      "septiembre", "octubre", "noviembre", "diciembre"), 1)}
+_MESES["setiembre"] = 9
+# encabezado del escrito: "DEMANDANTE: BANCO ...", "RUT: 97.030.000-7", "CUANTÍA: $ 5.000.000"
+_LABEL = re.compile(
+    r"^[ \t]*(DEMANDANTES?|DEMANDAD[OA]S?|EJECUTANTES?|EJECUTAD[OA]S?|REPRESENTANTE(?:\s+LEGAL)?|"
+    r"ABOGAD[OA](?:\s+PATROCINANTE)?(?:\s+Y\s+APODERAD[OA])?|APODERAD[OA]|PROCEDIMIENTO|MATERIA|CUANT[IÍ]A|RUT)"
+    r"[ \t]*(?:N[º°]?[ \t]*)?[:：][ \t]*(.*)$",
+    re.MULTILINE | re.IGNORECASE,
+)
+_ROLES = (("DEMANDANTE", "demandante"), ("EJECUTANTE", "demandante"), ("DEMANDAD", "demandado"),
+          ("EJECUTAD", "demandado"), ("REPRESENTANTE", "representante"), ("ABOGAD", "abogado"), ("APODERAD", "abogado"))
+_SUMA = re.compile(r"(?:suma|cantidad|total)\s+(?:total\s+)?(?:de|ascendente\s+a)\s*$", re.IGNORECASE)
+
+def format_rut(m: re.Match) -> str:
+    return f"{int(m.group(1))}.{m.group(2)}.{m.group(3)}-{m.group(4).upper()}"
+
+def format_monto(monto: dict) -> str:
+    entero = f"{monto['valor']:,}".replace(",", ".")
+    return f"UF {entero}" if monto["moneda"] == "UF" else f"${entero}"
+
+def _parse_monto(m: re.Match) -> dict:
+    return {"moneda": "UF" if m.group(1) == "UF" else "CLP", "valor": int(m.group(2).replace(".", ""))}
+
+def parse_fechas(text: str) -> List[str]:
+    """Fechas ISO (dd/mm/aaaa, dd-mm-aaaa y "15 de marzo de 2023") en orden de aparición, sin repetir."""
+    found = []
+    for m in _FECHA_NUM.finditer(text or ""):
+        found.append((m.start(), int(m.group(3)), int(m.group(2)), int(m.group(1))))
+    for m in _FECHA_TXT.finditer(text or ""):
+        mes = _MESES.get(fold_accents(m.group(2).lower()))
+        if mes:
+            found.append((m.start(), int(m.group(3)), mes, int(m.group(1))))
+    out = []
+    for _, y, mo, d in sorted(found):
+        try:
+            iso = dt.date(y, mo, d).isoformat()
+        except ValueError:
+            continue
+        if iso not in out:
+            out.append(iso)
+    return out
+
+def _role(label: str) -> Optional[str]:
+    label = fold_accents(label.upper())
+    return next((role for prefix, role in _ROLES if label.startswith(prefix)), None)
+
+def _clean_name(value: str) -> str:
+    # "JUAN PÉREZ, RUT 12.345.678-9, domiciliado en ..." -> "JUAN PÉREZ"
+    value = re.split(r",|\bRUT\b|\bC\.?I\.?\b|\bdomiciliad", value, maxsplit=1, flags=re.IGNORECASE)[0]
+    return " ".join(value.split()).strip(" .;-")
+
+def parse_header(text: str) -> dict:
+    """Partes (con su RUT), procedimiento, materia y cuantía desde las líneas "ROL: valor" del escrito."""
+    partes, fields = [], {}
+    for m in _LABEL.finditer(text or ""):
+        label, value = m.group(1), m.group(2).strip()
+        key = fold_accents(label.upper())
+        rut = _RUT.search(value)
+        if key == "RUT":
+            # "RUT:" en su propia línea es el de la parte anterior
+            if rut and partes and not partes[-1].get("rut"):
+                partes[-1]["rut"] = format_rut(rut)
+            continue
+        if key in ("PROCEDIMIENTO", "MATERIA", "CUANTIA"):
+            if value and key.lower() not in fields:
+                fields[key.lower()] = " ".join(value.split())
+            continue
+        name = _clean_name(value)
+        if not name:
+            continue
+        if any(p["rol"] == _role(label) and p["nombre"] == name for p in partes):
+            continue  # el mismo encabezado repetido (solape entre chunks al rearmar el texto)
+        parte = {"rol": _role(label), "nombre": name}
+        if rut:
+            parte["rut"] = format_rut(rut)
+        partes.append(parte)
+    return {"partes": partes, **fields}
+
+def parse_ruts(text: str) -> List[dict]:
+    """RUTs del escrito con el nombre que los precede en la misma línea (si lo hay), sin repetir."""
+    out: Dict[str, dict] = {}
+    for m in _RUT.finditer(text or ""):
+        rut = format_rut(m)
+        if rut in out:
+            continue
+        line = text[text.rfind("\n", 0, m.start()) + 1:m.start()]
+        line = re.sub(r"(?i)\b(?:RUT|R\.U\.T\.?|C[ée]dula(?:\s+(?:nacional\s+)?de\s+identidad)?|C\.I\.?)\s*(?:N[º°]?)?\s*[:.]?\s*$", "", line)
+        name = " ".join(line.split()).strip(" ,:;-()")
+        out[rut] = {"rut": rut, "nombre": name[-80:] if name else None}
+        if len(out) >= CARD_MAX_ITEMS:
+            break
+    return list(out.values())
+
+def parse_montos(text: str) -> dict:
+    """Montos en orden de aparición y el demandado (el que sigue a "la suma/cantidad de")."""
+    montos, demandado = [], None
+    for m in _MONTO.finditer(text or ""):
+        monto = _parse_monto(m)
+        if monto not in montos and len(montos) < CARD_MAX_ITEMS:
+            montos.append(monto)
+        if demandado is None and _SUMA.search(text[max(0, m.start() - 40):m.start()]):
+            demandado = monto
+    return {"montos": montos, "monto_demandado": demandado}
+
+def _folio_key(row: dict):
+    folio = str(row.get("folio") or "").strip()
+    return (0, int(folio)) if folio.isdigit() else (1, 0)
+
+def parse_tramites(detalle: Sequence[dict]) -> List[dict]:
+    """Filas de loadDetalleCausa -> línea de tiempo por folio (la fecha es la primera que aparezca en la fila)."""
+    out = []
+    for row in sorted(detalle or [], key=_folio_key):
+        fechas = parse_fechas(" ".join(str(row.get(k) or "") for k in ("desctramite", "foja", "geo", "anexo")))
+        t = {"folio": str(row.get("folio") or "").strip(), "etapa": (row.get("etapa") or "").strip(),
+             "tramite": (row.get("tramite") or "").strip(), "descripcion": (row.get("desctramite") or "").strip(),
+             "fecha": fechas[0] if fechas else None}
+        if t["etapa"] or t["tramite"] or t["descripcion"]:
+            out.append(t)
+    return out
+
+def build_case_card(first_filing: str, detalle: Optional[Sequence[dict]] = None, title: Optional[str] = None,
+                    source: Optional[str] = None, tramites: Optional[List[dict]] = None) -> Optional[dict]:
+    """
+    Ficha a partir del texto del primer escrito y la tabla de trámites; None si no sale nada de ninguno.
+    tramites: línea de tiempo ya armada (la de la ficha anterior) para cuando esta vez no vino detalle.
+    """
+    text = first_filing or ""
+    header = parse_header(text[:20000])  # el encabezado está al comienzo; el resto solo aporta RUTs, montos y fechas
+    montos = parse_montos(text)
+    cuantia = _MONTO.search(header.get("cuantia") or "")
+    if cuantia:  # la cuantía declarada manda sobre "la suma de" del cuerpo
+        montos["monto_demandado"] = _parse_monto(cuantia)
+    partes = header["partes"]
+    ruts = parse_ruts(text)
+    for p in partes:  # parte sin "RUT:" propio: el que aparece junto a su nombre en el texto
+        if not p.get("rut"):
+            p["rut"] = next((r["rut"] for r in ruts if r["nombre"] and p["nombre"].lower() in r["nombre"].lower()), None)
+    por_rut = {p["rut"]: p["nombre"] for p in partes if p.get("rut")}
+    for r in ruts:
+        r["nombre"] = r["nombre"] or por_rut.get(r["rut"])
+    tramites = parse_tramites(detalle) if detalle else list(tramites or [])
+    if not (partes or ruts or montos["montos"] or tramites):
+        return None
+    dte = next((p["nombre"] for p in partes if p["rol"] == "demandante"), None)
+    ddo = next((p["nombre"] for p in partes if p["rol"] == "demandado"), None)
+    last = tramites[-1] if tramites else {}
+    return {
+        "version": CASE_CARD_VERSION,
+        "causa": title,
+        "caratula": f"{dte} con {ddo}" if dte and ddo else None,
+        "procedimiento": header.get("procedimiento"),
+        "materia": header.get("materia"),
+        "partes": partes,
+        "ruts": ruts,
+        "montos": montos["montos"],
+        "monto_demandado": montos["monto_demandado"],
+        "fechas": parse_fechas(text)[:CARD_MAX_ITEMS],
+        "tramites": tramites,
+        "etapa": last.get("etapa") or None,
+        "ultimo_tramite": last or None,
+        "source": os.path.basename(source) if source else None,
+    }
+
+def save_case_card(con: sqlite3.Connection, demand_id: int, card: dict) -> None:
+    """Guarda (reemplaza) la ficha de la demanda; sin commit."""
+    con.execute("INSERT OR REPLACE INTO case_card(demand_id, card_json, updated_at) VALUES(?, ?, ?)",
+                (int(demand_id), json.dumps(card, ensure_ascii=False), dt.datetime.now().isoformat()))
+
+def load_case_card(con: sqlite3.Connection) -> Optional[dict]:
+    """Ficha de la demanda de la conexión (en el corpus, la de su scope); None en bases anteriores a la ficha."""
+    if not has_table(con, "case_card"):
+        return None
+    scope = demand_scope(con)
+    if scope is not None:
+        row = con.execute("SELECT card_json FROM case_card WHERE demand_id=?", (scope,)).fetchone()
+    else:
+        row = con.execute("SELECT card_json FROM case_card LIMIT 1").fetchone()
+    return json.loads(row[0]) if row else None
+
+def _parte(p: dict) -> str:
+    return f"{p['nombre']} (RUT {p['rut']})" if p.get("rut") else p["nombre"]
+
+def _tramite(t: dict) -> str:
+    desc = f"{t['tramite']}: {t['descripcion']}" if t.get("tramite") and t.get("descripcion") else (t.get("tramite") or t.get("descripcion"))
+    extra = ", ".join(x for x in (f"folio {t['folio']}" if t.get("folio") else "", t.get("fecha") or "") if x)
+    return f"{desc} ({extra})" if extra else desc
+
+def render_case_card(card: dict, max_tramites: int = CARD_TRAMITES) -> str:
+    """Bloque compacto para el contexto del LLM."""
+    lines = ["[ficha de la causa]"]
+    if card.get("causa") or card.get("caratula"):
+        lines.append(" - ".join(x for x in (card.get("causa"), card.get("caratula")) if x))
+    proc = " | ".join(f"{k.capitalize()}: {card[k]}" for k in ("procedimiento", "materia") if card.get(k))
+    if proc:
+        lines.append(proc)
+    for p in card.get("partes") or []:
+        lines.append(f"{(p.get('rol') or 'parte').capitalize()}: {_parte(p)}")
+    nombrados = {p.get("rut") for p in card.get("partes") or []}
+    otros = [f"{r['rut']} {r['nombre'] or ''}".strip() for r in card.get("ruts") or [] if r["rut"] not in nombrados]
+    if otros:
+        lines.append("Otros RUT: " + "; ".join(otros))
+    if card.get("monto_demandado"):
+        lines.append(f"Monto demandado: {format_monto(card['monto_demandado'])}")
+    otros = [format_monto(m) for m in card.get("montos") or [] if m != card.get("monto_demandado")]
+    if otros:
+        lines.append("Otros montos: " + ", ".join(otros))
+    if card.get("fechas"):
+        lines.append("Fechas en el escrito: " + ", ".join(card["fechas"]))
+    if card.get("etapa"):
+        lines.append(f"Etapa: {card['etapa']}")
+    tramites = card.get("tramites") or []
+    if tramites:
+        shown = tramites[-max_tramites:]
+        lines.append(f"Trámites ({len(shown)} más recientes de {len(tramites)}):" if len(shown) < len(tramites) else "Trámites:")
+        lines.extend(f"- {_tramite(t)}" for t in shown)
+    return "\n".join(lines)
+
+# preguntas que la ficha responde sola (texto sin tildes, minúsculas, sin signos de pregunta): ancladas a la pregunta
+# entera, con una cola corta opcional ("... de la causa", "... actual"); cualquier otra precisión va al LLM
+_TAIL = r"(?: (?:de|en) (?:la|esta) (?:causa|demanda)| del (?:juicio|expediente))?(?: actual(?:mente)?| hoy)?$"
+
+def _intent(*alts: str) -> re.Pattern:
+    return re.compile(r"^(?:" + "|".join(alts) + ")" + _TAIL)
+
+_INTENTS = (
+    ("partes", _intent(r"(?:cuales son |quienes son )?(?:las )?partes",
+                       r"quien(?:es)? (?:es|son) (?:el |la |los |las )?(?:demandante|demandad[oa]|ejecutante|ejecutad[oa])s?",
+                       r"quien demanda", r"a quien se demanda",
+                       r"contra quien (?:se dirige la demanda|es la demanda|se demanda)")),
+    ("monto", _intent(r"(?:cual es |a cuanto asciende )?(?:el |la )?(?:monto|cuantia|suma)(?: demandad[oa]| cobrad[oa])?",
+                      r"cuanto (?:se )?(?:demanda|cobra|debe)", r"a cuanto asciende la demanda")),
+    ("etapa", _intent(r"(?:en )?(?:que|cual es la) etapa(?: (?:esta|va|se encuentra)(?: la causa| el juicio| la demanda)?)?",
+                      r"(?:cual es el |en que )?estado (?:procesal|de la causa)", r"en que (?:va|esta) la causa")),
+    ("ultimo_tramite", _intent(r"(?:cual (?:es|fue) )?(?:el )?ultimo tramite",
+                               r"(?:cual (?:es|fue) )?(?:la )?ultima (?:resolucion|actuacion|gestion)")),
+)
+
+def card_intent(question: str) -> Optional[str]:
+    q = fold_accents((question or "").lower())
+    q = " ".join(re.sub(r"[¿?¡!.,;:]", " ", q).split())
+    hits = [name for name, rx in _INTENTS if rx.match(q)]
+    if len(hits) != 1:
+        return None
+    # "¿cuánto se demanda y por qué?", "¿quién es el demandado y cuál es su domicilio?": la ficha respondería
+    # solo una parte (también con partes: aunque pregunte por demandante y demandado, va al LLM con la ficha)
+    if re.search(r"\b(?:y|e|ademas|tambien|por que)\b", q):
+        return None
+    return hits[0]
+
+def answer_from_card(card: Optional[dict], question: str) -> Optional[str]:
+    """Respuesta directa si la pregunta es solo de partes, monto, etapa o último trámite y la ficha lo tiene."""
+    if not card:
+        return None
+    intent = card_intent(question)
+    if intent == "partes":
+        partes = [p for p in card.get("partes") or [] if p.get("rol") in ("demandante", "demandado")]
+        if not partes:
+            return None
+        return "; ".join(f"{p['rol'].capitalize()}: {_parte(p)}" for p in partes) + "."
+    if intent == "monto" and card.get("monto_demandado"):
+        return f"Monto demandado: {format_monto(card['monto_demandado'])}."
+    if intent == "etapa" and card.get("etapa"):
+        last = card.get("ultimo_tramite")
+        return f"Etapa: {card['etapa']}" + (f"; último trámite: {_tramite(last)}." if last else ".")
+    if intent == "ultimo_tramite" and card.get("ultimo_tramite"):
+        return f"Último trámite: {_tramite(card['ultimo_tramite'])}."
+    return None
@@ -0,0 +1,150 @@
+from __future__ import annotations
+import os, sqlite3, threading, time, logging
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+logger = logging.getLogger('civil')
+
+# Pool de conexiones de solo lectura por demand_<id>.db para el camino de consulta (rag_query/rag_search)
+RAG_SQLITE_MMAP_MB = int(os.getenv("RAG_SQLITE_MMAP_MB", "256"))
+RAG_SQLITE_CACHE_MB = int(os.getenv("RAG_SQLITE_CACHE_MB", "32"))
+RAG_SQLITE_POOL_IDLE_TTL = float(os.getenv("RAG_SQLITE_POOL_IDLE_TTL", "300"))  # segundos
+RAG_SQLITE_POOL_MAX_IDLE = int(os.getenv("RAG_SQLITE_POOL_MAX_IDLE", "4"))  # conexiones ociosas por base
+
+def _file_id(db_path: str) -> Tuple[int, int]:
+    # si la base se reemplaza (re-ingesta), cambia el inodo y las conexiones viejas se descartan
+    st = os.stat(db_path)
+    return (st.st_dev, st.st_ino)
+
+def open_readonly(db_path: str) -> sqlite3.Connection:
+    from .sqlite_db import DemandConnection
+    uri = f"file:{quote(os.path.abspath(db_path))}?mode=ro"
+    try:
+        con = sqlite3.connect(uri, uri=True, check_same_thread=False, factory=DemandConnection)
+        con.execute("SELECT 1 FROM sqlite_master LIMIT 1")
+    except sqlite3.OperationalError as e:
+        # WAL sin -shm escribible (p.ej. share montado): se abre normal y query_only protege igual
+        logger.debug("[SQLITE] mode=ro no disponible para %s (%s); abro con query_only", db_path, e)
+        con = sqlite3.connect(db_path, check_same_thread=False, factory=DemandConnection)
+    con.execute("PRAGMA query_only=ON")
+    con.execute(f"PRAGMA mmap_size={RAG_SQLITE_MMAP_MB * 1024 * 1024}")
+    con.execute(f"PRAGMA cache_size={-RAG_SQLITE_CACHE_MB * 1024}")  # negativo = KiB
+    return con
+
+class ReadPool:
+    """
+    Conexiones de solo lectura reutilizables. Cada conexión la usa un solo hilo a la vez
+    (se presta con connection() y se devuelve al salir), por eso puede cruzar a los hilos
+    de anyio.to_thread que usa call_tool_async.
+    """
+
+    def __init__(self, idle_ttl: float = RAG_SQLITE_POOL_IDLE_TTL, max_idle: int = RAG_SQLITE_POOL_MAX_IDLE):
+        self.idle_ttl = idle_ttl
+        self.max_idle = max_idle
+        self._idle: Dict[str, List[Tuple[sqlite3.Connection, Tuple[int, int], float]]] = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+        self.opened = self.reused = self.closed = 0
+
+    @contextmanager
+    def connection(self, db_path: str, demand_id: Optional[int] = None) -> Iterator[sqlite3.Connection]:
+        """demand_id acota la conexión a una demanda cuando db_path es el corpus consolidado."""
+        db_path = os.path.abspath(db_path)
+        con, fid = self._checkout(db_path)
+        con.demand_id = demand_id
+        try:
+            yield con
+        except BaseException:
+            self._close(con)
+            raise
+        else:
+            self._checkin(db_path, con, fid)
+
+    def _checkout(self, db_path: str) -> Tuple[sqlite3.Connection, Tuple[int, int]]:
+        fid = _file_id(db_path)
+        stale = []
+        con = None
+        with self._lock:
+            self._reap_locked(stale, self.idle_ttl)
+            idle = self._idle.get(db_path, [])
+            while idle:
+                c, c_fid, _ = idle.pop()
+                if c_fid == fid:
+                    con = c
+                    self.reused += 1
+                    break
+                stale.append(c)
+        for c in stale:
+            self._close(c)
+        if con is None:
+            con = open_readonly(db_path)
+            with self._lock:
+                self.opened += 1
+        return con, fid
+
+    def _checkin(self, db_path: str, con: sqlite3.Connection, fid: Tuple[int, int]) -> None:
+        if con.in_transaction:
+            con.rollback()
+        with self._lock:
+            idle = self._idle.setdefault(db_path, [])
+            if len(idle) < self.max_idle:
+                idle.append((con, fid, time.monotonic()))
+                self._start_reaper_locked()
+                return
+        self._close(con)
+
+    def _start_reaper_locked(self) -> None:
+        # hilo daemon que cierra lo ocioso aunque no lleguen más consultas
+        if self._reaper is not None and self._reaper.is_alive():
+            return
+
+        def run():
+            while True:
+                time.sleep(max(1.0, self.idle_ttl / 2))
+                self.close_idle(self.idle_ttl)
+                with self._lock:
+                    if not self._idle:
+                        self._reaper = None
+                        return
+
+        self._reaper = threading.Thread(target=run, name="sqlite-read-pool-reaper", daemon=True)
+        self._reaper.start()
+
+    def _reap_locked(self, out: list, max_age: float) -> None:
+        cutoff = time.monotonic() - max_age
+        for path in list(self._idle):
+            keep = [e for e in self._idle[path] if e[2] >= cutoff]
+            out.extend(e[0] for e in self._idle[path] if e[2] < cutoff)
+            if keep:
+                self._idle[path] = keep
+            else:
+                del self._idle[path]
+
+    def close_idle(self, max_age: float = 0.0) -> int:
+        """Cierra las conexiones ociosas con más de max_age segundos (0 = todas)."""
+        stale: list = []
+        with self._lock:
+            self._reap_locked(stale, max_age)
+        for c in stale:
+            self._close(c)
+        return len(stale)
+
+    def _close(self, con: sqlite3.Connection) -> None:
+        try:
+            con.close()
+        except Exception:
+            pass
+        with self._lock:
+            self.closed += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "idle": sum(len(v) for v in self._idle.values()),
+                "opened": self.opened,
+                "reused": self.reused,
+                "closed": self.closed,
+            }
+
+read_pool = ReadPool()
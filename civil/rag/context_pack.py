@@ -0,0 +1,141 @@
+from __future__ import annotations
+import os, sqlite3
+from dataclasses import dataclass
+from typing import Collection, Dict, List, Optional, Sequence, Tuple
+from .sqlite_db import span_select
+from .embed_batcher import estimate_tokens
+from .snippets import best_snippet, RAG_SNIPPET_CHARS
+
+# Armado del contexto para el LLM: un bloque por tramo de chunks vecinos, sin repetidos ni solapes,
+# hasta el presupuesto de tokens y en orden de score
+RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "2500"))  # contexto inicial de rag_answer (+ seed)
+RAG_MORE_CONTEXT_TOKENS = int(os.getenv("RAG_MORE_CONTEXT_TOKENS", "1500"))  # por ronda NEED_MORE_CONTEXT
+MIN_BLOCK_TOKENS = 60  # un bloque recortado a menos que esto no aporta: se prueba con el siguiente
+BLOCK_SEP = "\n\n---\n\n"
+
+@dataclass
+class ContextBlock:
+    chunk_ids: List[int]
+    text: str
+    score: float
+    path: Optional[str] = None
+    page: Optional[int] = None
+    page_end: Optional[int] = None
+
+    def header(self) -> str:
+        return f"[chunk:{','.join(str(c) for c in self.chunk_ids)} score={self.score:.3f}{cite(self.path, self.page, self.page_end)}]"
+
+    def render(self) -> str:
+        return f"{self.header()}\n{self.text}"
+
+@dataclass
+class _Pos:
+    cid: int
+    content: str
+    score: float
+    document_id: Optional[int] = None
+    seq: Optional[int] = None
+    char_start: Optional[int] = None
+    char_end: Optional[int] = None
+    path: Optional[str] = None
+    page: Optional[int] = None
+    page_end: Optional[int] = None
+
+def cite(path: Optional[str], page: Optional[int], page_end: Optional[int]) -> str:
+    # " doc=3_1.pdf p.2" (o p.2-3) para que la respuesta pueda citar folio y página
+    if not path and not page:
+        return ""
+    out = f" doc={os.path.basename(path or '')}"
+    if page:
+        out += f" p.{page}" if not page_end or page_end == page else f" p.{page}-{page_end}"
+    return out
+
+def _positions(con: sqlite3.Connection, hits: Dict[int, Tuple[str, float]]) -> List[_Pos]:
+    ids = list(hits)
+    rows = {}
+    for start in range(0, len(ids), 500):
+        part = ids[start:start + 500]
+        sql = (f"SELECT c.id, c.document_id, c.seq, {span_select(con)}, d.path FROM chunks c "
+               f"LEFT JOIN documents d ON d.id = c.document_id WHERE c.id IN ({','.join('?' for _ in part)})")
+        for cid, doc_id, seq, page, page_end, cs, ce, path in con.execute(sql, part):
+            rows[cid] = (doc_id, seq, cs, ce, path, page, page_end)
+    return [_Pos(cid, content, score, *rows.get(cid, (None,) * 7)) for cid, (content, score) in hits.items()]
+
+def _overlap(prev: _Pos, nxt: _Pos) -> int:
+    """Caracteres del comienzo de nxt que ya están al final de prev."""
+    if prev.char_end is not None and nxt.char_start is not None:
+        return max(0, min(prev.char_end - nxt.char_start, len(nxt.content)))
+    # bases sin offsets: el sufijo de prev más largo que es prefijo de nxt (el solape del chunker viejo)
+    a, b = prev.content, nxt.content
+    for n in range(min(len(a), len(b), 400), 20, -1):
+        if a.endswith(b[:n]):
+            return n
+    return 0
+
+def _merge(run: List[_Pos]) -> ContextBlock:
+    text = run[0].content
+    for prev, nxt in zip(run, run[1:]):
+        n = _overlap(prev, nxt)
+        contiguous = n > 0 or (prev.char_end is not None and nxt.char_start == prev.char_end)
+        text += ("" if contiguous else "\n") + nxt.content[n:]
+    pages = [p.page for p in run if p.page]
+    ends = [p.page_end or p.page for p in run if p.page]
+    return ContextBlock([p.cid for p in run], text.strip(), max(p.score for p in run), run[0].path,
+                        min(pages) if pages else None, max(ends) if ends else None)
+
+def merge_neighbours(positions: List[_Pos]) -> List[ContextBlock]:
+    """Agrupa chunks del mismo documento con seq consecutivos en un solo bloque (score = el mejor del tramo)."""
+    by_doc: Dict[Optional[int], List[_Pos]] = {}
+    for p in positions:
+        by_doc.setdefault(p.document_id, []).append(p)
+    blocks = []
+    for doc_id, items in by_doc.items():
+        if doc_id is None or any(p.seq is None for p in items):
+            blocks.extend(_merge([p]) for p in items)
+            continue
+        items.sort(key=lambda p: p.seq)
+        run = [items[0]]
+        for p in items[1:]:
+            if p.seq == run[-1].seq + 1:
+                run.append(p)
+            else:
+                blocks.append(_merge(run))
+                run = [p]
+        blocks.append(_merge(run))
+    return blocks
+
+def pack_context(con: sqlite3.Connection, hits: Sequence[tuple], query: str, max_tokens: int = RAG_CONTEXT_TOKENS,
+                 snippet_chars: int = RAG_SNIPPET_CHARS, exclude: Collection[int] = ()) -> List[ContextBlock]:
+    """
+    hits: filas (chunk_id, content, score) de una o varias búsquedas. Deduplica por chunk_id (queda el mejor score),
+    omite los de exclude (ya enviados en rondas anteriores), une vecinos (mismo documento, seq consecutivos)
+    quitando el texto solapado, recorta cada bloque a su mejor ventana (snippet_chars por chunk del bloque)
+    y llena max_tokens en orden de score.
+    """
+    best: Dict[int, Tuple[str, float]] = {}
+    for row in hits:
+        cid, content = int(row[0]), row[1] or ""
+        score = float(row[2]) if len(row) > 2 and row[2] is not None else -1.0
+        if cid in exclude:
+            continue
+        if cid not in best or score > best[cid][1]:
+            best[cid] = (content, score)
+    if not best:
+        return []
+    blocks = sorted(merge_neighbours(_positions(con, best)), key=lambda b: -b.score)
+    out, left = [], max_tokens
+    for b in blocks:
+        header = estimate_tokens(b.header()) + 2
+        budget_chars = min(snippet_chars * len(b.chunk_ids), (left - header - 1) * 3)  # -1: los … del recorte
+        if budget_chars < MIN_BLOCK_TOKENS * 3:
+            continue
+        b.text = best_snippet(b.text, query, budget_chars)
+        cost = header + estimate_tokens(b.text)
+        if cost > left:
+            continue
+        out.append(b)
+        left -= cost
+    return out
+
+def render_context(blocks: List[ContextBlock], sep: str = BLOCK_SEP) -> str:
+    return sep.join(b.render() for b in blocks)
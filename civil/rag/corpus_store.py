@@ -0,0 +1,110 @@
+from __future__ import annotations
+import os, sqlite3, json, logging
+from contextlib import closing
+from typing import Optional
+from .sqlite_db import (ensure_schema, connect, vector_codec, get_meta, fts_demand_token, fts_column, span_select,
+                        has_table, embedder_for, DemandConnection, RAG_CORPUS_FILE)
+from .bulk_writer import BulkWriter
+from .matrix_cache import matrix_cache
+from .ann import ann_path, build_ann_index, evict_ivf
+
+logger = logging.getLogger('civil')
+
+# Operaciones por demanda sobre el corpus consolidado (RAG_STORE=corpus).
+# Lectura/escritura usan la misma interfaz que las bases por demanda: connect(corpus, demand_id) + insert_*/hybrid_search.
+
+def corpus_path(root: Optional[str] = None) -> str:
+    return os.path.join(root or os.getenv("SQLITE_LOCAL_PATH") or ".", RAG_CORPUS_FILE)
+
+def snapshot_corpus(db_path: str, out_path: str) -> str:
+    """
+    Copia consistente del corpus (API de backup) en un solo archivo sin -wal, para publicarla donde leen otros hosts:
+    el corpus se escribe en disco local (WAL + BEGIN IMMEDIATE no funcionan sobre SMB) y no se comparte tal cual.
+    """
+    with closing(sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)) as src, closing(sqlite3.connect(out_path)) as dst:
+        src.backup(dst)
+        dst.execute("PRAGMA journal_mode=DELETE")
+    return out_path
+
+def open_demand(db_path: str, demand_id: int) -> DemandConnection:
+    ensure_schema(db_path)
+    return connect(db_path, demand_id)
+
+def delete_demand(con: sqlite3.Connection, demand_id: int) -> int:
+    """Borra documentos, chunks, vectores y FTS de la demanda (sin commit). Devuelve los chunks eliminados."""
+    con.execute("DELETE FROM chunks_fts WHERE rowid IN (SELECT id FROM chunks WHERE demand_id=?)", (demand_id,))
+    con.execute("DELETE FROM embeddings WHERE demand_id=?", (demand_id,))
+    con.execute("DELETE FROM chunk_occurrences WHERE demand_id=?", (demand_id,))
+    n = con.execute("DELETE FROM chunks WHERE demand_id=?", (demand_id,)).rowcount
+    con.execute("DELETE FROM documents WHERE demand_id=?", (demand_id,))
+    if has_table(con, "case_card"):
+        con.execute("DELETE FROM case_card WHERE demand_id=?", (demand_id,))
+    return n
+
+def drop_demand(db_path: str, demand_id: int) -> int:
+    with closing(connect(db_path, demand_id)) as con, con:
+        n = delete_demand(con, demand_id)
+        con.execute("DELETE FROM demands WHERE demand_id=?", (demand_id,))
+    if os.path.exists(ann_path(db_path, demand_id)):
+        os.remove(ann_path(db_path, demand_id))
+    matrix_cache.invalidate(db_path, demand_id)
+    evict_ivf(db_path, demand_id)
+    logger.info(f"[CORPUS] demanda {demand_id} eliminada de {db_path}: {n} chunks")
+    return n
+
+def rebuild_demand(db_path: str, demand_id: int) -> Optional[str]:
+    """Regenera la partición FTS y el índice IVF de la demanda a partir de chunks/embeddings."""
+    with closing(connect(db_path, demand_id)) as con, con:
+        con.execute("DELETE FROM chunks_fts WHERE rowid IN (SELECT id FROM chunks WHERE demand_id=?)", (demand_id,))
+        col = fts_column(con)
+        con.execute(
+            f"INSERT INTO chunks_fts(rowid, {col}, demand) SELECT id, {col}, ? FROM chunks WHERE demand_id=?",
+            (fts_demand_token(demand_id), demand_id),
+        )
+    matrix_cache.invalidate(db_path, demand_id)
+    evict_ivf(db_path, demand_id)
+    return build_ann_index(db_path, demand_id=demand_id)
+
+def import_demand_db(db_path: str, demand_id: int, src_path: str) -> int:
+    """Copia un demand_<id>.db al corpus (reemplaza lo que hubiera de esa demanda). Devuelve los chunks importados."""
+    src = sqlite3.connect(f"file:{src_path}?mode=ro", uri=True)
+    try:
+        src_codec = vector_codec(src)
+        with closing(open_demand(db_path, demand_id)) as con, con:
+            dst_codec = vector_codec(con)
+            # content_norm de la base origen se reutiliza si viene de la misma versión de text_norm
+            src_norm = get_meta(src).get("fts_norm")
+            reuse_norm = src_norm is not None and src_norm == get_meta(con).get("fts_norm")
+            delete_demand(con, demand_id)
+            spans = span_select(src)
+            # todo en la transacción del with: reemplazo atómico; el corpus no acepta vectores de otro embedder
+            writer = BulkWriter(con, dst_codec, commit=False, embedder=embedder_for(src))
+            doc_refs = {}
+            for old_id, path, meta_json in src.execute("SELECT id, path, meta_json FROM documents ORDER BY id"):
+                doc_refs[old_id] = writer.add_document(path, json.loads(meta_json or "{}"))
+            rows = src.execute(
+                f"SELECT c.id, c.document_id, c.content, c.seq, {'c.content_norm' if reuse_norm else 'NULL'}, e.vector, {spans} "
+                "FROM chunks c "
+                "LEFT JOIN embeddings e ON e.chunk_id = c.id ORDER BY c.id"
+            )
+            chunk_refs = {}
+            for old_chunk, document_id, content, seq, content_norm, blob, *span in rows:
+                if blob is not None and src_codec != dst_codec:
+                    blob = src_codec.decode(blob)
+                chunk_refs[old_chunk] = writer.add_chunk(doc_refs[document_id], content, seq, blob, content_norm, span)
+            if has_table(src, "chunk_occurrences"):
+                for chunk_id, document_id, seq, *span in src.execute(
+                        f"SELECT chunk_id, document_id, seq, {span_select(src, 'o')} FROM chunk_occurrences o ORDER BY id"):
+                    writer.add_occurrence(chunk_refs[chunk_id], doc_refs[document_id], seq, span)
+            total = writer.finish()
+            if has_table(src, "case_card"):
+                for card_json, updated_at in src.execute("SELECT card_json, updated_at FROM case_card LIMIT 1"):
+                    con.execute("INSERT INTO case_card(demand_id, card_json, updated_at) VALUES(?, ?, ?)",
+                                (demand_id, card_json, updated_at))
+    finally:
+        src.close()
+    matrix_cache.invalidate(db_path, demand_id)
+    evict_ivf(db_path, demand_id)
+    build_ann_index(db_path, demand_id=demand_id)
+    logger.info(f"[CORPUS] {src_path} importado como demanda {demand_id}: {total} chunks")
+    return total
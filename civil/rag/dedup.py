@@ -0,0 +1,126 @@
+from __future__ import annotations
+import os, zlib
+import numpy as np
+from collections import defaultdict
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Union
+from .text_norm import fts_tokens
+from .embed_batcher import embed_batches, EMBED_MAX_INPUTS
+
+# Supresión de casi-duplicados en la ingesta (encabezados, notificaciones y texto tipo repetidos entre folios):
+# MinHash sobre shingles de palabras normalizadas + LSH por bandas; se guarda un chunk canónico por grupo.
+RAG_DEDUP = os.getenv("RAG_DEDUP", "1") == "1"
+RAG_DEDUP_THRESHOLD = float(os.getenv("RAG_DEDUP_THRESHOLD", "0.85"))  # Jaccard estimado mínimo para fusionar
+RAG_DEDUP_PERMS = int(os.getenv("RAG_DEDUP_PERMS", "64"))
+RAG_DEDUP_BANDS = int(os.getenv("RAG_DEDUP_BANDS", "16"))  # 16x4: candidatos desde ~0.5, luego se verifica la firma
+SHINGLE_WORDS = 3
+
+_PRIME = np.uint64((1 << 61) - 1)
+_MASK32 = np.uint64(0xFFFFFFFF)
+
+def shingles(text: str, k: int = SHINGLE_WORDS) -> np.ndarray:
+    # palabras normalizadas (sin tildes ni mayúsculas, números canónicos) para que diferencias del OCR/extractor no cuenten
+    toks = fts_tokens(text, stopwords=False)
+    if len(toks) < k:
+        grams = [" ".join(toks)] if toks else []
+    else:
+        grams = [" ".join(toks[i:i + k]) for i in range(len(toks) - k + 1)]
+    return np.unique(np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams)))
+
+class MinHasher:
+    def __init__(self, num_perm: int = RAG_DEDUP_PERMS, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        # a*x+b mod p con x < 2^32 y a, b < 2^29: el producto cabe en uint64 sin desbordar
+        self.a = rng.integers(1, 1 << 29, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 29, size=num_perm, dtype=np.uint64)
+        self.num_perm = num_perm
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """(num_perm,) uint32, o None si el texto no tiene palabras."""
+        sh = shingles(text)
+        if not len(sh):
+            return None
+        hv = (self.a[:, None] * sh[None, :] + self.b[:, None]) % _PRIME
+        return (hv.min(axis=1) & _MASK32).astype(np.uint32)
+
+class NearDupIndex:
+    """
+    Agrupamiento por líder: cada texto se compara (vía buckets LSH) con los canónicos ya vistos;
+    si alguno supera el umbral es un duplicado suyo, si no pasa a ser canónico. Sin encadenamiento A~B~C.
+    """
+
+    def __init__(self, threshold: float = RAG_DEDUP_THRESHOLD, num_perm: int = RAG_DEDUP_PERMS,
+                 bands: int = RAG_DEDUP_BANDS):
+        if num_perm % bands:
+            raise ValueError(f"num_perm={num_perm} no es múltiplo de bands={bands}")
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm)
+        self.bands, self.rows = bands, num_perm // bands
+        self._buckets: List[Dict[bytes, List[int]]] = [defaultdict(list) for _ in range(bands)]
+        self._sigs: Dict[int, np.ndarray] = {}
+
+    def _keys(self, sig: np.ndarray) -> List[bytes]:
+        return [sig[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def add(self, key: int, text: str) -> Optional[int]:
+        """Devuelve la clave del canónico del que text es casi-duplicado, o None si queda como canónico."""
+        sig = self.hasher.signature(text)
+        if sig is None:
+            return None
+        keys = self._keys(sig)
+        best, best_sim = None, self.threshold
+        seen = set()
+        for band, k in zip(self._buckets, keys):
+            for cand in band.get(k, ()):
+                if cand in seen:
+                    continue
+                seen.add(cand)
+                sim = float(np.mean(self._sigs[cand] == sig))
+                if sim >= best_sim:
+                    best, best_sim = cand, sim
+        if best is not None:
+            return best
+        self._sigs[key] = sig
+        for band, k in zip(self._buckets, keys):
+            band[k].append(key)
+        return None
+
+def canonical_map(texts: List[str], threshold: float = RAG_DEDUP_THRESHOLD) -> List[int]:
+    """Para cada texto, el índice de su canónico (el mismo índice si es canónico). Gana el primero en aparecer."""
+    index = NearDupIndex(threshold)
+    out = []
+    for i, t in enumerate(texts):
+        dup_of = index.add(i, t)
+        out.append(i if dup_of is None else dup_of)
+    return out
+
+class ChunkItem(NamedTuple):
+    doc_ref: int
+    seq: int
+    text: str
+    span: Optional[Sequence[Optional[int]]] = None
+    vector: Union[np.ndarray, bytes, None] = None  # ya calculado (p.ej. copiado de la ingesta anterior)
+    content_norm: Optional[str] = None
+
+def write_deduplicated(writer, items: List[ChunkItem], embed_fn: Callable, max_items: int = EMBED_MAX_INPUTS,
+                       dedup: bool = RAG_DEDUP, threshold: float = RAG_DEDUP_THRESHOLD) -> dict:
+    """
+    Escribe items en el BulkWriter: un chunk por grupo de casi-duplicados (el primero; conviene poner antes los que
+    ya traen vector) y una fila en chunk_occurrences por cada copia. Solo se embeben los canónicos sin vector.
+    """
+    canon = canonical_map([it.text for it in items], threshold) if dedup else list(range(len(items)))
+    refs: Dict[int, int] = {}
+    for i, it in enumerate(items):
+        if canon[i] == i and it.vector is not None:
+            refs[i] = writer.add_chunk(it.doc_ref, it.text, it.seq, it.vector, it.content_norm, it.span)
+    todo = [i for i, it in enumerate(items) if canon[i] == i and it.vector is None]
+    # embeddings: lotes por tokens en paralelo; los resultados llegan en orden y el writer los vuelca por lotes
+    for start, vecs in embed_batches([items[i].text for i in todo], embed_fn, max_items=max_items):
+        for i, vec in zip(todo[start:start + len(vecs)], vecs):
+            it = items[i]
+            refs[i] = writer.add_chunk(it.doc_ref, it.text, it.seq, vec, it.content_norm, it.span)
+    dups = 0
+    for i, c in enumerate(canon):
+        if c != i:
+            writer.add_occurrence(refs[c], items[i].doc_ref, items[i].seq, items[i].span)
+            dups += 1
+    return {"chunks": len(items), "canonical": len(items) - dups, "duplicates": dups, "embedded": len(todo)}
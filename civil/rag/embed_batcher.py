@@ -0,0 +1,131 @@
+from __future__ import annotations
+import os, time, random, threading, logging
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, Tuple
+from .utils_embed import embed_texts
+
+logger = logging.getLogger('civil')
+
+# Etapa de embeddings de la ingesta: lotes por tokens, varios lotes en vuelo, backoff ante 429
+RAG_EMBED_CONCURRENCY = int(os.getenv("RAG_EMBED_CONCURRENCY", "4"))
+RAG_EMBED_BATCH_TOKENS = int(os.getenv("RAG_EMBED_BATCH_TOKENS", "100000"))  # la API acepta hasta 300k por request
+RAG_EMBED_MAX_RETRIES = int(os.getenv("RAG_EMBED_MAX_RETRIES", "6"))
+EMBED_MAX_INPUT_TOKENS = 8191
+EMBED_MAX_INPUTS = 2048
+
+def estimate_tokens(text: str) -> int:
+    # cota conservadora para español (~3.5-4 chars/token en cl100k); evita depender de tiktoken
+    return len(text) // 3 + 1
+
+def token_batches(texts: List[str], max_tokens: int = RAG_EMBED_BATCH_TOKENS,
+                  max_items: int = EMBED_MAX_INPUTS) -> List[Tuple[int, int]]:
+    """Rangos [start, end) consecutivos cuyo total estimado de tokens no supera max_tokens."""
+    out = []
+    start, acc = 0, 0
+    for i, t in enumerate(texts):
+        n = min(estimate_tokens(t), EMBED_MAX_INPUT_TOKENS)
+        if i > start and (acc + n > max_tokens or i - start >= max_items):
+            out.append((start, i))
+            start, acc = i, 0
+        acc += n
+    if start < len(texts):
+        out.append((start, len(texts)))
+    return out
+
+def _is_rate_limit(e: Exception) -> bool:
+    return getattr(e, "status_code", None) == 429 or type(e).__name__ == "RateLimitError"
+
+def _retry_after(e: Exception) -> Optional[float]:
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+class AdaptiveLimiter:
+    """
+    Semáforo con límite ajustable: cada 429 lo reduce a la mitad y aplica una pausa global;
+    tras varias respuestas OK vuelve a subir de a uno hasta max_concurrency.
+    """
+
+    def __init__(self, max_concurrency: int, recover_after: int = 8):
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = self.max_concurrency
+        self.recover_after = recover_after
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.rate_limited = 0
+        self._ok_streak = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0 and self.in_flight < self.limit:
+                    break
+                self._cond.wait(timeout=wait if wait > 0 else None)
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def success(self) -> None:
+        with self._cond:
+            self._ok_streak += 1
+            if self.limit < self.max_concurrency and self._ok_streak >= self.recover_after:
+                self.limit += 1
+                self._ok_streak = 0
+                self._cond.notify_all()
+
+    def throttle(self, delay: float) -> None:
+        with self._cond:
+            self.rate_limited += 1
+            self._ok_streak = 0
+            self.limit = max(1, self.limit // 2)
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+def _embed_with_backoff(embed_fn, texts: List[str], limiter: AdaptiveLimiter,
+                        max_retries: int = RAG_EMBED_MAX_RETRIES) -> np.ndarray:
+    for attempt in range(max_retries + 1):
+        with limiter:
+            try:
+                vecs = embed_fn(texts)
+            except Exception as e:
+                if not _is_rate_limit(e) or attempt == max_retries:
+                    raise
+                delay = _retry_after(e) or min(60.0, 2 ** attempt) * (0.5 + random.random())
+                logger.warning(f"[EMB] 429 de la API (intento {attempt + 1}); concurrencia -> {max(1, limiter.limit // 2)}, pausa {delay:.1f}s")
+                limiter.throttle(delay)
+                continue
+        limiter.success()
+        return vecs
+
+def embed_batches(texts: List[str], embed_fn: Optional[Callable[[List[str]], np.ndarray]] = None,
+                  concurrency: int = RAG_EMBED_CONCURRENCY, max_tokens: int = RAG_EMBED_BATCH_TOKENS,
+                  max_items: int = EMBED_MAX_INPUTS) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Embebe texts con hasta `concurrency` lotes en vuelo y entrega (start, vecs) EN ORDEN,
+    de modo que el escritor SQLite (un solo hilo) inserta en la misma secuencia que antes.
+    A lo más 2*concurrency lotes terminados esperan en memoria.
+    """
+    embed_fn = embed_fn or embed_texts
+    ranges = token_batches(texts, max_tokens, max_items)
+    limiter = AdaptiveLimiter(concurrency)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="embed") as pool:
+        for start, end in ranges:
+            pending.append((start, pool.submit(_embed_with_backoff, embed_fn, texts[start:end], limiter)))
+            while len(pending) >= 2 * max(1, concurrency):
+                s, fut = pending.popleft()
+                yield s, fut.result()
+        while pending:
+            s, fut = pending.popleft()
+            yield s, fut.result()
+    if limiter.rate_limited:
+        logger.info(f"[EMB] {limiter.rate_limited} respuestas 429 durante la ingesta")
@@ -0,0 +1,146 @@
+from __future__ import annotations
+import os, sqlite3, hashlib, threading, time, logging
+import numpy as np
+from typing import Callable, Dict, List, Optional
+from .utils_embed import embed_texts, get_embedder
+
+logger = logging.getLogger('civil')
+
+# Cache persistente de embeddings por (modelo, sha256 del texto normalizado), compartido entre demandas
+RAG_EMBED_CACHE_PATH = os.getenv("RAG_EMBED_CACHE_PATH") or os.path.join(os.getenv("SQLITE_LOCAL_PATH") or ".", "embed_cache.db")
+RAG_EMBED_CACHE_MB = int(os.getenv("RAG_EMBED_CACHE_MB", "2048"))
+
+CACHE_SCHEMA_SQL = """
+PRAGMA journal_mode=WAL;
+CREATE TABLE IF NOT EXISTS embed_cache(
+  id INTEGER PRIMARY KEY,
+  model TEXT NOT NULL,
+  text_hash TEXT NOT NULL,
+  vector BLOB NOT NULL,       -- float32 tal como lo entrega el modelo (el codec de la demanda se aplica al insertar)
+  last_used REAL NOT NULL,
+  UNIQUE(model, text_hash)
+);
+CREATE INDEX IF NOT EXISTS idx_embed_cache_last_used ON embed_cache(last_used);
+"""
+
+def normalize_text(text: str) -> str:
+    # los chunks difieren a menudo solo en espacios/saltos de línea del extractor de PDF
+    return " ".join(text.split())
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """
+    Se pone delante de embed_texts: solo los textos no vistos van a la API.
+    Eviction LRU (last_used) cuando el archivo supera max_bytes.
+    hits/misses son de esta instancia, así cada ingesta informa su propio hit ratio.
+    """
+
+    def __init__(self, path: str = RAG_EMBED_CACHE_PATH, max_bytes: int = RAG_EMBED_CACHE_MB * 1024 * 1024,
+                 model: Optional[str] = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.model = model or get_embedder().model  # el del backend activo (RAG_EMBEDDER)
+        self.hits = self.misses = self.evicted = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._con = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._con.executescript(CACHE_SCHEMA_SQL)
+
+    def close(self) -> None:
+        self._con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_many(self, hashes: List[str]) -> Dict[str, np.ndarray]:
+        out: Dict[str, np.ndarray] = {}
+        uniq = list(dict.fromkeys(hashes))
+        with self._lock:
+            for s in range(0, len(uniq), 500):
+                part = uniq[s:s + 500]
+                marks = ",".join("?" * len(part))
+                rows = self._con.execute(
+                    f"SELECT text_hash, vector FROM embed_cache WHERE model=? AND text_hash IN ({marks})",
+                    [self.model, *part],
+                ).fetchall()
+                out.update((h, np.frombuffer(blob, dtype=np.float32)) for h, blob in rows)
+            if out:
+                now = time.time()
+                self._con.executemany("UPDATE embed_cache SET last_used=? WHERE model=? AND text_hash=?",
+                                      [(now, self.model, h) for h in out])
+                self._con.commit()
+        return out
+
+    def put_many(self, items: Dict[str, np.ndarray]) -> None:
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._con.executemany(
+                "INSERT OR REPLACE INTO embed_cache(model, text_hash, vector, last_used) VALUES(?,?,?,?)",
+                [(self.model, h, np.asarray(v, dtype=np.float32).tobytes(), now) for h, v in items.items()],
+            )
+            self._con.commit()
+            self._evict(keep_since=now)
+
+    def embed(self, texts: List[str], embed_fn: Optional[Callable[[List[str]], np.ndarray]] = None) -> np.ndarray:
+        """Mismo contrato que embed_texts: (len(texts), dim) float32 en el mismo orden."""
+        embed_fn = embed_fn or embed_texts
+        hashes = [text_hash(t) for t in texts]
+        found = self.get_many(hashes)
+        missing: Dict[str, str] = {}
+        for h, t in zip(hashes, texts):
+            if h not in found and h not in missing:
+                missing[h] = t
+        n_hits = sum(1 for h in hashes if h in found)
+        with self._lock:  # embed() puede llamarse desde varios hilos (embed_batcher)
+            self.hits += n_hits
+            self.misses += len(hashes) - n_hits
+        if missing:
+            vecs = embed_fn(list(missing.values()))
+            fresh = dict(zip(missing.keys(), vecs))
+            self.put_many(fresh)
+            found.update(fresh)
+        return np.vstack([found[h] for h in hashes]) if hashes else np.empty((0, 0), np.float32)
+
+    def size_bytes(self) -> int:
+        page_size, = self._con.execute("PRAGMA page_size").fetchone()
+        page_count, = self._con.execute("PRAGMA page_count").fetchone()
+        free, = self._con.execute("PRAGMA freelist_count").fetchone()
+        return (page_count - free) * page_size
+
+    def _evict(self, keep_since: float) -> None:
+        # borra de una vez los menos usados hasta quedar ~10% bajo el límite (las páginas liberadas se reutilizan);
+        # nunca lo recién escrito, aunque eso deje el archivo sobre el límite
+        size = self.size_bytes()
+        if size <= self.max_bytes:
+            return
+        total, = self._con.execute("SELECT COUNT(*) FROM embed_cache").fetchone()
+        if not total:
+            return
+        target = int(self.max_bytes * 0.9)
+        n_drop = max(1, int(total * (size - target) / size))
+        cur = self._con.execute(
+            "DELETE FROM embed_cache WHERE id IN "
+            "(SELECT id FROM embed_cache WHERE last_used < ? ORDER BY last_used LIMIT ?)",
+            (keep_since, n_drop),
+        )
+        self._con.commit()
+        if cur.rowcount <= 0:
+            return
+        self.evicted += cur.rowcount
+        logger.info(f"[RAG] embed_cache: {cur.rowcount} vectores eliminados ({size / (1024 * 1024.0):.1f} MB > {self.max_bytes / (1024 * 1024.0):.1f} MB)")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            "evicted": self.evicted,
+        }
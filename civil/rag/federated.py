@@ -0,0 +1,130 @@
+from __future__ import annotations
+import os, time, heapq, sqlite3, threading, logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from .sqlite_db import hybrid_search, embedder_for, SEARCH_MODES, is_corpus_path
+from .utils_embed import EmbedderMismatch
+from .conn_pool import read_pool
+
+logger = logging.getLogger('civil')
+
+# Búsqueda sobre varias demand_<id>.db a la vez (p.ej. todas las causas listas de un usuario)
+RAG_FEDERATED_WORKERS = int(os.getenv("RAG_FEDERATED_WORKERS", "8"))
+RAG_FEDERATED_BUDGET_S = float(os.getenv("RAG_FEDERATED_BUDGET_S", "3.0"))  # por demanda
+RAG_FEDERATED_MAX_DEMANDS = int(os.getenv("RAG_FEDERATED_MAX_DEMANDS", "200"))
+
+@dataclass
+class FederatedHit:
+    demand_id: int
+    chunk_id: int
+    content: str
+    score: float
+
+@dataclass
+class FederatedReport:
+    searched: List[int] = field(default_factory=list)
+    timed_out: List[int] = field(default_factory=list)
+    failed: Dict[int, str] = field(default_factory=dict)
+    skipped: List[int] = field(default_factory=list)  # no alcanzaron a correr por terminación temprana
+    elapsed_s: float = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "searched": self.searched,
+            "timed_out": self.timed_out,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "elapsed_s": round(self.elapsed_s, 3),
+        }
+
+class _Deadline(Exception):
+    pass
+
+def _search_one(demand_id: int, db_path: str, query: str, qvec, k: int, mode: str,
+                budget_s: float, cancelled: threading.Event, model: Optional[str] = None) -> List[FederatedHit]:
+    if cancelled.is_set():
+        raise _Deadline()
+    deadline = time.monotonic() + budget_s
+    with read_pool.connection(db_path, demand_id if is_corpus_path(db_path) else None) as con:
+        if model and embedder_for(con).model != model:
+            # el vector de la consulta no es comparable con los de esta base: se informa como fallida
+            raise EmbedderMismatch(f"la base usa {embedder_for(con).model}, la consulta {model}")
+        # el handler aborta la consulta SQLite en curso (FTS/escaneo) al vencer el presupuesto
+        con.set_progress_handler(lambda: int(cancelled.is_set() or time.monotonic() > deadline), 2000)
+        try:
+            rows = hybrid_search(con, query, lambda q: qvec, rerank_k=k, mode=mode)
+        except sqlite3.OperationalError as e:
+            if "interrupted" in str(e):
+                raise _Deadline()
+            raise
+        finally:
+            con.set_progress_handler(None, 0)
+    if time.monotonic() > deadline:
+        logger.debug("[FED] demanda %s excedió el presupuesto (%.2fs) en el rerank", demand_id, budget_s)
+    return [FederatedHit(demand_id, int(cid), content, float(score)) for cid, content, score in rows]
+
+def federated_search(targets: Sequence[Tuple[int, str]], query: str, embed_query: Callable, k: int = 8,
+                     per_demand_k: Optional[int] = None, mode: str = "union",
+                     max_workers: int = RAG_FEDERATED_WORKERS, budget_s: float = RAG_FEDERATED_BUDGET_S,
+                     min_score: Optional[float] = None) -> Tuple[List[FederatedHit], FederatedReport]:
+    """
+    Ejecuta hybrid_search en cada (demand_id, db_path) con un pool acotado y mezcla el top-k global por score.
+    - La consulta se embebe una sola vez y se reutiliza en todas las bases; si embed_query tiene .model
+      (QueryEmbedder), las bases de otro embedder se informan en failed.
+    - budget_s: tiempo máximo por demanda; las que lo exceden se informan en timed_out.
+    - Los scores son cosenos en todos los modos (rrf incluido: ordena por RRF pero devuelve el coseno), así que
+      se pueden mezclar entre demandas y entre el camino fusionado y el fallback denso.
+    - min_score: umbral de coseno para terminación temprana; con k hits >= min_score no se lanzan las pendientes.
+    Las demandas se buscan en el orden recibido (conviene pasar primero las más relevantes/recientes).
+    """
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"mode must be one of {SEARCH_MODES}, got {mode!r}")
+    t0 = time.perf_counter()
+    report = FederatedReport()
+    targets = list(targets)[:RAG_FEDERATED_MAX_DEMANDS]
+    if not targets:
+        return [], report
+    qvec = embed_query(query)
+    per_demand_k = per_demand_k or k
+    cancelled = threading.Event()
+    heap: List[Tuple[float, int, FederatedHit]] = []  # min-heap del top-k global
+    seq = 0
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(targets))), thread_name_prefix="fed") as pool:
+        futures = {
+            pool.submit(_search_one, demand_id, db_path, query, qvec, per_demand_k, mode, budget_s, cancelled,
+                        getattr(embed_query, "model", None)): demand_id
+            for demand_id, db_path in targets
+        }
+        for fut in as_completed(futures):
+            demand_id = futures[fut]
+            if fut.cancelled():
+                continue
+            try:
+                hits = fut.result()
+            except _Deadline:
+                (report.skipped if cancelled.is_set() else report.timed_out).append(demand_id)
+                continue
+            except Exception as e:
+                logger.warning("[FED] demanda %s falló: %s", demand_id, e)
+                report.failed[demand_id] = str(e)
+                continue
+            report.searched.append(demand_id)
+            for hit in hits:  # coseno de cada hit final: comparable entre demandas
+                seq += 1
+                item = (hit.score, -seq, hit)
+                if len(heap) < k:
+                    heapq.heappush(heap, item)
+                elif item[:2] > heap[0][:2]:
+                    heapq.heapreplace(heap, item)
+            if min_score is not None and not cancelled.is_set() and len(heap) >= k and heap[0][0] >= min_score:
+                logger.info("[FED] terminación temprana: %d hits >= %.3f tras %d demandas", k, min_score, len(report.searched))
+                cancelled.set()
+                for f in futures:
+                    if f.cancel():
+                        report.skipped.append(futures[f])
+    report.elapsed_s = time.perf_counter() - t0
+    hits = [h for _, _, h in sorted(heap, key=lambda x: (x[0], x[1]), reverse=True)]
+    logger.info("[FED] %d demandas buscadas, %d fuera de tiempo, %d fallidas, %d omitidas en %.3fs",
+                len(report.searched), len(report.timed_out), len(report.failed), len(report.skipped), report.elapsed_s)
+    return hits, report
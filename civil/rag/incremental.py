@@ -0,0 +1,122 @@
+from __future__ import annotations
+import os, glob, json, hashlib, sqlite3, logging
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+from .sqlite_db import vector_codec, get_meta, connect, span_select, has_table
+from .bulk_writer import BulkWriter
+
+logger = logging.getLogger('civil')
+
+# Reingesta incremental: los documentos se identifican por (folio, sha256 del PDF).
+# Lo que no cambió se copia desde la base anterior (chunks, content_norm y vectores); solo lo nuevo se extrae y embebe.
+
+DocKey = Tuple[str, str]  # (folio, sha256)
+
+def file_sha256(path: str, block: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for b in iter(lambda: f.read(block), b""):
+            h.update(b)
+    return h.hexdigest()
+
+def folio_of(path: str) -> str:
+    # get_demanda guarda <folio>_<fila>.pdf; la fila cambia cuando entran trámites nuevos, el folio no
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return stem.split("_", 1)[0]
+
+def document_meta(path: str) -> dict:
+    return {"size": os.path.getsize(path), "sha256": file_sha256(path), "folio": folio_of(path)}
+
+def previous_documents(src: sqlite3.Connection, scope: Optional[int] = None,
+                       chunker: Optional[str] = None) -> Dict[DocKey, int]:
+    """
+    (folio, sha256) -> documents.id de la ingesta anterior. No cuentan los documentos sin sha256 (ingestas viejas),
+    los que quedaron sin texto en una ingesta sin OCR ni, si se indica chunker, los troceados con otro chunker.
+    """
+    where, params = (" WHERE d.demand_id=?", (scope,)) if scope is not None else ("", ())
+    out: Dict[DocKey, int] = {}
+    has_text = "EXISTS(SELECT 1 FROM chunks c WHERE c.document_id = d.id)"
+    if has_table(src, "chunk_occurrences"):  # un documento puede tener solo apariciones de chunks de otros
+        has_text += " OR EXISTS(SELECT 1 FROM chunk_occurrences o WHERE o.document_id = d.id)"
+    rows = src.execute(f"SELECT d.id, d.path, d.meta_json, {has_text} FROM documents d{where} ORDER BY d.id", params)
+    for doc_id, path, meta_json, has_text in rows:
+        meta = json.loads(meta_json or "{}")
+        if not has_text and not meta.get("ocr"):
+            continue  # sin texto y extraído sin OCR: se reintenta (ahora puede tener OCR)
+        if chunker is not None and meta.get("chunker") != chunker:
+            continue
+        if meta.get("sha256"):
+            out.setdefault((meta.get("folio") or folio_of(path), meta["sha256"]), doc_id)
+    return out
+
+def reusable_vectors(src: sqlite3.Connection, writer: BulkWriter) -> bool:
+    """
+    False si la base anterior guardó vectores truncados (vector_dim, Matryoshka) más cortos de lo que guarda la nueva
+    (su vector_dim, o la dimensión completa del embedder): esos vectores no se pueden copiar y hay que reembeberlos.
+    """
+    src_dim = vector_codec(src).dim
+    need = writer.codec.dim or (writer.embedder.dim if writer.embedder is not None else 0)
+    return not (src_dim and need and src_dim < need)
+
+def carried_chunks(src: sqlite3.Connection, writer: BulkWriter, old_id: int) -> Iterator[tuple]:
+    """
+    (content, seq, content_norm, vector, span) del documento old_id en la base anterior, en orden de seq,
+    incluidas sus apariciones de chunks canónicos de otros documentos (se vuelven a deduplicar al escribir).
+    Los vectores pasan como bytes si el codec coincide; content_norm se reutiliza si la versión de text_norm es la misma.
+    vector es None si la base anterior los guardó truncados a menos dimensiones (ver reusable_vectors): se reembeben.
+    """
+    src_codec = vector_codec(src)
+    same_codec = src_codec == writer.codec
+    keep_vectors = reusable_vectors(src, writer)
+    src_norm = get_meta(src).get("fts_norm")
+    reuse_norm = writer.normalized and src_norm is not None and src_norm == get_meta(writer.con).get("fts_norm")
+    norm = "c.content_norm" if reuse_norm else "NULL"
+    sql = (f"SELECT c.content, c.seq, {norm}, e.vector, {span_select(src)} FROM chunks c "
+           "LEFT JOIN embeddings e ON e.chunk_id = c.id WHERE c.document_id=?")
+    params: tuple = (old_id,)
+    if has_table(src, "chunk_occurrences"):
+        sql += (f" UNION ALL SELECT c.content, o.seq, {norm}, e.vector, {span_select(src, 'o')} FROM chunk_occurrences o "
+                "JOIN chunks c ON c.id = o.chunk_id LEFT JOIN embeddings e ON e.chunk_id = c.id WHERE o.document_id=?")
+        params = (old_id, old_id)
+    for content, seq, content_norm, blob, *span in src.execute(sql + " ORDER BY 2", params):
+        if not keep_vectors:
+            blob = None
+        elif blob is not None and not same_codec:
+            blob = src_codec.decode(blob)
+        yield content, seq, content_norm, blob, span
+
+def carry_documents(src: sqlite3.Connection, writer: BulkWriter, docs: Iterable[Tuple[int, str, dict]]) -> int:
+    """
+    Copia al writer los documentos (old_id, path nuevo, meta) de la base anterior con sus chunks y vectores
+    (sin vector si no son reutilizables: la ingesta los reembebe vía write_deduplicated).
+    """
+    n = 0
+    for old_id, path, meta in docs:
+        doc_ref = writer.add_document(path, meta)
+        for content, seq, content_norm, blob, span in carried_chunks(src, writer, old_id):
+            writer.add_chunk(doc_ref, content, seq, blob, content_norm, span)
+            n += 1
+    return n
+
+def find_previous_db(root: str, demand_id: int, hint: Optional[str] = None) -> Optional[str]:
+    """
+    Última demand_<id>.db existente bajo root/<fecha>/. hint (Causa.sqlite_path) se prefiere si existe;
+    get_demanda ya lo apunta a la fecha de hoy antes de ingestar, por eso se busca la más reciente.
+    """
+    if hint:
+        path = f"{root}{hint}"
+        if os.path.exists(path):
+            return path
+    found = sorted(glob.glob(os.path.join(root, "*", f"demand_{int(demand_id)}.db")))
+    return found[-1] if found else None
+
+def open_previous(db_path: Optional[str], scope: Optional[int] = None) -> Optional[sqlite3.Connection]:
+    """Base de la ingesta anterior en solo lectura, o None si no existe (primera ingesta)."""
+    if not db_path or not os.path.exists(db_path):
+        return None
+    try:
+        con = connect(f"file:{db_path}?mode=ro", scope, uri=True)
+        con.execute("SELECT 1 FROM documents LIMIT 1")
+        return con
+    except sqlite3.DatabaseError as e:
+        logger.warning(f"[INGEST] no se puede leer la base anterior {db_path}: {e}")
+        return None
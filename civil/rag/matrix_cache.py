@@ -0,0 +1,139 @@
+from __future__ import annotations
+import os, sqlite3, threading, logging
+import numpy as np
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple
+from .utils_embed import normalize_rows
+
+logger = logging.getLogger('civil')
+
+RAG_MATRIX_CACHE_MB = int(os.getenv("RAG_MATRIX_CACHE_MB", "512"))
+
+@dataclass
+class DemandMatrix:
+    chunk_ids: np.ndarray  # int64, ascending
+    matrix: np.ndarray     # float32 (n, dim), rows L2-normalized
+    signature: Tuple
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.chunk_ids.nbytes + self.matrix.nbytes)
+
+    def rows_for(self, ids) -> Tuple[np.ndarray, np.ndarray]:
+        # (posiciones en la matriz, chunk_ids encontrados) para los ids pedidos
+        ids = np.asarray(list(ids), dtype=np.int64)
+        if not len(self.chunk_ids) or not len(ids):
+            return np.empty(0, np.int64), np.empty(0, np.int64)
+        pos = np.searchsorted(self.chunk_ids, ids).clip(max=len(self.chunk_ids) - 1)
+        found = self.chunk_ids[pos] == ids
+        return pos[found], ids[found]
+
+def db_path_of(con: sqlite3.Connection) -> str:
+    for _, name, path in con.execute("PRAGMA database_list").fetchall():
+        if name == "main":
+            return path or ""
+    return ""
+
+def db_signature(db_path: str) -> Tuple:
+    # mtime+size del .db y del -wal: cambia cuando ingest_demand reescribe la base
+    st = os.stat(db_path)
+    sig = (st.st_mtime_ns, st.st_size)
+    wal = db_path + "-wal"
+    if os.path.exists(wal):
+        wst = os.stat(wal)
+        sig += (wst.st_mtime_ns, wst.st_size)
+    return sig
+
+def cache_key(db_path: str, demand_id: Optional[int] = None) -> str:
+    # en el corpus consolidado cada demanda es una entrada propia del cache
+    return db_path if demand_id is None else f"{db_path}#{demand_id}"
+
+def demand_signature(con: sqlite3.Connection, db_path: str, demand_id: int) -> Tuple:
+    # en el corpus el archivo cambia con cualquier demanda: la firma es la generación de la demanda
+    row = con.execute("SELECT generation FROM demands WHERE demand_id=?", (demand_id,)).fetchone()
+    return (os.stat(db_path).st_ino, row[0] if row else 0)
+
+def load_matrix(con: sqlite3.Connection, signature: Tuple = ()) -> DemandMatrix:
+    demand_id = getattr(con, "demand_id", None)
+    if demand_id is not None:
+        rows = con.execute("SELECT chunk_id, vector FROM embeddings WHERE demand_id=? ORDER BY chunk_id", (demand_id,)).fetchall()
+    else:
+        rows = con.execute("SELECT chunk_id, vector FROM embeddings ORDER BY chunk_id").fetchall()
+    if not rows:
+        return DemandMatrix(np.empty(0, np.int64), np.empty((0, 0), np.float32), signature)
+    from .sqlite_db import vector_codec
+    ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+    mat = vector_codec(con).decode_matrix([r[1] for r in rows])
+    return DemandMatrix(ids, normalize_rows(mat), signature)
+
+class MatrixCache:
+    """LRU en proceso de matrices de embeddings por demanda, acotado por memoria total."""
+
+    def __init__(self, max_bytes: int = RAG_MATRIX_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, DemandMatrix]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def get(self, con: sqlite3.Connection) -> Optional[DemandMatrix]:
+        db_path = db_path_of(con)
+        if not db_path or not os.path.exists(db_path):
+            return None
+        demand_id = getattr(con, "demand_id", None)
+        key = cache_key(db_path, demand_id)
+        sig = db_signature(db_path) if demand_id is None else demand_signature(con, db_path, demand_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.signature == sig:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            if entry is not None:
+                self._drop(key)
+                self.invalidations += 1
+            self.misses += 1
+        entry = load_matrix(con, sig)
+        logger.debug("[RAG] matrix_cache miss %s: %d vectores, %.1f MB", key, len(entry.chunk_ids), entry.nbytes / (1024 * 1024.0))
+        with self._lock:
+            if entry.nbytes <= self.max_bytes:
+                if key in self._entries:
+                    self._drop(key)
+                self._entries[key] = entry
+                self._bytes += entry.nbytes
+                while self._bytes > self.max_bytes:
+                    old_path, _ = next(iter(self._entries.items()))
+                    self._drop(old_path)
+                    self.evictions += 1
+        return entry
+
+    def invalidate(self, db_path: str, demand_id: Optional[int] = None) -> None:
+        key = cache_key(db_path, demand_id)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= entry.nbytes
+
+matrix_cache = MatrixCache()
@@ -0,0 +1,71 @@
+from __future__ import annotations
+import os, re, hashlib, logging
+import numpy as np
+from typing import Callable, Dict, List, Optional
+from .utils_embed import embed_texts, get_embedder
+
+logger = logging.getLogger('civil')
+
+# Memo de embeddings de consultas: por request (dict) + cache compartido corto en django.core.cache (Redis)
+RAG_QUERY_EMBED_TTL = int(os.getenv("RAG_QUERY_EMBED_TTL", "900"))  # segundos; 0 desactiva el cache compartido
+CACHE_PREFIX = "rag:qemb:"
+
+def normalize_query(q: str) -> str:
+    # la misma pregunta llega como texto original, saneado para FTS ("a b") o con prefijos ("a* b*"):
+    # sin puntuación ni espacios extra todas comparten un solo embedding
+    return " ".join(re.sub(r"[^\w]+", " ", q or "").split())
+
+class QueryEmbedder:
+    """
+    Reemplazo de embed_query para hybrid_search. Se crea uno por pregunta (rag_answer)
+    y se comparte entre el seed, la búsqueda inicial y los NEED_MORE_CONTEXT.
+    embed_fn puede ser un Embedder (p.ej. embedder_for(con)): model se toma de él.
+    """
+
+    def __init__(self, embed_fn: Optional[Callable[[List[str]], np.ndarray]] = None,
+                 model: Optional[str] = None, ttl: int = RAG_QUERY_EMBED_TTL):
+        self.embed_fn = embed_fn or embed_texts
+        self.model = model or getattr(embed_fn, "model", None) or get_embedder().model
+        self.ttl = ttl
+        self._memo: Dict[str, np.ndarray] = {}
+        self.hits = self.shared_hits = self.misses = 0
+
+    def __call__(self, query: str) -> np.ndarray:
+        text = normalize_query(query) or (query or "").strip()
+        vec = self._memo.get(text)
+        if vec is not None:
+            self.hits += 1
+            return vec
+        key = CACHE_PREFIX + hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).hexdigest()
+        vec = self._shared_get(key)
+        if vec is not None:
+            self.shared_hits += 1
+        else:
+            self.misses += 1
+            vec = np.asarray(self.embed_fn([text])[0], dtype=np.float32)
+            self._shared_set(key, vec)
+        self._memo[text] = vec
+        return vec
+
+    def _shared_get(self, key: str) -> Optional[np.ndarray]:
+        if self.ttl <= 0:
+            return None
+        try:
+            from django.core.cache import cache
+            blob = cache.get(key)
+        except Exception as e:
+            logger.warning("[RAG] query embed cache no disponible: %s", e)
+            return None
+        return np.frombuffer(blob, dtype=np.float32) if blob else None
+
+    def _shared_set(self, key: str, vec: np.ndarray) -> None:
+        if self.ttl <= 0:
+            return
+        try:
+            from django.core.cache import cache
+            cache.set(key, vec.tobytes(), self.ttl)
+        except Exception as e:
+            logger.warning("[RAG] query embed cache no disponible: %s", e)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "shared_hits": self.shared_hits, "misses": self.misses}
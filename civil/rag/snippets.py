@@ -0,0 +1,84 @@
+from __future__ import annotations
+import os, re
+import numpy as np
+from typing import List, Optional, Tuple
+from .text_norm import fts_tokens
+from .utils_embed import Embedder, get_embedder
+
+# Fragmento de cada chunk que va al LLM: la ventana de oraciones contiguas con más términos de la pregunta
+# y más parecida a ella, en vez de los primeros N caracteres.
+RAG_SNIPPET_CHARS = int(os.getenv("RAG_SNIPPET_CHARS", "600"))  # contexto inicial de rag_answer
+RAG_MORE_SNIPPET_CHARS = int(os.getenv("RAG_MORE_SNIPPET_CHARS", "900"))  # NEED_MORE_CONTEXT / seed
+RAG_SNIPPET_SIM_WEIGHT = float(os.getenv("RAG_SNIPPET_SIM_WEIGHT", "0.5"))
+RAG_SNIPPET_EMBED_DIM = 256
+
+_SENT_BREAK = re.compile(r"(?<=[\.;:!?])\s+|\s*\n\s*")
+ELLIPSIS = "…"
+
+def sentence_spans(text: str, max_len: int) -> List[Tuple[int, int]]:
+    """(start, end) de las oraciones/líneas de text; las más largas que max_len se parten en espacios."""
+    out, pos = [], 0
+    for m in list(_SENT_BREAK.finditer(text)) + [None]:
+        end = m.start() if m else len(text)
+        start = pos
+        while end - start > max_len:
+            cut = text.rfind(" ", start + max_len // 2, start + max_len)
+            cut = cut if cut > start else start + max_len
+            out.append((start, cut))
+            start = cut + 1 if text[cut:cut + 1] == " " else cut
+        if text[start:end].strip():
+            out.append((start, end))
+        pos = m.end() if m else len(text)
+    return out
+
+def _sim_embedder() -> Embedder:
+    # similitud oración/pregunta con el embedder local (sin red): embeber oraciones con la API costaría más que el ahorro
+    return get_embedder("local", dim=RAG_SNIPPET_EMBED_DIM)
+
+def _sentence_scores(sentences: List[str], query: str, embedder: Optional[Embedder]) -> np.ndarray:
+    terms = set(fts_tokens(query))
+    lex = np.array([len(terms & set(fts_tokens(s))) / len(terms) if terms else 0.0 for s in sentences], np.float32)
+    if embedder is None or not sentences or RAG_SNIPPET_SIM_WEIGHT <= 0:
+        return lex
+    vecs = embedder.embed(sentences + [query])
+    sims = np.clip(vecs[:-1] @ vecs[-1], 0.0, None)
+    return lex + RAG_SNIPPET_SIM_WEIGHT * sims
+
+def best_window(text: str, query: str, max_chars: int, embedder: Optional[Embedder] = None) -> Tuple[int, int]:
+    """
+    (start, end) de la ventana de oraciones contiguas de a lo más max_chars con mayor puntaje total
+    (fracción de términos de la pregunta + similitud). Si nada puntúa, el comienzo del texto.
+    """
+    if len(text) <= max_chars:
+        return 0, len(text)
+    spans = sentence_spans(text, max(1, max_chars // 2))
+    if not spans:
+        return 0, 0
+    scores = _sentence_scores([text[s:e] for s, e in spans], query, embedder or _sim_embedder())
+    best, best_score = None, 0.0
+    j, total = 0, 0.0
+    for i in range(len(spans)):
+        # dos punteros: [i, j) es la ventana más larga desde la oración i que cabe en max_chars
+        j = max(j, i)
+        while j < len(spans) and spans[j][1] - spans[i][0] <= max_chars:
+            total += scores[j]
+            j += 1
+        if total > best_score + 1e-9:
+            best, best_score = (spans[i][0], spans[j - 1][1]), total
+        if j > i:
+            total -= scores[i]
+    if best is None:
+        end = text.rfind(" ", max_chars // 2, max_chars)
+        return 0, end if end > 0 else max_chars
+    return best
+
+def best_snippet(text: str, query: str, max_chars: int, embedder: Optional[Embedder] = None) -> str:
+    """Mejor ventana de text para query, con … donde se recortó."""
+    text = text or ""
+    start, end = best_window(text, query, max_chars, embedder)
+    out = text[start:end].strip()
+    if start > 0:
+        out = ELLIPSIS + out
+    if end < len(text.rstrip()):
+        out += ELLIPSIS
+    return out
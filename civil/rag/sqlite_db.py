@@ -1,7 +1,23 @@
 from __future__ import annotations
-import os, sqlite3, json, numpy as np
+import os, re, sqlite3, json, numpy as np
+from contextlib import closing
 from typing import List, Tuple, Iterable, Optional
-from .utils_embed import pack_vec, unpack_vec, embed_texts, cosine_sim
+from .utils_embed import pack_vec, embed_texts, cosine_scores, normalize_vec, VectorCodec, FLOAT32, default_codec
+from .utils_embed import Embedder, EmbedderMismatch, embedder_from_meta, OPENAI_EMBEDDING_MODEL
+from .matrix_cache import matrix_cache, DemandMatrix, load_matrix, db_path_of
+from .ann import load_ivf, ANN_N_PROBE
+from .text_norm import fts_tokens, normalize_for_fts, normalize_fts_query, FTS_NORM_VERSION
+
+SEARCH_MODES = ("bm25", "union", "rrf")
+RRF_K = 60  # constante estándar de reciprocal rank fusion
+
+# Almacenamiento: "per_demand" (un demand_<id>.db por causa) o "corpus" (un solo archivo particionado por demand_id)
+RAG_STORES = ("per_demand", "corpus")
+RAG_STORE = os.getenv("RAG_STORE", "per_demand")
+RAG_CORPUS_FILE = os.getenv("RAG_CORPUS_FILE", "corpus.db")  # relativo a SQLITE_LOCAL_PATH / SQLITE_PATH
+
+# ubicación del chunk en el documento (citas precisas); ensure_schema las agrega a bases existentes
+SPAN_COLUMNS = ("page", "page_end", "char_start", "char_end")
 
 SCHEMA_SQL = '''
 PRAGMA journal_mode=WAL;
@@ -17,7 +33,12 @@ CREATE TABLE IF NOT EXISTS chunks (
     id INTEGER PRIMARY KEY,
     document_id INTEGER NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
     content TEXT NOT NULL,
-    seq INTEGER NOT NULL
+    seq INTEGER NOT NULL,
+    content_norm TEXT,
+    page INTEGER,               -- página (desde 1) donde empieza el chunk; NULL en bases anteriores al chunker por estructura
+    page_end INTEGER,
+    char_start INTEGER,         -- offsets en el texto del documento (páginas unidas por una línea en blanco)
+    char_end INTEGER
 );
 
 CREATE TABLE IF NOT EXISTS embeddings (
@@ -26,50 +47,424 @@ CREATE TABLE IF NOT EXISTS embeddings (
     vector BLOB NOT NULL
 );
 
--- FTS5 for BM25 retrieval
-CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(content, chunk_id UNINDEXED, tokenize='porter');
--- contentless option could be used; here we keep content
+-- apariciones de un chunk canónico en otros documentos/posiciones (casi-duplicados suprimidos en la ingesta, rag.dedup)
+CREATE TABLE IF NOT EXISTS chunk_occurrences (
+    id INTEGER PRIMARY KEY,
+    chunk_id INTEGER NOT NULL REFERENCES chunks(id) ON DELETE CASCADE,
+    document_id INTEGER NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    page INTEGER,
+    page_end INTEGER,
+    char_start INTEGER,
+    char_end INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_chunk_occurrences_chunk ON chunk_occurrences(chunk_id);
+
+-- ficha de la causa (civil.rag.case_card): partes, RUTs, montos, fechas y trámites; se arma en la ingesta
+CREATE TABLE IF NOT EXISTS case_card (
+    demand_id INTEGER PRIMARY KEY,
+    card_json TEXT NOT NULL,
+    updated_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+-- FTS5 for BM25 retrieval; external content over chunks.content_norm (text_norm.normalize_for_fts: Spanish
+-- stopwords, light stemming, RUT/number canonicalization), so the index never stores a copy of the text
+CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(content_norm, content='chunks', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
 '''
 
-def ensure_schema(db_path: str):
+# Esquemas anteriores de chunks_fts, que las bases existentes conservan hasta migrarlas con migrate_fts (manage.py rag_fts):
+# "legacy" guardaba su propia copia del texto (y chunk_id); "external" indexaba chunks.content con porter (stemmer inglés).
+LEGACY_FTS_SQL = "CREATE VIRTUAL TABLE chunks_fts USING fts5(content, chunk_id UNINDEXED, tokenize='porter')"
+NORMALIZED_FTS_SQL = "CREATE VIRTUAL TABLE chunks_fts USING fts5(content_norm, content='chunks', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+CORPUS_FTS_VIEW_SQL = "CREATE VIEW chunks_fts_src AS SELECT id, content_norm, 'd' || demand_id AS demand FROM chunks"
+CORPUS_FTS_SQL = "CREATE VIRTUAL TABLE chunks_fts USING fts5(content_norm, demand, content='chunks_fts_src', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+
+# Corpus consolidado: mismas tablas + demand_id. En FTS la demanda es una columna indexada con el token
+# "d<id>", así el filtro por demanda es una intersección de posting lists y no un post-filtro.
+CORPUS_SCHEMA_SQL = '''
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+
+CREATE TABLE IF NOT EXISTS demands (
+    demand_id INTEGER PRIMARY KEY,
+    generation INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    demand_id INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    meta_json TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_documents_demand ON documents(demand_id);
+
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY,
+    demand_id INTEGER NOT NULL,
+    document_id INTEGER NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+    content TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    content_norm TEXT,
+    page INTEGER,               -- página (desde 1) donde empieza el chunk; NULL en bases anteriores al chunker por estructura
+    page_end INTEGER,
+    char_start INTEGER,         -- offsets en el texto del documento (páginas unidas por una línea en blanco)
+    char_end INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_chunks_demand ON chunks(demand_id);
+
+CREATE TABLE IF NOT EXISTS embeddings (
+    id INTEGER PRIMARY KEY,
+    demand_id INTEGER NOT NULL,
+    chunk_id INTEGER NOT NULL REFERENCES chunks(id) ON DELETE CASCADE,
+    vector BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_embeddings_demand ON embeddings(demand_id, chunk_id);
+
+CREATE TABLE IF NOT EXISTS chunk_occurrences (
+    id INTEGER PRIMARY KEY,
+    demand_id INTEGER NOT NULL,
+    chunk_id INTEGER NOT NULL REFERENCES chunks(id) ON DELETE CASCADE,
+    document_id INTEGER NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    page INTEGER,
+    page_end INTEGER,
+    char_start INTEGER,
+    char_end INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_chunk_occurrences_chunk ON chunk_occurrences(chunk_id);
+CREATE INDEX IF NOT EXISTS idx_chunk_occurrences_demand ON chunk_occurrences(demand_id);
+
+-- ficha de la causa (civil.rag.case_card): partes, RUTs, montos, fechas y trámites; se arma en la ingesta
+CREATE TABLE IF NOT EXISTS case_card (
+    demand_id INTEGER PRIMARY KEY,
+    card_json TEXT NOT NULL,
+    updated_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+-- FTS de contenido externo sobre una vista que expone la demanda como token "d<id>"
+CREATE VIEW IF NOT EXISTS chunks_fts_src AS SELECT id, content_norm, 'd' || demand_id AS demand FROM chunks;
+CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(content_norm, demand, content='chunks_fts_src', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+
+-- generation cambia con cada escritura de vectores de la demanda: firma del matrix_cache por demanda
+CREATE TRIGGER IF NOT EXISTS embeddings_generation_ai AFTER INSERT ON embeddings BEGIN
+    INSERT INTO demands(demand_id, generation) VALUES (NEW.demand_id, 1)
+    ON CONFLICT(demand_id) DO UPDATE SET generation = generation + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS embeddings_generation_ad AFTER DELETE ON embeddings BEGIN
+    UPDATE demands SET generation = generation + 1 WHERE demand_id = OLD.demand_id;
+END;
+'''
+
+class DemandConnection(sqlite3.Connection):
+    """Conexión acotada a una demanda dentro del corpus consolidado (demand_id=None: base por demanda)."""
+    demand_id: Optional[int] = None
+
+def demand_scope(con: sqlite3.Connection) -> Optional[int]:
+    return getattr(con, "demand_id", None)
+
+def is_corpus_path(db_path: str) -> bool:
+    return os.path.basename(db_path or "") == os.path.basename(RAG_CORPUS_FILE)
+
+def connect(db_path: str, demand_id: Optional[int] = None, **kwargs) -> DemandConnection:
+    con = sqlite3.connect(db_path, factory=DemandConnection, **kwargs)
+    con.demand_id = demand_id
+    return con
+
+def fts_demand_token(demand_id: int) -> str:
+    return f"d{int(demand_id)}"
+
+def ensure_schema(db_path: str, codec: Optional[VectorCodec] = None):
     os.makedirs(os.path.dirname(db_path), exist_ok=True)
     with sqlite3.connect(db_path) as con:
-        con.executescript(SCHEMA_SQL)
+        con.executescript(CORPUS_SCHEMA_SQL if is_corpus_path(db_path) else SCHEMA_SQL)
+        existing = chunk_columns(con)
+        for col in SPAN_COLUMNS:
+            if col not in existing:
+                con.execute(f"ALTER TABLE chunks ADD COLUMN {col} INTEGER")
+        # el formato solo se fija al crear la base; una base existente conserva el suyo
+        for key, value in (codec or default_codec()).as_meta().items():
+            con.execute("INSERT OR IGNORE INTO meta(key, value) VALUES(?, ?)", (key, value))
+        if fts_layout(con) == "normalized":
+            con.execute("INSERT OR IGNORE INTO meta(key, value) VALUES('fts_norm', ?)", (FTS_NORM_VERSION,))
+
+def has_table(con: sqlite3.Connection, name: str) -> bool:
+    return con.execute("SELECT 1 FROM sqlite_master WHERE name=?", (name,)).fetchone() is not None
+
+def chunk_columns(con: sqlite3.Connection) -> set:
+    return {r[1] for r in con.execute("PRAGMA table_info(chunks)")}
+
+def has_spans(con: sqlite3.Connection) -> bool:
+    return set(SPAN_COLUMNS) <= chunk_columns(con)
+
+def span_select(con: sqlite3.Connection, alias: str = "c") -> str:
+    # columnas de ubicación para un SELECT; NULLs si la base es anterior a ellas
+    return ", ".join(f"{alias}.{c}" if has_spans(con) else "NULL" for c in SPAN_COLUMNS)
+
+def get_meta(con: sqlite3.Connection) -> dict:
+    try:
+        return dict(con.execute("SELECT key, value FROM meta").fetchall())
+    except sqlite3.OperationalError:
+        return {}  # bases anteriores a la tabla meta
+
+def set_meta(con: sqlite3.Connection, key: str, value) -> None:
+    con.execute("INSERT OR REPLACE INTO meta(key, value) VALUES(?, ?)", (key, str(value)))
+
+def fts_layout(con: sqlite3.Connection) -> str:
+    # "normalized" (esquema actual), "external" o "legacy" (bases anteriores a la migración).
+    # Se cachea por schema_version: una conexión del pool ve la migración hecha por otro proceso.
+    version = con.execute("PRAGMA schema_version").fetchone()[0]
+    cached = getattr(con, "_fts_layout", None)
+    if cached is None or cached[0] != version:
+        row = con.execute("SELECT sql FROM sqlite_master WHERE name='chunks_fts'").fetchone()
+        sql = row[0] if row else ""
+        cached = (version, "normalized" if "content_norm" in sql else "external" if "content=" in sql else "legacy")
+        if isinstance(con, DemandConnection):
+            con._fts_layout = cached
+    return cached[1]
+
+def fts_column(con: sqlite3.Connection) -> str:
+    return "content_norm" if fts_layout(con) == "normalized" else "content"
+
+def migrate_fts(db_path: str, vacuum: bool = True) -> bool:
+    """
+    Lleva chunks_fts al esquema actual: llena chunks.content_norm y regenera el índice desde ahí.
+    También re-normaliza si la base fue indexada con otra versión de text_norm. False si ya estaba al día.
+    """
+    with closing(sqlite3.connect(db_path)) as con:
+        if fts_layout(con) == "normalized" and get_meta(con).get("fts_norm") == FTS_NORM_VERSION:
+            return False
+        corpus = is_corpus_path(db_path)
+        con.create_function("normalize_for_fts", 1, normalize_for_fts, deterministic=True)
+        with con:
+            con.execute("BEGIN")  # el DDL también dentro de la transacción: si algo falla la base queda como estaba
+            con.execute("DROP TABLE IF EXISTS chunks_fts")
+            if corpus:
+                con.execute("DROP VIEW IF EXISTS chunks_fts_src")
+            if "content_norm" not in chunk_columns(con):
+                con.execute("ALTER TABLE chunks ADD COLUMN content_norm TEXT")
+            con.execute("UPDATE chunks SET content_norm = normalize_for_fts(content)")
+            if corpus:
+                con.execute(CORPUS_FTS_VIEW_SQL)
+            con.execute(CORPUS_FTS_SQL if corpus else NORMALIZED_FTS_SQL)
+            con.execute("INSERT INTO chunks_fts(chunks_fts) VALUES('rebuild')")
+            con.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            set_meta(con, "fts_norm", FTS_NORM_VERSION)
+        if vacuum:
+            con.execute("VACUUM")  # devuelve al sistema las páginas del texto duplicado
+            con.execute("PRAGMA wal_checkpoint(TRUNCATE)")  # en WAL el VACUUM queda en el -wal hasta el checkpoint
+    return True
+
+def chunk_locations(con: sqlite3.Connection, ids: Iterable[int]) -> dict:
+    """chunk_id -> (ruta del PDF, página, página final) para citar; páginas None en bases sin ubicación."""
+    ids = list(dict.fromkeys(int(i) for i in ids))
+    if not ids:
+        return {}
+    pages = "c.page, c.page_end" if has_spans(con) else "NULL, NULL"
+    rows = con.execute(
+        f"SELECT c.id, d.path, {pages} FROM chunks c JOIN documents d ON d.id = c.document_id "
+        f"WHERE c.id IN ({','.join('?' * len(ids))})", ids,
+    ).fetchall()
+    return {cid: (path, page, page_end) for cid, path, page, page_end in rows}
+
+def vector_codec(con: sqlite3.Connection) -> VectorCodec:
+    meta = get_meta(con)
+    return VectorCodec.from_meta(meta) if meta else FLOAT32
+
+def embedder_for(con: sqlite3.Connection) -> Embedder:
+    """Embedder de los vectores de la base: las consultas se embeben con él, no con RAG_EMBEDDER."""
+    return embedder_from_meta(get_meta(con))
+
+def record_embedder(con: sqlite3.Connection, embedder: Embedder) -> None:
+    """
+    Fija en meta el embedder de la base. Si ya tiene vectores de otro modelo o dimensión levanta EmbedderMismatch;
+    una base anterior al registro con vectores se toma como del modelo OpenAI por defecto.
+    """
+    if con.execute("SELECT 1 FROM embeddings LIMIT 1").fetchone():
+        meta = get_meta(con)
+        model, dim = meta.get("embed_model") or OPENAI_EMBEDDING_MODEL, int(meta.get("embed_dim") or 0)
+        if model != embedder.model or (dim and embedder.dim and dim != embedder.dim):
+            raise EmbedderMismatch(f"la base tiene vectores de {model} (dim={dim or '?'}), "
+                               f"no se pueden agregar de {embedder.model} (dim={embedder.dim or '?'})")
+    for key, value in embedder.as_meta().items():
+        if key != "embed_dim" or embedder.dim:
+            set_meta(con, key, value)
 
 def insert_document(con: sqlite3.Connection, path: str, meta: dict | None=None) -> int:
-    cur = con.execute("INSERT INTO documents(path, meta_json) VALUES(?, ?)", (path, json.dumps(meta or {}, ensure_ascii=False)))
+    meta_json = json.dumps(meta or {}, ensure_ascii=False)
+    scope = demand_scope(con)
+    if scope is not None:
+        cur = con.execute("INSERT INTO documents(demand_id, path, meta_json) VALUES(?, ?, ?)", (scope, path, meta_json))
+    else:
+        cur = con.execute("INSERT INTO documents(path, meta_json) VALUES(?, ?)", (path, meta_json))
     return int(cur.lastrowid)
 
 def insert_chunk(con: sqlite3.Connection, document_id: int, content: str, seq: int) -> int:
-    cur = con.execute("INSERT INTO chunks(document_id, content, seq) VALUES(?,?,?)", (document_id, content, seq))
+    scope = demand_scope(con)
+    layout = fts_layout(con)
+    cols, values = ["document_id", "content", "seq"], [document_id, content, seq]
+    if scope is not None:
+        cols.insert(0, "demand_id")
+        values.insert(0, scope)
+    fts_text = content
+    if layout == "normalized":
+        fts_text = normalize_for_fts(content)
+        cols.append("content_norm")
+        values.append(fts_text)
+    cur = con.execute(f"INSERT INTO chunks({', '.join(cols)}) VALUES({', '.join('?' for _ in cols)})", values)
     chunk_id = int(cur.lastrowid)
-    con.execute("INSERT INTO chunks_fts(rowid, content, chunk_id) VALUES(?,?,?)", (chunk_id, content, chunk_id))
+    col = fts_column(con)
+    if scope is not None:
+        con.execute(f"INSERT INTO chunks_fts(rowid, {col}, demand) VALUES(?,?,?)", (chunk_id, fts_text, fts_demand_token(scope)))
+    elif layout == "legacy":
+        con.execute("INSERT INTO chunks_fts(rowid, content, chunk_id) VALUES(?,?,?)", (chunk_id, content, chunk_id))
+    else:
+        con.execute(f"INSERT INTO chunks_fts(rowid, {col}) VALUES(?,?)", (chunk_id, fts_text))
     return chunk_id
 
-def insert_embedding(con: sqlite3.Connection, chunk_id: int, vector):
-    con.execute("INSERT INTO embeddings(chunk_id, vector) VALUES(?, ?)", (chunk_id, pack_vec(vector)))
+def insert_embedding(con: sqlite3.Connection, chunk_id: int, vector, codec: Optional[VectorCodec] = None):
+    codec = codec or vector_codec(con)
+    scope = demand_scope(con)
+    if scope is not None:
+        con.execute("INSERT INTO embeddings(demand_id, chunk_id, vector) VALUES(?, ?, ?)", (scope, chunk_id, pack_vec(vector, codec)))
+    else:
+        con.execute("INSERT INTO embeddings(chunk_id, vector) VALUES(?, ?)", (chunk_id, pack_vec(vector, codec)))
 
 def topk_bm25(con: sqlite3.Connection, query: str, k: int=40) -> List[Tuple[int, str]]:
-    sql = "SELECT rowid, content FROM chunks_fts WHERE chunks_fts MATCH ? ORDER BY rank LIMIT ?"
+    if fts_layout(con) == "normalized":
+        # el índice guarda content_norm: la consulta pasa por la misma normalización y el texto sale de chunks
+        query = normalize_fts_query(query)
+        if not query.strip():
+            return []
+        sql = ("SELECT chunks_fts.rowid, c.content FROM chunks_fts JOIN chunks c ON c.id = chunks_fts.rowid "
+               "WHERE chunks_fts MATCH ? ORDER BY chunks_fts.rank LIMIT ?")
+    else:
+        sql = "SELECT rowid, content FROM chunks_fts WHERE chunks_fts MATCH ? ORDER BY rank LIMIT ?"
+    scope = demand_scope(con)
+    if scope is not None:
+        query = f"demand : {fts_demand_token(scope)} AND ({query})"
     return [(int(r[0]), r[1]) for r in con.execute(sql, (query, k)).fetchall()]
 
+def fts_or_query(text: str, normalized: bool = False) -> str:
+    # every term quoted and OR-ed: never a syntax error, and chunks matching more terms rank higher.
+    # normalized: terms from text_norm (the content_norm vocabulary), so RUTs and amounts stay one token
+    words = fts_tokens(text) if normalized else (t.lower() for t in re.findall(r"\w+", text or ""))
+    terms = dict.fromkeys(t for t in words if len(t) > 1)
+    return " OR ".join(f'"{t}"' for t in terms)
+
 def fetch_embeddings(con: sqlite3.Connection, chunk_ids: Iterable[int]) -> List[tuple]:
     qmarks = ",".join("?" for _ in chunk_ids)
     sql = f"SELECT c.id, c.content, e.vector FROM chunks c JOIN embeddings e ON e.chunk_id=c.id WHERE c.id IN ({qmarks})"
     return con.execute(sql, tuple(chunk_ids)).fetchall()
 
-def hybrid_search(con: sqlite3.Connection, query: str, embed_query, bm25_k=40, rerank_k=8):
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    # partial sort: O(n) selection of the k best, then order only those k
+    n = len(scores)
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < n:
+        idx = np.argpartition(-scores, k - 1)[:k]
+    else:
+        idx = np.arange(n)
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+def rerank_by_embedding(rows: List[tuple], qvec, k: int, codec: Optional[VectorCodec] = None) -> List[Tuple[int, str, float]]:
+    if not rows:
+        return []
+    ids = [int(r[0]) for r in rows]
+    contents = [r[1] for r in rows]
+    scores = cosine_scores([r[2] for r in rows], qvec, codec=codec)
+    return [(ids[i], contents[i], float(scores[i])) for i in top_k_indices(scores, k)]
+
+def rerank_cached(cached: DemandMatrix, candidates: List[Tuple[int, str]], qvec, k: int) -> List[Tuple[int, str, float]]:
+    contents = dict(candidates)
+    pos, ids = cached.rows_for(contents.keys())
+    if not len(pos):
+        return []
+    scores = cached.matrix[pos] @ normalize_vec(qvec)
+    return [(int(ids[i]), contents[int(ids[i])], float(scores[i])) for i in top_k_indices(scores, k)]
+
+def fetch_contents(con: sqlite3.Connection, chunk_ids: List[int]) -> List[Tuple[int, str]]:
+    if not chunk_ids:
+        return []
+    qmarks = ",".join("?" for _ in chunk_ids)
+    rows = dict(con.execute(f"SELECT id, content FROM chunks WHERE id IN ({qmarks})", tuple(chunk_ids)).fetchall())
+    return [(cid, rows[cid]) for cid in chunk_ids if cid in rows]
+
+def dense_candidates(con: sqlite3.Connection, cached: DemandMatrix, qvec, k: int, n_probe: int = ANN_N_PROBE) -> List[int]:
+    # IVF probe when the demand has an index next to its DB, exact scan of the matrix otherwise
+    db_path = db_path_of(con)
+    index = load_ivf(db_path, demand_scope(con)) if db_path else None
+    if index is not None:
+        pos, ids = cached.rows_for(index.probe(qvec, n_probe))
+    else:
+        pos, ids = np.arange(len(cached.chunk_ids)), cached.chunk_ids
+    if not len(pos):
+        return []
+    scores = cached.matrix[pos] @ normalize_vec(qvec)
+    return [int(ids[i]) for i in top_k_indices(scores, k)]
+
+def rrf_fuse(rankings: List[List[int]], k: int = RRF_K) -> List[Tuple[int, float]]:
+    fused: dict = {}
+    for ranking in rankings:
+        for rank, cid in enumerate(ranking, start=1):
+            fused[cid] = fused.get(cid, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda x: x[1], reverse=True)
+
+def rrf_search(con: sqlite3.Connection, query: str, embed_query, bm25_k=40, rerank_k=8, use_cache=True,
+               ann_k: int = 40, n_probe: int = ANN_N_PROBE, fts_query: Optional[str] = None):
+    fts_query = fts_or_query(fts_query or query, fts_layout(con) == "normalized")
+    lexical = topk_bm25(con, fts_query, k=bm25_k) if fts_query else []
+    qvec = vector_codec(con).prepare(embed_query(query))
+    cached = matrix_cache.get(con) if use_cache else None
+    if cached is None:
+        cached = load_matrix(con)
+    dense = dense_candidates(con, cached, qvec, ann_k, n_probe)
+    if not lexical:
+        # dense-only fallback: cosine scores over the demand's vectors
+        return rerank_cached(cached, fetch_contents(con, dense[:rerank_k]), qvec, rerank_k)
+    top = [cid for cid, _ in rrf_fuse([[cid for cid, _ in lexical], dense])[:rerank_k]]
+    contents = dict(lexical)
+    contents.update(fetch_contents(con, [cid for cid in top if cid not in contents]))
+    # orden de RRF, pero el score es el coseno (como el fallback denso y los otros modos): 1/(k+rank) no se
+    # puede comparar con los de otra búsqueda ni con los de otra demanda (federated_search, score= del contexto)
+    pos, ids = cached.rows_for(top)
+    cos = dict(zip(ids.tolist(), (cached.matrix[pos] @ normalize_vec(qvec)).tolist())) if len(pos) else {}
+    return [(cid, contents[cid], float(cos.get(cid, 0.0))) for cid in top if cid in contents]
+
+def hybrid_search(con: sqlite3.Connection, query: str, embed_query, bm25_k=40, rerank_k=8, use_cache=True,
+                  mode: str = "bm25", ann_k: int = 40, n_probe: int = ANN_N_PROBE, fts_query: Optional[str] = None):
+    # fts_query: consulta MATCH distinta del texto que se embebe (p.ej. la pregunta saneada vs. la original)
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"mode must be one of {SEARCH_MODES}, got {mode!r}")
+    if mode == "rrf":
+        return rrf_search(con, query, embed_query, bm25_k, rerank_k, use_cache, ann_k, n_probe, fts_query)
     # Step 1: lexical
-    candidates = topk_bm25(con, query, k=bm25_k)
-    if not candidates:
+    candidates = topk_bm25(con, fts_query or query, k=bm25_k)
+    if not candidates and mode == "bm25":
         return []
-    ids = [cid for cid, _ in candidates]
-    rows = fetch_embeddings(con, ids)
-    # Step 2: embedding rerank
-    qvec = embed_query(query)
-    scored = []
-    for cid, content, blob in rows:
-        vec = unpack_vec(blob)
-        scored.append((cid, content, cosine_sim(qvec, vec)))
-    scored.sort(key=lambda x: x[2], reverse=True)
-    return scored[:rerank_k]
+    # query truncated/normalized the same way the stored vectors were
+    codec = vector_codec(con)
+    qvec = codec.prepare(embed_query(query))
+    cached = matrix_cache.get(con) if use_cache else None
+    # Step 1b (union): dense candidates from the ANN index, so FTS misses still get context
+    if mode == "union":
+        if cached is None:
+            cached = load_matrix(con)
+        seen = {cid for cid, _ in candidates}
+        dense_ids = [cid for cid in dense_candidates(con, cached, qvec, ann_k, n_probe) if cid not in seen]
+        candidates = candidates + fetch_contents(con, dense_ids)
+    # Step 2: embedding rerank, from the per-demand matrix cache when the DB is a file
+    if cached is not None:
+        return rerank_cached(cached, candidates, qvec, rerank_k)
+    rows = fetch_embeddings(con, [cid for cid, _ in candidates])
+    return rerank_by_embedding(rows, qvec, rerank_k, codec)
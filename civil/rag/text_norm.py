@@ -0,0 +1,110 @@
+from __future__ import annotations
+import re, unicodedata
+from functools import lru_cache
+from typing import List
+
+# Normalización del texto que va al índice FTS (columna chunks.content_norm) y de las consultas BM25.
+# Versión guardada en meta.fts_norm: si cambia el algoritmo, las bases viejas se regeneran con rag_fts.
+FTS_NORM_VERSION = "es1"
+
+STOPWORDS = frozenset("""
+a al algo algun alguna algunas alguno algunos ante antes aquel aquella aquellas aquellos aqui asi aun aunque
+bajo bien cada como con contra cual cuales cualquier cuando cuanta cuantas cuanto cuantos de del desde donde
+durante e el ella ellas ello ellos en entre era eran es esa esas ese eso esos esta estaba estan estar
+estas este esto estos fue fueron ha habia han hasta hay la las le les lo los mas me mi mis mucho muy ni no nos
+nosotros o otra otras otro otros para pero poco por porque que quien quienes se sea sean segun ser si sido sin
+sobre son su sus tal tambien tan tanto te tiene tienen todo todos tu tus u un una unas uno unos usted ustedes
+y ya yo
+""".split())
+
+_RUT = re.compile(r"\b(\d{1,2})\.?(\d{3})\.?(\d{3})\s*-\s*([\dkK])\b")
+_THOUSANDS = re.compile(r"\b\d{1,3}(?:\.\d{3})+\b")
+_ORDINAL = re.compile(r"(\d)\s*[º°ª]")
+_TOKEN = re.compile(r"[0-9a-z]+")
+
+_FOLD = str.maketrans("áéíóúüñÁÉÍÓÚÜÑàèìòùÀÈÌÒÙ", "aeiouunAEIOUUNaeiouAEIOU")
+
+def fold_accents(text: str) -> str:
+    # igual que unicode61 remove_diacritics: á->a, ü->u, ñ->n. Tabla para lo común, NFKD solo si queda algo
+    text = text.translate(_FOLD)
+    if text.isascii():
+        return text
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+def canonicalize_numbers(text: str) -> str:
+    # RUT 12.345.678-K / 12345678-k -> 12345678k; montos y leyes 1.234.567 / 20.027 -> 1234567 / 20027;
+    # ordinales 2º / 2° -> 2 (el º se pliega a "o" y el ° desaparece: sin esto no coinciden)
+    # (cada regex solo corre si el texto tiene el carácter que la dispara: es el costo dominante al indexar)
+    if "º" in text or "°" in text or "ª" in text:
+        text = _ORDINAL.sub(r"\1", text)
+    if "-" in text:
+        text = _RUT.sub(lambda m: f"{m.group(1)}{m.group(2)}{m.group(3)}{m.group(4).lower()}", text)
+    if "." in text:
+        text = _THOUSANDS.sub(lambda m: m.group(0).replace(".", ""), text)
+    return text
+
+def _stem_once(token: str) -> str:
+    if len(token) < 5 or token.isdigit():
+        return token
+    last = token[-1]
+    if last in "aoe":
+        return token[:-1]
+    if last == "s":
+        if token.endswith("eses"):
+            return token[:-2]
+        if token.endswith("ces"):
+            return token[:-3] + "z"
+        if token[-2] in "aoe":
+            return token[:-2]
+    return token
+
+@lru_cache(maxsize=65536)
+def light_stem(token: str) -> str:
+    # stemmer liviano de Savoy (el de Lucene SpanishLightStemmer): plurales y género, sin tocar la raíz.
+    # Se aplica hasta punto fijo para que normalizar texto ya normalizado no lo cambie (intereses/interés -> inter)
+    while True:
+        stem = _stem_once(token)
+        if stem == token:
+            return token
+        token = stem
+
+@lru_cache(maxsize=65536)
+def _norm_token(tok: str, stopwords: bool) -> str:
+    # "" = se descarta; cacheado porque el vocabulario de una causa se repite mucho
+    if stopwords and tok in STOPWORDS:
+        return ""
+    if tok.isdigit():
+        return tok.lstrip("0") or "0"  # 09/07/2024 y 9 de julio comparten el 9
+    tok = light_stem(tok)
+    return "" if stopwords and tok in STOPWORDS else tok
+
+def clear_token_cache() -> None:
+    light_stem.cache_clear()
+    _norm_token.cache_clear()
+
+def fts_tokens(text: str, stopwords: bool = True) -> List[str]:
+    text = fold_accents(canonicalize_numbers(text or "")).lower()
+    return [t for t in (_norm_token(tok, stopwords) for tok in _TOKEN.findall(text)) if t]
+
+def normalize_for_fts(text: str) -> str:
+    """Texto indexado en chunks_fts (y forma de las consultas): minúsculas, sin tildes, sin stopwords, con stem liviano."""
+    return " ".join(fts_tokens(text))
+
+_FTS_SYNTAX = re.compile(r'["*():^+]|\b(?:AND|OR|NOT|NEAR)\b')
+_WORD = re.compile(r"[^\W_]+")
+
+def normalize_fts_query(query: str) -> str:
+    """
+    Lleva una consulta MATCH al vocabulario de content_norm. Texto libre: normalize_for_fts.
+    Con sintaxis FTS5 (comillas, prefijos, AND/OR): solo se normalizan las palabras y se respetan los operadores.
+    """
+    if not _FTS_SYNTAX.search(query or ""):
+        return normalize_for_fts(query)
+
+    def term(m):
+        word = m.group(0)
+        if word in ("AND", "OR", "NOT", "NEAR"):
+            return word
+        toks = fts_tokens(word, stopwords=False)
+        return " ".join(toks) if toks else word
+    return _WORD.sub(term, query)
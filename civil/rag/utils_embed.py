@@ -1,9 +1,8 @@
 from __future__ import annotations
 import os
 import numpy as np
-import sqlite3
-from typing import List, Tuple
-from pydantic import BaseModel
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Tuple, Optional
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -11,23 +10,202 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
 OPENAI_EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-large")
+RAG_EMBEDDER = os.getenv("RAG_EMBEDDER", "openai")  # "openai" | "local" (sin red, ver LocalEmbedder)
+RAG_LOCAL_EMBED_DIM = int(os.getenv("RAG_LOCAL_EMBED_DIM", "512"))
+
+# Formato de almacenamiento de vectores para bases nuevas (las existentes guardan el suyo en la tabla meta)
+VECTOR_FORMATS = ("float32", "float16", "int8")
+RAG_VECTOR_FORMAT = os.getenv("RAG_VECTOR_FORMAT", "float32")
+RAG_VECTOR_DIM = int(os.getenv("RAG_VECTOR_DIM", "0"))  # 0 = dimensión completa del modelo
 
-# Lazy import to avoid hard dependency until used
 def _openai_client():
-    from openai import OpenAI
-    return OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL) if OPENAI_BASE_URL else OpenAI(api_key=OPENAI_API_KEY)
+    # cliente compartido del proceso (pool HTTP reutilizado entre llamadas)
+    from civil.lib.openai_clients import get_client
+    return get_client(OPENAI_API_KEY, OPENAI_BASE_URL)
+
+class EmbedderMismatch(ValueError):
+    """Vectores de otro backend/modelo/dimensión que los de la base: nunca se mezclan."""
+
+class Embedder:
+    """
+    Backend de embeddings. model identifica el espacio vectorial (se guarda en meta.embed_model de la base):
+    dos embedders con el mismo model producen vectores comparables. dim = 0 si aún no se conoce.
+    """
+    name = ""
+
+    def __init__(self, model: str, dim: int = 0):
+        self.model = model
+        self.dim = dim
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        return self.embed(texts)
+
+    def as_meta(self) -> dict:
+        return {"embedder": self.name, "embed_model": self.model, "embed_dim": str(self.dim)}
+
+class OpenAIEmbedder(Embedder):
+    name = "openai"
+    DIMS = {"text-embedding-3-large": 3072, "text-embedding-3-small": 1536, "text-embedding-ada-002": 1536}
+
+    def __init__(self, model: Optional[str] = None, dim: int = 0):
+        model = model or OPENAI_EMBEDDING_MODEL
+        super().__init__(model, dim or self.DIMS.get(model, 0))
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        client = _openai_client()
+        resp = client.embeddings.create(model=self.model, input=texts)
+        vecs = np.vstack([np.array(d.embedding, dtype=np.float32) for d in resp.data])
+        self.dim = self.dim or vecs.shape[1]
+        return vecs
+
+def _local_features(text: str) -> List[str]:
+    # mismas palabras que el FTS (sin tildes, stem liviano, RUT/montos canónicos) más bigramas
+    from .text_norm import fts_tokens
+    toks = fts_tokens(text)
+    return toks + [f"{a} {b}" for a, b in zip(toks, toks[1:])]
+
+class LocalEmbedder(Embedder):
+    """
+    Sin red ni modelo: feature hashing (HashingVectorizer de scikit-learn, murmurhash con signo) de palabras y bigramas
+    normalizados, tf logarítmico y L2. Determinista y sin ajuste al corpus: preguntas y chunks de cualquier demanda
+    caen en el mismo espacio. Para pruebas, benchmarks y operar sin la API; la calidad es léxica, no semántica.
+    """
+    name = "local"
+    VERSION = "hash1"
+
+    def __init__(self, model: Optional[str] = None, dim: int = 0):
+        dim = dim or (int(model.rsplit("-", 1)[1]) if model else RAG_LOCAL_EMBED_DIM)
+        super().__init__(f"local-{self.VERSION}-{dim}", dim)
+        if model and model != self.model:
+            raise EmbedderMismatch(f"embedder local {self.model} no puede producir vectores de {model}")
+        from sklearn.feature_extraction.text import HashingVectorizer
+        self._vectorizer = HashingVectorizer(n_features=dim, analyzer=_local_features, alternate_sign=True, norm=None)
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        x = self._vectorizer.transform(texts)
+        x.data = np.sign(x.data) * np.log1p(np.abs(x.data))  # sublinear tf, conserva el signo del hashing
+        return normalize_rows(x.toarray().astype(np.float32))
+
+# registro de backends: RAG_EMBEDDER elige el de las ingestas nuevas; las consultas usan el de la base (meta)
+EMBEDDERS: Dict[str, Callable[..., Embedder]] = {"openai": OpenAIEmbedder, "local": LocalEmbedder}
+_embedders: Dict[Tuple[str, Optional[str], int], Embedder] = {}
+
+def register_embedder(name: str, factory: Callable[..., Embedder]) -> None:
+    """factory(model=None, dim=0) -> Embedder."""
+    EMBEDDERS[name] = factory
+
+def get_embedder(name: Optional[str] = None, model: Optional[str] = None, dim: int = 0) -> Embedder:
+    name = name or RAG_EMBEDDER
+    if name not in EMBEDDERS:
+        raise ValueError(f"embedder must be one of {tuple(EMBEDDERS)}, got {name!r}")
+    key = (name, model, dim)
+    if key not in _embedders:
+        _embedders[key] = EMBEDDERS[name](model=model, dim=dim)
+    return _embedders[key]
+
+def embedder_from_meta(meta: dict) -> Embedder:
+    """Embedder con que se llenó una base (meta embedder/embed_model/embed_dim); bases anteriores: OpenAI."""
+    return get_embedder(meta.get("embedder") or "openai", meta.get("embed_model") or None, int(meta.get("embed_dim") or 0))
 
 def embed_texts(texts: List[str]) -> np.ndarray:
-    client = _openai_client()
-    resp = client.embeddings.create(model=OPENAI_EMBEDDING_MODEL, input=texts)
-    vecs = [np.array(d.embedding, dtype=np.float32) for d in resp.data]
-    return np.vstack(vecs)
+    return get_embedder().embed(texts)
+
+def normalize_vec(vec: np.ndarray) -> np.ndarray:
+    vec = np.asarray(vec, dtype=np.float32).reshape(-1)
+    return vec / (np.linalg.norm(vec) or 1e-12)
+
+@dataclass(frozen=True)
+class VectorCodec:
+    """
+    Codifica vectores para la columna embeddings.vector.
+    - float32: 4 bytes/dim (formato histórico)
+    - float16: 2 bytes/dim
+    - int8: 1 byte/dim + escala float32 por vector (max|v| / 127)
+    dim > 0 trunca al prefijo de dim componentes y renormaliza (Matryoshka, soportado por text-embedding-3).
+    """
+    fmt: str = "float32"
+    dim: int = 0
+
+    def __post_init__(self):
+        if self.fmt not in VECTOR_FORMATS:
+            raise ValueError(f"vector format must be one of {VECTOR_FORMATS}, got {self.fmt!r}")
+
+    def prepare(self, vec: np.ndarray) -> np.ndarray:
+        vec = np.asarray(vec, dtype=np.float32).reshape(-1)
+        return normalize_vec(vec[:self.dim]) if self.dim else vec
+
+    def encode(self, vec: np.ndarray) -> bytes:
+        vec = self.prepare(vec)
+        if self.fmt == "float16":
+            return vec.astype(np.float16).tobytes()
+        if self.fmt == "int8":
+            scale = np.float32(np.abs(vec).max() / 127.0 or 1.0)
+            return scale.tobytes() + np.round(vec / scale).astype(np.int8).tobytes()
+        return vec.astype(np.float32).tobytes()
+
+    def decode(self, blob: bytes) -> np.ndarray:
+        return self.decode_matrix([blob])[0]
+
+    def decode_matrix(self, blobs: List[bytes]) -> np.ndarray:
+        # one contiguous (n, dim) float32 matrix instead of n small arrays
+        if not blobs:
+            return np.empty((0, 0), dtype=np.float32)
+        buf = b"".join(blobs)
+        if self.fmt == "float16":
+            return np.frombuffer(buf, dtype=np.float16).reshape(len(blobs), -1).astype(np.float32)
+        if self.fmt == "int8":
+            raw = np.frombuffer(buf, dtype=np.uint8).reshape(len(blobs), -1)
+            scales = raw[:, :4].copy().view(np.float32)
+            return raw[:, 4:].view(np.int8).astype(np.float32) * scales
+        return np.frombuffer(buf, dtype=np.float32).reshape(len(blobs), -1)
+
+    def bytes_per_vector(self, full_dim: int) -> int:
+        d = self.dim or full_dim
+        return {"float32": 4 * d, "float16": 2 * d, "int8": d + 4}[self.fmt]
+
+    def as_meta(self) -> dict:
+        return {"vector_format": self.fmt, "vector_dim": str(self.dim)}
+
+    @classmethod
+    def from_meta(cls, meta: dict) -> "VectorCodec":
+        return cls(meta.get("vector_format") or "float32", int(meta.get("vector_dim") or 0))
+
+FLOAT32 = VectorCodec()
+
+def default_codec() -> VectorCodec:
+    return VectorCodec(RAG_VECTOR_FORMAT, RAG_VECTOR_DIM)
+
+def pack_vec(vec: np.ndarray, codec: Optional[VectorCodec] = None) -> bytes:
+    return (codec or FLOAT32).encode(vec)
+
+def unpack_vec(blob: bytes, codec: Optional[VectorCodec] = None) -> np.ndarray:
+    if codec is None or codec == FLOAT32:
+        return np.frombuffer(blob, dtype=np.float32)
+    return codec.decode(blob)
+
+def unpack_matrix(blobs: List[bytes], codec: Optional[VectorCodec] = None) -> np.ndarray:
+    return (codec or FLOAT32).decode_matrix(blobs)
+
+def row_norms(mat: np.ndarray) -> np.ndarray:
+    # einsum avoids the temporary (n, dim) array that np.linalg.norm(axis=1) allocates
+    norms = np.sqrt(np.einsum("ij,ij->i", mat, mat))
+    norms[norms == 0] = 1e-12
+    return norms
 
-def pack_vec(vec: np.ndarray) -> bytes:
-    return vec.astype(np.float32).tobytes()
+def normalize_rows(mat: np.ndarray) -> np.ndarray:
+    return mat / row_norms(mat)[:, None]
 
-def unpack_vec(blob: bytes) -> np.ndarray:
-    return np.frombuffer(blob, dtype=np.float32)
+def cosine_scores(blobs: List[bytes], qvec: np.ndarray, block: int = 128, codec: Optional[VectorCodec] = None) -> np.ndarray:
+    # scores rows in contiguous blocks so the working set stays cache-sized even for thousands of candidates
+    q = normalize_vec(qvec)
+    out = np.empty(len(blobs), dtype=np.float32)
+    for s in range(0, len(blobs), block):
+        mat = unpack_matrix(blobs[s:s + block], codec)
+        out[s:s + block] = (mat @ q) / row_norms(mat)
+    return out
 
 def cosine_sim(a: np.ndarray, b: np.ndarray) -> float:
     denom = (np.linalg.norm(a) * np.linalg.norm(b)) or 1e-12
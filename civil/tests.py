@@ -1,3 +1,1047 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, override_settings
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from collections import OrderedDict
+from unittest import mock
+import numpy as np
 
-# Create your tests here.
+from civil.rag.sqlite_db import ensure_schema, insert_document, insert_chunk, insert_embedding, hybrid_search, vector_codec
+from civil.rag.utils_embed import cosine_sim, normalize_rows, pack_vec, VectorCodec
+from civil.rag.matrix_cache import MatrixCache
+from civil.rag.embed_cache import EmbeddingCache, text_hash
+from civil.rag.query_cache import QueryEmbedder
+from civil.lib import openai_clients
+from civil.rag.embed_batcher import embed_batches, token_batches
+from civil.rag.conn_pool import ReadPool
+from civil.rag.matrix_cache import db_path_of
+from civil.rag.federated import federated_search
+from civil.rag.corpus_store import import_demand_db, drop_demand, rebuild_demand, snapshot_corpus
+from civil.rag.sqlite_db import connect, topk_bm25, fts_layout, migrate_fts, get_meta, LEGACY_FTS_SQL
+from civil.rag.text_norm import normalize_for_fts, normalize_fts_query
+from civil.rag.bulk_writer import BulkWriter, install_db
+from civil.rag import ann
+from civil.rag.ann import ann_path, build_ann_index, build_ivf, evict_ivf, load_ivf
+from civil.lib import pdf_extract
+from civil.lib.pdf_extract import (iter_pdf_pages, iter_pdf_texts, plan_tasks, _page_deadline, PageTimeout,
+                                   OcrCache, ExtractMetrics)
+from civil.lib.chunker import chunk_pages, PAGE_SEP
+from civil.rag.sqlite_db import chunk_locations, has_spans
+from civil.rag.incremental import (document_meta, previous_documents, carry_documents, carried_chunks,
+                                   find_previous_db, open_previous, reusable_vectors)
+from civil.rag.dedup import canonical_map, ChunkItem, write_deduplicated
+from civil.rag import bench
+from civil.rag.snippets import best_snippet, best_window, ELLIPSIS
+from civil.rag.context_pack import pack_context, render_context
+from civil.rag.embed_batcher import estimate_tokens
+from civil.rag.utils_embed import get_embedder, embedder_from_meta, LocalEmbedder, EmbedderMismatch
+from civil.rag.sqlite_db import embedder_for, record_embedder
+from civil.rag.case_card import (build_case_card, save_case_card, load_case_card, render_case_card, answer_from_card,
+                                 card_intent)
+
+
+def _write_pdf(path, texts):
+    # PDF mínimo con una línea de texto por página (Helvetica), sin dependencias además de pypdf
+    from pypdf import PdfWriter
+    from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+    writer = PdfWriter()
+    font = writer._add_object(DictionaryObject({NameObject("/Type"): NameObject("/Font"),
+                                                NameObject("/Subtype"): NameObject("/Type1"),
+                                                NameObject("/BaseFont"): NameObject("/Helvetica")}))
+    for text in texts:
+        page = writer.add_blank_page(612, 792)
+        stream = DecodedStreamObject()
+        stream.set_data(f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode())
+        page[NameObject("/Contents")] = writer._add_object(stream)
+        page[NameObject("/Resources")] = DictionaryObject({NameObject("/Font"): DictionaryObject({NameObject("/F1"): font})})
+    with open(path, "wb") as f:
+        writer.write(f)
+
+
+def _fake_ocr(pdf_path, page_no, dpi, lang, timeout):
+    # a nivel de módulo para que el pool de procesos la pueda serializar
+    return f"escaneo folio {os.path.basename(pdf_path)} pagina {page_no}"
+
+
+def _pages_in_daemon(files, out):
+    # como un worker prefork de celery: proceso daemon, no puede crear hijos
+    try:
+        out.put([(os.path.basename(p), i, t) for p, i, t in iter_pdf_pages(files, workers=3, ocr=False)])
+    except BaseException as e:
+        out.put(repr(e))
+
+
+class DemandDBTestCase(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, "demand_1.db")
+        ensure_schema(self.db_path)
+        rng = np.random.default_rng(0)
+        self.vecs = rng.standard_normal((30, 16)).astype(np.float32)
+        with sqlite3.connect(self.db_path) as con:
+            doc_id = insert_document(con, "demanda.pdf")
+            for i, vec in enumerate(self.vecs):
+                cid = insert_chunk(con, doc_id, f"pagare banco cuota {i}", seq=i)
+                insert_embedding(con, cid, vec)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+class HybridSearchTests(DemandDBTestCase):
+    def test_rerank_matches_cosine_order(self):
+        qvec = self.vecs[7] + 0.01
+        with sqlite3.connect(self.db_path) as con:
+            rows = hybrid_search(con, "pagare", lambda q: qvec, bm25_k=40, rerank_k=5)
+        expected = sorted(range(30), key=lambda i: cosine_sim(qvec, self.vecs[i]), reverse=True)[:5]
+        self.assertEqual([cid - 1 for cid, _, _ in rows], expected)
+        self.assertAlmostEqual(rows[0][2], cosine_sim(qvec, self.vecs[7]), places=5)
+
+    def test_rerank_k_larger_than_candidates(self):
+        with sqlite3.connect(self.db_path) as con:
+            rows = hybrid_search(con, "pagare", lambda q: self.vecs[0], bm25_k=3, rerank_k=10)
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows, sorted(rows, key=lambda r: r[2], reverse=True))
+
+
+class MatrixCacheTests(DemandDBTestCase):
+    def test_hit_then_invalidate_on_rewrite(self):
+        cache = MatrixCache(max_bytes=1024 * 1024)
+        with sqlite3.connect(self.db_path) as con:
+            first = cache.get(con)
+            self.assertIs(cache.get(con), first)
+        self.assertEqual(first.matrix.shape, (30, 16))
+        with sqlite3.connect(self.db_path) as con:
+            cid = insert_chunk(con, 1, "nuevo tramite", seq=30)
+            insert_embedding(con, cid, self.vecs[0])
+        with sqlite3.connect(self.db_path) as con:
+            self.assertEqual(cache.get(con).matrix.shape, (31, 16))
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["invalidations"]), (1, 2, 1))
+
+    def test_evicts_by_memory_budget(self):
+        cache = MatrixCache(max_bytes=30 * 16 * 4 + 30 * 8)
+        other = os.path.join(self.tmp.name, "demand_2.db")
+        with sqlite3.connect(self.db_path) as src, sqlite3.connect(other) as dst:
+            src.backup(dst)
+        for path in (self.db_path, other):
+            with sqlite3.connect(path) as con:
+                cache.get(con)
+        stats = cache.stats()
+        self.assertEqual((stats["entries"], stats["evictions"]), (1, 1))
+        self.assertLessEqual(stats["bytes"], cache.max_bytes)
+
+
+class AnnIndexTests(DemandDBTestCase):
+    def test_probe_finds_nearest_neighbour(self):
+        rng = np.random.default_rng(1)
+        mat = normalize_rows(rng.standard_normal((2000, 32)).astype(np.float32))
+        ids = np.arange(1, 2001, dtype=np.int64)
+        index = build_ivf(ids, mat)
+        self.assertEqual(index.offsets[-1], 2000)
+        found = 0
+        for i in range(50):
+            probed = index.probe(mat[i], n_probe=8)
+            self.assertLess(len(probed), 2000)
+            found += int(ids[i] in probed)
+        self.assertGreaterEqual(found, 48)
+
+    def test_union_mode_returns_chunks_without_fts_match(self):
+        self.assertIsNotNone(build_ann_index(self.db_path))
+        self.assertIsNotNone(load_ivf(self.db_path))
+        with sqlite3.connect(self.db_path) as con:
+            self.assertEqual(hybrid_search(con, "embargo", lambda q: self.vecs[3]), [])
+            rows = hybrid_search(con, "embargo", lambda q: self.vecs[3], rerank_k=3, mode="union")
+        self.assertEqual(rows[0][0], 4)
+
+    def test_loaded_indexes_bounded_by_bytes(self):
+        other = os.path.join(self.tmp.name, "demand_2.db")
+        with sqlite3.connect(self.db_path) as src, sqlite3.connect(other) as dst:
+            src.backup(dst)
+        for path in (self.db_path, other):
+            build_ann_index(path)
+        with mock.patch.object(ann, "_loaded", OrderedDict()), mock.patch.object(ann, "_loaded_bytes", 0):
+            size = load_ivf(self.db_path).nbytes
+            with mock.patch.object(ann, "ANN_CACHE_MB", size * 1.5 / (1024 * 1024)):
+                load_ivf(other)
+                self.assertEqual(list(ann._loaded), [ann_path(other)])
+                self.assertEqual(ann._loaded_bytes, size)
+                evict_ivf(other)
+                self.assertEqual((len(ann._loaded), ann._loaded_bytes), (0, 0))
+
+
+class RRFSearchTests(DemandDBTestCase):
+    def test_fuses_lexical_and_dense_ranks(self):
+        with sqlite3.connect(self.db_path) as con:
+            rows = hybrid_search(con, "¿cuota 12?", lambda q: self.vecs[12], rerank_k=3, mode="rrf")
+        self.assertEqual(rows[0][0], 13)
+        self.assertEqual(len(rows), 3)
+
+    def test_dense_fallback_when_fts_is_empty(self):
+        with sqlite3.connect(self.db_path) as con:
+            rows = hybrid_search(con, "embargo: (pendiente)", lambda q: self.vecs[5], rerank_k=2, mode="rrf")
+        self.assertEqual(rows[0][0], 6)
+        self.assertAlmostEqual(rows[0][2], 1.0, places=5)
+
+    def test_fused_and_fallback_scores_are_cosines(self):
+        qvec = self.vecs[12] + 0.05
+        with sqlite3.connect(self.db_path) as con:
+            fused = hybrid_search(con, "cuota 12", lambda q: qvec, rerank_k=3, mode="rrf")
+            dense = hybrid_search(con, "embargo", lambda q: qvec, rerank_k=3, mode="rrf")
+        self.assertEqual(fused[0][0], dense[0][0])
+        self.assertAlmostEqual(fused[0][2], dense[0][2], places=5)
+        for cid, _, score in fused + dense:
+            self.assertAlmostEqual(score, cosine_sim(qvec, self.vecs[cid - 1]), places=5)
+
+    def test_rut_matches_normalized_index(self):
+        # content_norm guarda el RUT como un solo token (123456789): la consulta OR debe armarse igual
+        with sqlite3.connect(self.db_path) as con:
+            self.assertEqual(fts_layout(con), "normalized")
+            doc = insert_document(con, "escrito.pdf")
+            cid = insert_chunk(con, doc, "Ejecutado don Juan Pérez, RUT 12.345.678-9, domiciliado en Santiago", seq=0)
+            insert_embedding(con, cid, np.random.default_rng(9).standard_normal(16).astype(np.float32))
+            rows = hybrid_search(con, "¿RUT 12.345.678-9?", lambda q: self.vecs[5], rerank_k=3, mode="rrf")
+        self.assertEqual(rows[0][0], cid)
+
+
+class VectorCodecTests(SimpleTestCase):
+    def test_round_trip_formats(self):
+        vec = np.random.default_rng(2).standard_normal(64).astype(np.float32)
+        for fmt, size in (("float32", 256), ("float16", 128), ("int8", 68)):
+            codec = VectorCodec(fmt)
+            blob = codec.encode(vec)
+            self.assertEqual(len(blob), size)
+            self.assertGreater(cosine_sim(vec, codec.decode(blob)), 0.999)
+        truncated = VectorCodec("float16", dim=16)
+        self.assertEqual(truncated.decode(truncated.encode(vec)).shape, (16,))
+
+    def test_search_on_int8_truncated_db(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "demand_3.db")
+            ensure_schema(db_path, VectorCodec("int8", dim=8))
+            vecs = np.random.default_rng(3).standard_normal((10, 16)).astype(np.float32)
+            with sqlite3.connect(db_path) as con:
+                self.assertEqual(vector_codec(con), VectorCodec("int8", 8))
+                doc_id = insert_document(con, "demanda.pdf")
+                for i, vec in enumerate(vecs):
+                    insert_embedding(con, insert_chunk(con, doc_id, f"embargo {i}", seq=i), vec)
+                self.assertEqual(len(con.execute("SELECT vector FROM embeddings").fetchone()[0]), 12)
+                rows = hybrid_search(con, "embargo", lambda q: vecs[4], rerank_k=1)
+            self.assertEqual(rows[0][0], 5)
+
+    def test_db_without_meta_reads_float32(self):
+        con = sqlite3.connect(":memory:")
+        self.assertEqual(vector_codec(con), VectorCodec())
+
+
+class EmbeddingCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "embed_cache.db")
+        self.calls = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def fake_embed(self, texts):
+        self.calls.append(list(texts))
+        return np.vstack([np.full(8, len(t), np.float32) for t in texts])
+
+    def test_only_unseen_texts_hit_the_api(self):
+        with EmbeddingCache(self.path, model="m") as cache:
+            cache.embed(["hola mundo", "pagare"], self.fake_embed)
+        with EmbeddingCache(self.path, model="m") as cache:
+            vecs = cache.embed(["hola   mundo\n", "embargo", "pagare", "embargo"], self.fake_embed)
+            self.assertEqual(self.calls[-1], ["embargo"])
+            self.assertEqual(vecs.shape, (4, 8))
+            self.assertEqual(vecs[0][0], 10)
+            self.assertEqual(cache.stats()["hit_ratio"], 0.5)
+        with EmbeddingCache(self.path, model="otro") as cache:
+            cache.embed(["pagare"], self.fake_embed)
+        self.assertEqual(self.calls[-1], ["pagare"])
+
+    def test_evicts_least_recently_used(self):
+        with EmbeddingCache(self.path, max_bytes=64 * 1024, model="m") as cache:
+            texts = [f"chunk {i}" for i in range(400)]
+            for i in range(0, 400, 50):
+                cache.embed(texts[i:i + 50], lambda ts: np.ones((len(ts), 256), np.float32))
+            self.assertGreater(cache.stats()["evicted"], 0)
+            self.assertLess(cache.size_bytes(), 2 * 64 * 1024)
+            self.assertEqual(len(cache.get_many([text_hash(texts[-1])])), 1)
+            self.assertEqual(len(cache.get_many([text_hash(texts[0])])), 0)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class QueryEmbedderTests(SimpleTestCase):
+    def test_variants_of_same_question_embed_once(self):
+        calls = []
+
+        def fake_embed(texts):
+            calls.append(texts)
+            return np.ones((len(texts), 4), np.float32)
+
+        embedder = QueryEmbedder(fake_embed, model="test-memo")
+        for q in ("¿Hay embargo pendiente?", "Hay embargo pendiente", "Hay* embargo* pendiente*"):
+            self.assertEqual(embedder(q).shape, (4,))
+        self.assertEqual(calls, [["Hay embargo pendiente"]])
+        self.assertEqual(embedder.stats(), {"hits": 2, "shared_hits": 0, "misses": 1})
+        # otra pregunta (otro request) la toma del cache compartido
+        other = QueryEmbedder(fake_embed, model="test-memo")
+        other("Hay embargo pendiente.")
+        self.assertEqual((len(calls), other.shared_hits), (1, 1))
+
+
+class OpenAIClientsTests(SimpleTestCase):
+    def test_client_is_reused_and_reset_in_forked_child(self):
+        first = openai_clients.get_client("sk-test")
+        self.assertIs(openai_clients.get_client("sk-test"), first)
+        self.assertIsNot(openai_clients.get_client("sk-test", "http://localhost:1/v1"), first)
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.write(write_fd, b"1" if openai_clients.get_client("sk-test") is not first else b"0")
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read_fd, 1), b"1")
+        self.assertIs(openai_clients.get_client("sk-test"), first)
+
+    def test_default_endpoint_ignores_base_url_env(self):
+        with mock.patch.object(openai_clients, "OPENAI_BASE_URL", "http://localhost:1/v1"):
+            proxied = openai_clients.get_client("sk-test")
+            default = openai_clients.get_client("sk-test", openai_clients.DEFAULT_ENDPOINT)
+        self.assertIn("localhost:1", str(proxied.base_url))
+        self.assertIn("api.openai.com", str(default.base_url))
+        self.assertIs(openai_clients.get_client("sk-test", openai_clients.DEFAULT_ENDPOINT), default)
+
+
+class EmbedBatcherTests(SimpleTestCase):
+    def test_batches_by_estimated_tokens(self):
+        texts = ["x" * 300] * 10  # ~101 tokens c/u
+        self.assertEqual(token_batches(texts, max_tokens=350), [(0, 3), (3, 6), (6, 9), (9, 10)])
+        self.assertEqual(token_batches(texts, max_tokens=10_000, max_items=4), [(0, 4), (4, 8), (8, 10)])
+        self.assertEqual(token_batches(["x" * 90_000]), [(0, 1)])
+
+    def test_ordered_results_with_rate_limit_retry(self):
+        class RateLimitError(Exception):
+            status_code = 429
+
+        failed = []
+
+        def flaky_embed(batch):
+            n = int(batch[0])
+            if n == 3 and not failed:
+                failed.append(n)
+                raise RateLimitError()
+            time.sleep(0.001 * (10 - n % 10))
+            return np.array([[float(t)] for t in batch], np.float32)
+
+        texts = [str(i) for i in range(40)]
+        out = list(embed_batches(texts, flaky_embed, concurrency=4, max_items=3))
+        self.assertEqual([s for s, _ in out], list(range(0, 40, 3)))
+        self.assertEqual(np.vstack([v for _, v in out]).ravel().tolist(), list(range(40)))
+        self.assertEqual(failed, [3])
+
+
+class ReadPoolTests(DemandDBTestCase):
+    def test_reuses_read_only_connection(self):
+        pool = ReadPool()
+        with pool.connection(self.db_path) as con:
+            first = con
+            self.assertEqual(db_path_of(con), os.path.abspath(self.db_path))
+            with self.assertRaises(sqlite3.OperationalError):
+                con.execute("DELETE FROM chunks")
+        with pool.connection(self.db_path) as con:
+            self.assertIs(con, first)
+            rows = hybrid_search(con, "pagare", lambda q: self.vecs[2], rerank_k=1)
+        self.assertEqual(rows[0][0], 3)
+        self.assertEqual(pool.stats()["reused"], 1)
+        self.assertEqual(pool.close_idle(), 1)
+
+    def test_replaced_file_gets_fresh_connection(self):
+        pool = ReadPool()
+        with pool.connection(self.db_path) as con:
+            old = con
+        tmp_copy = self.db_path + ".new"
+        with sqlite3.connect(self.db_path) as src, sqlite3.connect(tmp_copy) as dst:
+            src.backup(dst)
+        os.replace(tmp_copy, self.db_path)
+        with pool.connection(self.db_path) as con:
+            self.assertIsNot(con, old)
+        self.assertEqual(pool.stats()["opened"], 2)
+
+
+class FederatedSearchTests(DemandDBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = os.path.join(self.tmp.name, "demand_2.db")
+        ensure_schema(self.other)
+        with sqlite3.connect(self.other) as con:
+            doc_id = insert_document(con, "otra.pdf")
+            insert_embedding(con, insert_chunk(con, doc_id, "pagare endosado", seq=0), self.vecs[9] + 0.01)
+
+    def test_merges_global_top_k_across_demands(self):
+        targets = [(1, self.db_path), (2, self.other), (3, os.path.join(self.tmp.name, "no_existe.db"))]
+        hits, report = federated_search(targets, "pagare", lambda q: self.vecs[9], k=2)
+        self.assertEqual([(h.demand_id, h.chunk_id) for h in hits], [(1, 10), (2, 1)])
+        self.assertEqual(sorted(report.searched), [1, 2])
+        self.assertIn(3, report.failed)
+
+    def test_early_termination_skips_pending_demands(self):
+        targets = [(i, self.db_path) for i in range(1, 40)]
+        hits, report = federated_search(targets, "pagare", lambda q: self.vecs[9], k=1, max_workers=1, min_score=0.9)
+        self.assertEqual(hits[0].chunk_id, 10)
+        self.assertGreater(len(report.skipped), 0)
+        self.assertEqual(len(report.searched) + len(report.skipped), 39)
+
+    def test_rrf_merges_demands_with_and_without_fts_match(self):
+        # demanda 2 no tiene coincidencia léxica (fallback denso), demanda 1 sí: antes el coseno del fallback
+        # le ganaba siempre a los scores RRF (~0.03); ahora ambas devuelven coseno
+        targets = [(2, self.other), (1, self.db_path)]
+        hits, _ = federated_search(targets, "cuota 12", lambda q: self.vecs[12], k=3, per_demand_k=2, mode="rrf")
+        self.assertEqual((hits[0].demand_id, hits[0].chunk_id), (1, 13))
+        self.assertAlmostEqual(hits[0].score, 1.0, places=5)
+        other = next(h for h in hits if h.demand_id == 2)
+        self.assertAlmostEqual(other.score, cosine_sim(self.vecs[12], self.vecs[9] + 0.01), places=5)
+        self.assertEqual([h.score for h in hits], sorted((h.score for h in hits), reverse=True))
+        targets = [(i, self.db_path) for i in range(1, 40)]
+        hits, report = federated_search(targets, "cuota 12", lambda q: self.vecs[12], k=1, max_workers=1,
+                                        min_score=0.9, mode="rrf")
+        self.assertEqual(hits[0].chunk_id, 13)
+        self.assertGreater(len(report.skipped), 0)
+
+
+class CorpusStoreTests(DemandDBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.corpus = os.path.join(self.tmp.name, "corpus.db")
+        self.assertEqual(import_demand_db(self.corpus, 7, self.db_path), 30)
+        self.assertEqual(import_demand_db(self.corpus, 8, self.db_path), 30)
+
+    def test_search_is_scoped_to_demand(self):
+        cache = MatrixCache()
+        for demand_id in (7, 8):
+            con = connect(self.corpus, demand_id)
+            rows = hybrid_search(con, "cuota", lambda q: self.vecs[4], rerank_k=3, mode="union")
+            self.assertEqual(rows[0][1], "pagare banco cuota 4")
+            ids = {cid for cid, _, _ in rows}
+            self.assertTrue(all((cid > 30) == (demand_id == 8) for cid in ids))
+            self.assertEqual(cache.get(con).matrix.shape, (30, 16))
+            con.close()
+        self.assertEqual(cache.stats()["entries"], 2)
+
+    def test_delete_and_reimport_invalidates_only_that_demand(self):
+        cache = MatrixCache()
+        con7, con8 = connect(self.corpus, 7), connect(self.corpus, 8)
+        first8 = cache.get(con8)
+        cache.get(con7)
+        self.assertEqual(drop_demand(self.corpus, 7), 30)
+        self.assertEqual(hybrid_search(con7, "cuota", lambda q: self.vecs[4]), [])
+        self.assertEqual(len(cache.get(con7).chunk_ids), 0)
+        self.assertIs(cache.get(con8), first8)
+        self.assertIsNotNone(rebuild_demand(self.corpus, 8))
+        self.assertEqual(len(hybrid_search(con8, "cuota", lambda q: self.vecs[4], rerank_k=40)), 30)
+        con7.close()
+        con8.close()
+
+    def test_snapshot_is_a_single_file_without_wal(self):
+        os.makedirs(os.path.join(self.tmp.name, "snap"))
+        out = snapshot_corpus(self.corpus, os.path.join(self.tmp.name, "snap", "corpus.db"))
+        self.assertFalse(os.path.exists(out + "-wal"))
+        con = connect(out, 8)
+        self.assertEqual(con.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+        self.assertEqual(len(hybrid_search(con, "cuota", lambda q: self.vecs[4], rerank_k=40)), 30)
+        con.close()
+
+
+class FTSExternalContentTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, "demand_1.db")
+        ensure_schema(self.db_path)
+        with sqlite3.connect(self.db_path) as con:
+            # base creada con el esquema anterior: chunks_fts con su propia copia del texto
+            con.execute("DROP TABLE chunks_fts")
+            con.execute(LEGACY_FTS_SQL)
+            doc_id = insert_document(con, "demanda.pdf")
+            for i in range(200):
+                insert_chunk(con, doc_id, f"pagare banco cuota {i} " + "intereses moratorios liquidacion " * 40, seq=i)
+        with sqlite3.connect(self.db_path) as con:
+            con.execute("VACUUM")
+            con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_migration_keeps_results_and_drops_text_copy(self):
+        with sqlite3.connect(self.db_path) as con:
+            before = topk_bm25(con, "cuota AND 17", 5)
+        self.assertTrue(migrate_fts(self.db_path))
+        self.assertFalse(migrate_fts(self.db_path))
+        with sqlite3.connect(self.db_path) as con:
+            self.assertEqual(fts_layout(con), "normalized")
+            self.assertEqual(get_meta(con)["fts_norm"], "es1")
+            self.assertEqual(topk_bm25(con, "cuota AND 17", 5), before)
+            cid = insert_chunk(con, 1, "embargo nuevo", seq=200)
+            self.assertEqual(topk_bm25(con, "embargo", 5), [(cid, "embargo nuevo")])
+            con.execute("INSERT INTO chunks_fts(chunks_fts, rank) VALUES('integrity-check', 1)")
+            self.assertIsNone(con.execute("SELECT 1 FROM sqlite_master WHERE name='chunks_fts_content'").fetchone())
+
+
+class SpanishFTSTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, "demand_1.db")
+        ensure_schema(self.db_path)
+        self.texts = [
+            "Demandado: Juan Pérez, RUT 12.345.678-K, adeuda $1.234.567 por pagarés impagos.",
+            "El tribunal notificó la resolución al ejecutado el 09/07/2024.",
+            "Los intereses moratorios se liquidarán conforme a la Ley N° 20.027.",
+        ]
+        with sqlite3.connect(self.db_path) as con:
+            doc_id = insert_document(con, "demanda.pdf")
+            self.ids = [insert_chunk(con, doc_id, t, seq=i) for i, t in enumerate(self.texts)]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _ids(self, query):
+        with sqlite3.connect(self.db_path) as con:
+            return [cid for cid, _ in topk_bm25(con, query, 5)]
+
+    def test_accents_plurals_and_numbers_match(self):
+        self.assertEqual(self._ids("pagare impago"), [self.ids[0]])
+        self.assertEqual(self._ids("notifico resoluciones"), [self.ids[1]])
+        self.assertEqual(self._ids("12345678-k"), [self.ids[0]])
+        self.assertEqual(self._ids("monto 1234567"), [])  # texto libre: AND implícito
+        self.assertEqual(sorted(self._ids('"1234567" OR "20027"')), [self.ids[0], self.ids[2]])
+        self.assertEqual(self._ids("9/7/2024"), [self.ids[1]])
+        self.assertEqual(self._ids("¿quiénes son los del?"), [])  # solo stopwords: sin consulta
+
+    def test_normalization_is_idempotent_and_keeps_fts_syntax(self):
+        for text in self.texts + ["intereses", "interés", "peces"]:
+            norm = normalize_for_fts(text)
+            self.assertEqual(normalize_for_fts(norm), norm)
+        self.assertEqual(normalize_fts_query('"Pagarés" OR cuotas*'), '"pagar" OR cuot*')
+        with sqlite3.connect(self.db_path) as con:
+            self.assertEqual(con.execute("SELECT content_norm FROM chunks WHERE id=?", (self.ids[2],)).fetchone()[0],
+                             normalize_for_fts(self.texts[2]))
+
+
+class BulkWriterTests(DemandDBTestCase):
+    def test_bulk_matches_rowwise_and_replaces_file(self):
+        tmp_db = os.path.join(self.tmp.name, "ingest", "demand_1.db")
+        ensure_schema(tmp_db)
+        with sqlite3.connect(tmp_db) as con:
+            writer = BulkWriter(con, flush_rows=7)  # varios flush: ids y documentos cruzan lotes
+            docs = [writer.add_document("a.pdf"), writer.add_document("b.pdf")]
+            for i, vec in enumerate(self.vecs):
+                writer.add_chunk(docs[i % 2], f"pagare banco cuota {i}", i, vec)
+                if i == 10:
+                    writer.add_document("vacio.pdf")
+            self.assertEqual(writer.finish(), 30)
+            self.assertEqual(con.execute("SELECT COUNT(*) FROM documents").fetchone()[0], 3)
+            con.execute("INSERT INTO chunks_fts(chunks_fts, rank) VALUES('integrity-check', 1)")
+        with sqlite3.connect(self.db_path) as con:
+            expected = hybrid_search(con, "pagare", lambda q: self.vecs[3], rerank_k=5)
+        install_db(tmp_db, self.db_path)
+        self.assertFalse(os.path.exists(tmp_db))
+        with sqlite3.connect(self.db_path) as con:
+            self.assertEqual(hybrid_search(con, "pagare", lambda q: self.vecs[3], rerank_k=5), expected)
+            self.assertEqual(con.execute("SELECT DISTINCT document_id FROM chunks WHERE seq % 2 = 1").fetchall(), [(2,)])
+
+    def test_truncated_vectors_accepted_at_codec_dim(self):
+        # float16/8 decodificado hacia una base int8/8: el vector ya viene truncado a la dim del codec
+        src = VectorCodec("float16", 8)
+        decoded = src.decode(pack_vec(self.vecs[0], src))
+        db = os.path.join(self.tmp.name, "int8", "demand_1.db")
+        ensure_schema(db, VectorCodec("int8", 8))
+        with sqlite3.connect(db) as con:
+            writer = BulkWriter(con, vector_codec(con), embedder=LocalEmbedder(dim=16))
+            doc = writer.add_document("3_0.pdf")
+            writer.add_chunk(doc, "pagare banco cuota 0", 0, decoded)
+            writer.add_chunk(doc, "pagare banco cuota 1", 1, self.vecs[1])
+            with self.assertRaises(EmbedderMismatch):
+                writer.add_chunk(doc, "pagare banco cuota 2", 2, self.vecs[2][:12])
+            self.assertEqual(writer.finish(), 2)
+
+
+class IncrementalIngestTests(DemandDBTestCase):
+    def test_carries_unchanged_folios(self):
+        pdfs = os.path.join(self.tmp.name, "pdfs")
+        os.makedirs(pdfs)
+        for name, body in (("3_0.pdf", b"folio tres"), ("5_1.pdf", b"folio cinco")):
+            with open(os.path.join(pdfs, name), "wb") as f:
+                f.write(body)
+        prev_db = os.path.join(self.tmp.name, "2026-01-01", "demand_1.db")
+        ensure_schema(prev_db)
+        with sqlite3.connect(prev_db) as con:
+            writer = BulkWriter(con)
+            for i, name in enumerate(("3_0.pdf", "5_1.pdf")):
+                doc = writer.add_document(name, document_meta(os.path.join(pdfs, name)))
+                writer.add_chunk(doc, f"pagare banco cuota {i}", 0, self.vecs[i])
+            writer.finish()
+        self.assertEqual(find_previous_db(self.tmp.name, 1), prev_db)
+
+        # el trámite nuevo corre la fila (3_0 -> 3_1) y el folio 5 cambió de contenido
+        os.rename(os.path.join(pdfs, "3_0.pdf"), os.path.join(pdfs, "3_1.pdf"))
+        with open(os.path.join(pdfs, "5_2.pdf"), "wb") as f:
+            f.write(b"folio cinco corregido")
+        os.remove(os.path.join(pdfs, "5_1.pdf"))
+        prev = open_previous(prev_db)
+        known = previous_documents(prev)
+        new_db = os.path.join(self.tmp.name, "new", "demand_1.db")
+        ensure_schema(new_db)
+        with sqlite3.connect(new_db) as con:
+            writer = BulkWriter(con)
+            metas = {n: document_meta(os.path.join(pdfs, n)) for n in ("3_1.pdf", "5_2.pdf")}
+            self.assertIsNone(known.get((metas["5_2.pdf"]["folio"], metas["5_2.pdf"]["sha256"])))
+            old_id = known[(metas["3_1.pdf"]["folio"], metas["3_1.pdf"]["sha256"])]
+            self.assertEqual(carry_documents(prev, writer, [(old_id, "3_1.pdf", metas["3_1.pdf"])]), 1)
+            writer.finish()
+            prev.close()
+            content, blob = con.execute(
+                "SELECT c.content, e.vector FROM chunks c JOIN embeddings e ON e.chunk_id = c.id").fetchone()
+            self.assertEqual(content, "pagare banco cuota 0")
+            np.testing.assert_array_equal(vector_codec(con).decode(blob), self.vecs[0])
+            self.assertEqual(len(topk_bm25(con, "cuota", 5)), 1)
+
+    def test_truncated_vectors_are_reembedded(self):
+        # la base anterior guardó vector_dim=8 (Matryoshka) y la nueva guarda los 16 completos del embedder
+        prev_db = os.path.join(self.tmp.name, "prev", "demand_1.db")
+        ensure_schema(prev_db, VectorCodec("float32", 8))
+        with sqlite3.connect(prev_db) as con:
+            writer = BulkWriter(con)
+            doc = writer.add_document("3_0.pdf", {"folio": "3", "sha256": "x"})
+            writer.add_chunk(doc, "pagare banco cuota 0", 0, self.vecs[0])
+            writer.finish()
+        embedder = LocalEmbedder(dim=16)
+        new_db = os.path.join(self.tmp.name, "new", "demand_1.db")
+        ensure_schema(new_db, VectorCodec("float32", 0))
+        prev = open_previous(prev_db)
+        with sqlite3.connect(new_db) as con:
+            writer = BulkWriter(con, embedder=embedder)
+            self.assertFalse(reusable_vectors(prev, writer))
+            doc = writer.add_document("3_0.pdf", {"folio": "3", "sha256": "x"})
+            items = [ChunkItem(doc, seq, content, span, blob, norm)
+                     for content, seq, norm, blob, span in carried_chunks(prev, writer, 1)]
+            prev.close()
+            self.assertEqual([it.vector for it in items], [None])
+            self.assertEqual(write_deduplicated(writer, items, embedder.embed)["embedded"], 1)
+            writer.finish()
+            blob = con.execute("SELECT vector FROM embeddings").fetchone()[0]
+            self.assertEqual(vector_codec(con).decode(blob).shape, (16,))
+
+    def test_format_only_change_keeps_truncated_vectors(self):
+        # solo cambia RAG_VECTOR_FORMAT (float16 -> int8) con RAG_VECTOR_DIM=8 en ambas: se reusan sin reembeber
+        prev_db = os.path.join(self.tmp.name, "prev", "demand_1.db")
+        ensure_schema(prev_db, VectorCodec("float16", 8))
+        with sqlite3.connect(prev_db) as con:
+            writer = BulkWriter(con, vector_codec(con))
+            doc = writer.add_document("3_0.pdf", {"folio": "3", "sha256": "x"})
+            writer.add_chunk(doc, "pagare banco cuota 0", 0, self.vecs[0])
+            writer.finish()
+        embedder = LocalEmbedder(dim=16)
+        new_db = os.path.join(self.tmp.name, "new", "demand_1.db")
+        ensure_schema(new_db, VectorCodec("int8", 8))
+        prev = open_previous(prev_db)
+        with sqlite3.connect(new_db) as con:
+            writer = BulkWriter(con, vector_codec(con), embedder=embedder)
+            self.assertTrue(reusable_vectors(prev, writer))
+            doc = writer.add_document("3_0.pdf", {"folio": "3", "sha256": "x"})
+            items = [ChunkItem(doc, seq, content, span, blob, norm)
+                     for content, seq, norm, blob, span in carried_chunks(prev, writer, 1)]
+            prev.close()
+            self.assertEqual(write_deduplicated(writer, items, embedder.embed)["embedded"], 0)
+            writer.finish()
+            blob = con.execute("SELECT vector FROM embeddings").fetchone()[0]
+            got = vector_codec(con).decode(blob)
+        self.assertEqual(got.shape, (8,))
+        self.assertGreater(cosine_sim(got, self.vecs[0][:8]), 0.99)
+
+
+class PdfExtractTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.files = [os.path.join(self.tmp.name, n) for n in ("1_0.pdf", "2_1.pdf", "roto.pdf", "3_2.pdf")]
+        _write_pdf(self.files[0], [f"demanda pagina {i}" for i in range(5)])
+        _write_pdf(self.files[1], ["resolucion"])
+        with open(self.files[2], "wb") as f:
+            f.write(b"%PDF-1.4 basura")
+        _write_pdf(self.files[3], ["notificacion uno", "notificacion dos"])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_pages_stream_in_order_across_workers(self):
+        # split_bytes=0: todos por tramos de 2 páginas, así el PDF de 5 páginas se reparte en 3 tareas
+        self.assertEqual([t[1:] for t in plan_tasks(self.files[:1], 0, 2)], [(0, 2), (2, 4), (4, 5)])
+        serial = list(iter_pdf_pages(self.files, workers=1, split_bytes=0, pages_per_task=2, ocr=False))
+        pooled = list(iter_pdf_pages(self.files, workers=3, split_bytes=0, pages_per_task=2, ocr=False))
+        self.assertEqual(pooled, serial)
+        self.assertEqual([(os.path.basename(p), i) for p, i, _ in serial][:6],
+                         [("1_0.pdf", 0), ("1_0.pdf", 1), ("1_0.pdf", 2), ("1_0.pdf", 3), ("1_0.pdf", 4), ("2_1.pdf", 0)])
+        self.assertIn("pagina 3", serial[3][2])
+
+    def test_texts_grouped_per_pdf(self):
+        out = list(iter_pdf_texts(self.files, workers=2, ocr=False))
+        self.assertEqual([p for p, _ in out], self.files)
+        self.assertEqual([len(pages) for _, pages in out], [5, 1, 0, 2])
+        self.assertIn("notificacion dos", out[3][1][1])
+
+    def test_daemon_process_extracts_serially(self):
+        import multiprocessing
+        out = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=_pages_in_daemon, args=(self.files, out), daemon=True)
+        proc.start()
+        got = out.get(timeout=60)
+        proc.join(10)
+        serial = [(os.path.basename(p), i, t) for p, i, t in iter_pdf_pages(self.files, workers=1, ocr=False)]
+        self.assertEqual(got, serial)
+
+    def test_timed_out_task_keeps_page_numbers(self):
+        # el segundo tramo (páginas 3-4) no responde: salen vacías y las siguientes no se corren
+        real_wait = pdf_extract._wait
+        def wait(fut, timeout, what):
+            return None if "páginas 3-4" in what else real_wait(fut, timeout, what)
+        with mock.patch.object(pdf_extract, "_wait", wait):
+            pages = list(iter_pdf_pages(self.files[:1], workers=2, split_bytes=0, pages_per_task=2, ocr=False))
+            out = dict(iter_pdf_texts(self.files, workers=2, split_bytes=0, pages_per_task=2, ocr=False))
+        self.assertEqual([i for _, i, _ in pages], [0, 1, 2, 3, 4])
+        self.assertEqual([t for _, i, t in pages if i in (2, 3)], ["", ""])
+        self.assertIn("pagina 4", pages[4][2])
+        first = out[self.files[0]]
+        self.assertEqual(len(first), 5)
+        self.assertIn("pagina 4", first[4])
+        self.assertEqual(len(out[self.files[3]]), 2)
+
+    def test_page_deadline(self):
+        with self.assertRaises(PageTimeout):
+            with _page_deadline(0.05):
+                time.sleep(2)
+
+    def test_ocr_blank_pages_once(self):
+        scan = os.path.join(self.tmp.name, "4_3.pdf")
+        _write_pdf(scan, ["caratula con texto suficiente para no pasar por OCR", "", ""])
+        with OcrCache(os.path.join(self.tmp.name, "ocr.db")) as cache:
+            first, second = ExtractMetrics(), ExtractMetrics()
+            pages = list(iter_pdf_pages([scan], workers=2, ocr_fn=_fake_ocr, ocr_cache=cache, metrics=first))
+            again = list(iter_pdf_pages([scan], workers=1, ocr_fn=_fake_ocr, ocr_cache=cache, metrics=second))
+        self.assertEqual(pages, again)
+        self.assertIn("caratula", pages[0][2])
+        # las dos páginas en blanco tienen el mismo hash: un solo OCR, y la segunda pasada sale del cache
+        self.assertEqual(pages[1][2], "escaneo folio 4_3.pdf pagina 1")
+        self.assertEqual(pages[2][2], pages[1][2])
+        self.assertEqual((first.ocr_pages, first.ocr_cache_hits), (1, 0))
+        self.assertEqual((second.ocr_pages, second.ocr_cache_hits), (0, 2))
+        self.assertEqual(second.summary()["pages"], 3)
+
+
+class ChunkerTests(SimpleTestCase):
+    PAGES = [
+        "EN LO PRINCIPAL: demanda ejecutiva; OTROSÍ: acompaña documentos.\n"
+        "BANCO DE CHILE, RUT 97.004.000-5, a US. respetuosamente digo:\n"
+        "1. Que el demandado suscribió un pagaré el 9 de julio de 2024. " + "El deudor no pagó la cuota pactada. " * 30 + "\n"
+        "2. Que la obligación es actualmente exigible.\n"
+        "POR TANTO, ruego a US. tener por interpuesta demanda ejecutiva y despachar mandamiento.\n"
+        "PRIMER OTROSÍ: Sírvase US. tener por acompañado el pagaré con citación.",
+        "Santiago, diez de julio de dos mil veinticuatro. A lo principal, despáchese mandamiento de ejecución.",
+    ]
+
+    def test_structure_pages_and_spans(self):
+        chunks = chunk_pages(self.PAGES, max_tokens=120, overlap_tokens=20)
+        doc = PAGE_SEP.join(self.PAGES)
+        for c in chunks:
+            self.assertEqual(doc[c.char_start:c.char_end], c.text)
+            self.assertLessEqual(len(c.text), 120 * 3)
+        self.assertTrue(chunks[0].text.startswith("EN LO PRINCIPAL"))
+        self.assertTrue(any(c.text.startswith("1. Que") for c in chunks))
+        self.assertTrue(any(c.text.startswith("POR TANTO") or c.text.startswith("2. Que") for c in chunks))
+        # la resolución de la página 2 no se mezcla con el escrito
+        self.assertEqual((chunks[-1].page, chunks[-1].page_end), (2, 2))
+        self.assertTrue(chunks[-1].text.startswith("Santiago"))
+        self.assertTrue(all(c.page == 1 for c in chunks[:-1]))
+
+    def test_spans_stored_and_added_to_old_dbs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = os.path.join(tmp, "demand_1.db")
+            with sqlite3.connect(db) as con:  # base anterior: chunks sin columnas de ubicación
+                con.execute("CREATE TABLE chunks (id INTEGER PRIMARY KEY, document_id INTEGER, content TEXT, seq INTEGER, "
+                            "content_norm TEXT)")
+            ensure_schema(db)
+            with sqlite3.connect(db) as con:
+                self.assertTrue(has_spans(con))
+                writer = BulkWriter(con)
+                doc = writer.add_document("/pdfs/3_1.pdf")
+                for seq, c in enumerate(chunk_pages(self.PAGES, max_tokens=120)):
+                    writer.add_chunk(doc, c.text, seq, np.ones(4, np.float32), span=(c.page, c.page_end, c.char_start, c.char_end))
+                n = writer.finish()
+                last = con.execute("SELECT id FROM chunks ORDER BY seq DESC LIMIT 1").fetchone()[0]
+                self.assertEqual(chunk_locations(con, [last]), {last: ("/pdfs/3_1.pdf", 2, 2)})
+                self.assertEqual(con.execute("SELECT COUNT(*) FROM chunks WHERE page IS NOT NULL").fetchone()[0], n)
+
+
+class DedupTests(SimpleTestCase):
+    NOTIF = ("Santiago, a {d} de julio de 2024, notifiqué por cédula a don Juan Pérez González, domiciliado en "
+             "calle Los Aromos 123, comuna de Providencia, la resolución de fecha 10 de julio de 2024 dictada en "
+             "causa rol C-1234-2024 caratulada Banco de Chile con Pérez, dejando copia íntegra de la misma.")
+
+    def test_near_duplicates_grouped(self):
+        texts = [
+            self.NOTIF.format(d=15),
+            "EN LO PRINCIPAL: demanda ejecutiva por pagaré suscrito por el demandado.",
+            self.NOTIF.format(d=15).upper(),  # mismo texto, otra capitalización/extracción
+            self.NOTIF.format(d=16),          # cambia una palabra: casi-duplicado
+            "POR TANTO, ruego a US. tener por interpuesta demanda ejecutiva y despachar mandamiento.",
+        ]
+        self.assertEqual(canonical_map(texts), [0, 1, 0, 0, 4])
+        self.assertEqual(canonical_map(texts, threshold=1.01), [0, 1, 2, 3, 4])
+
+    def test_occurrences_written_and_carried(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = os.path.join(tmp, "demand_1.db")
+            ensure_schema(db)
+            calls = []
+
+            def embed(texts):
+                calls.append(len(texts))
+                return np.ones((len(texts), 4), np.float32)
+            with sqlite3.connect(db) as con:
+                writer = BulkWriter(con, flush_rows=2)  # varios flush: apariciones antes de que su canónico se escriba
+                a, b = writer.add_document("1_0.pdf"), writer.add_document("2_1.pdf")
+                items = [ChunkItem(a, 0, self.NOTIF.format(d=15), (1, 1, 0, 250)),
+                         ChunkItem(a, 1, "EN LO PRINCIPAL: demanda ejecutiva por pagaré.", (1, 1, 251, 300)),
+                         ChunkItem(b, 0, self.NOTIF.format(d=16), (3, 3, 10, 260))]
+                stats = write_deduplicated(writer, items, embed)
+                writer.finish()
+                self.assertEqual((stats["canonical"], stats["duplicates"], stats["embedded"]), (2, 1, 2))
+                self.assertEqual(sum(calls), 2)
+                self.assertEqual(con.execute("SELECT COUNT(*) FROM chunks").fetchone()[0], 2)
+                self.assertEqual(con.execute("SELECT c.seq, o.document_id, o.seq, o.page FROM chunk_occurrences o "
+                                             "JOIN chunks c ON c.id = o.chunk_id").fetchall(), [(0, 2, 0, 3)])
+            # la reingesta incremental reconstruye el documento 2 completo a partir de la aparición
+            prev = open_previous(db)
+            try:
+                self.assertEqual(len(previous_documents(prev)), 0)  # sin sha256: no se copian
+                rows = list(carried_chunks(prev, writer, 2))
+            finally:
+                prev.close()
+            self.assertEqual([(r[0], r[1], r[4]) for r in rows], [(self.NOTIF.format(d=15), 0, [3, 3, 10, 260])])
+
+class RetrievalBenchTests(SimpleTestCase):
+    def test_synthetic_run_and_json(self):
+        rows = bench.bench_retrieval_synthetic([300], n_questions=20, k=5, dim=64,
+                                               traces=[("¿Cuánto adeuda el demandado?", None)])
+        self.assertEqual([r["set"] for r in rows], ["synthetic", "traces_latency"])
+        r = rows[0]
+        self.assertEqual((r["chunks"], r["questions"]), (300, 20))
+        self.assertEqual(set(r["quality"]), {"bm25", "union", "rrf"})
+        self.assertGreater(r["quality"]["rrf"]["recall@5"], 0.3)
+        self.assertEqual(set(r["latency"]), {"embed", "bm25", "dense", "search_bm25", "search_union", "search_rrf"})
+        self.assertEqual(set(r["latency"]["bm25"]), {"p50_ms", "p95_ms", "p99_ms"})
+        with tempfile.TemporaryDirectory() as tmp:
+            path = bench.write_results({"results": rows}, os.path.join(tmp, "out", "r.json"))
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        self.assertEqual(data["results"][0]["quality"], r["quality"])
+        self.assertIn("commit", data)
+
+    def test_trace_labels(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = os.path.join(tmp, "demand_1.db")
+            texts = ["Juan Pérez adeuda la suma de $1.500.000 al Banco Estado.", "Se notificó por cédula al demandado."]
+            ids = bench.build_synthetic_db(db, texts, bench.local_embedder(16))
+            with sqlite3.connect(db) as con:
+                labels = bench.trace_labels(con, [("¿Cuánto adeuda Juan Pérez?", "Adeuda $1.500.000 al Banco Estado."),
+                                                  ("¿Quién notificó?", None)])
+        self.assertEqual([(l["question"], l["relevant"]) for l in labels], [("¿Cuánto adeuda Juan Pérez?", [ids[0]])])
+
+class EmbedderRegistryTests(SimpleTestCase):
+    def test_local_embedder_deterministic(self):
+        emb = get_embedder("local", dim=64)
+        a = emb.embed(["Juan Pérez adeuda $1.000.000", "embargo de bienes"])
+        b = LocalEmbedder(dim=64).embed(["JUAN PEREZ adeuda $1000000", "embargo de bienes"])
+        self.assertEqual(a.shape, (2, 64))
+        self.assertTrue(np.allclose(a, b))  # misma normalización que el FTS: tildes, mayúsculas, miles
+        self.assertAlmostEqual(float(np.linalg.norm(a[0])), 1.0, places=5)
+        self.assertIs(embedder_from_meta(emb.as_meta()).__class__, LocalEmbedder)
+        with self.assertRaises(ValueError):
+            get_embedder("nope")
+
+    def test_meta_recorded_and_mismatch_rejected(self):
+        local = get_embedder("local", dim=16)
+        with tempfile.TemporaryDirectory() as tmp:
+            db = os.path.join(tmp, "demand_1.db")
+            ensure_schema(db)
+            with sqlite3.connect(db) as con:
+                writer = BulkWriter(con, embedder=local)
+                doc = writer.add_document("1_1.pdf")
+                writer.add_chunk(doc, "pagaré suscrito por el demandado", 0, local.embed(["pagaré"])[0])
+                with self.assertRaises(EmbedderMismatch):
+                    writer.add_chunk(doc, "otro", 1, np.ones(8, np.float32))  # otra dimensión
+                writer.finish()
+                self.assertEqual(embedder_for(con).model, local.model)
+                other = get_embedder("local", dim=32)
+                with self.assertRaises(EmbedderMismatch):
+                    w2 = BulkWriter(con, embedder=other)
+                    w2.add_chunk(w2.add_document("2_1.pdf"), "texto", 0, other.embed(["texto"])[0])
+                    w2.finish()
+                rows = hybrid_search(con, "pagaré", lambda q: embedder_for(con).embed([q])[0], mode="union")
+            self.assertEqual(len(rows), 1)
+            # sin registro y con vectores: base anterior al registro, se asume OpenAI
+            legacy = os.path.join(tmp, "demand_2.db")
+            ensure_schema(legacy)
+            with sqlite3.connect(legacy) as con:
+                insert_embedding(con, insert_chunk(con, insert_document(con, "a.pdf"), "x", 0), np.ones(4, np.float32))
+                self.assertEqual(embedder_for(con).name, "openai")
+                with self.assertRaises(EmbedderMismatch):
+                    record_embedder(con, local)
+
+    def test_query_embedder_uses_model(self):
+        local = get_embedder("local", dim=16)
+        qe = QueryEmbedder(local, ttl=0)
+        self.assertEqual(qe.model, local.model)
+        self.assertEqual(qe("hola mundo").shape, (16,))
+
+class SnippetTests(SimpleTestCase):
+    BOILER = ("Santiago, a quince de julio de dos mil veinticuatro. A lo principal, téngase presente. Al otrosí, "
+              "por acompañados los documentos, con citación. Notifíquese por el estado diario. ")
+
+    def test_window_at_end_of_chunk(self):
+        text = self.BOILER * 4 + "El demandado adeuda la suma de $1.500.000 por concepto de capital del pagaré."
+        out = best_snippet(text, "¿Cuánto adeuda el demandado por el pagaré?", 200)
+        self.assertIn("$1.500.000", out)
+        self.assertTrue(out.startswith(ELLIPSIS))
+        self.assertLessEqual(len(out), 202)
+
+    def test_short_and_unmatched_text(self):
+        self.assertEqual(best_snippet("Texto breve.", "pagaré", 200), "Texto breve.")
+        out = best_snippet(self.BOILER * 4, "hipoteca", 120)
+        self.assertTrue(self.BOILER.startswith(out[:-1].strip()))  # sin coincidencias: el comienzo, como antes
+        self.assertTrue(out.endswith(ELLIPSIS))
+
+    def test_long_sentence_split(self):
+        text = " ".join(["palabra"] * 300) + " embargo del inmueble inscrito " + " ".join(["palabra"] * 300)
+        start, end = best_window(text, "embargo inmueble", 150)
+        self.assertLessEqual(end - start, 150)
+        self.assertIn("embargo", text[start:end])
+
+class ContextPackTests(SimpleTestCase):
+    def _db(self, tmp, chunks):
+        db = os.path.join(tmp, "demand_1.db")
+        ensure_schema(db)
+        with sqlite3.connect(db) as con:
+            writer = BulkWriter(con)
+            docs = {}
+            for path, seq, text, span in chunks:
+                if path not in docs:
+                    docs[path] = writer.add_document(path)
+                writer.add_chunk(docs[path], text, seq, np.ones(4, np.float32), span=span)
+            writer.finish()
+        return db
+
+    def test_dedupe_merge_and_strip_overlap(self):
+        doc = "EN LO PRINCIPAL: demanda ejecutiva. El demandado suscribió un pagaré por $1.500.000 a favor del banco."
+        a, b = doc[:60], doc[40:]  # 20 caracteres de solape
+        with tempfile.TemporaryDirectory() as tmp:
+            db = self._db(tmp, [("3_1.pdf", 0, a, (1, 1, 0, 60)), ("3_1.pdf", 1, b, (1, 2, 40, len(doc))),
+                                ("4_1.pdf", 0, "Resolución que provee la demanda.", (1, 1, 0, 33))])
+            with sqlite3.connect(db) as con:
+                hits = [(1, a, 0.5), (3, "Resolución que provee la demanda.", 0.9), (2, b, 0.7), (1, a, 0.8)]
+                blocks = pack_context(con, hits, "pagaré demandado", max_tokens=1000)
+        self.assertEqual([blk.chunk_ids for blk in blocks], [[3], [1, 2]])
+        self.assertEqual(blocks[1].text, doc)
+        self.assertAlmostEqual(blocks[1].score, 0.8)
+        self.assertIn("[chunk:1,2 score=0.800 doc=3_1.pdf p.1-2]", render_context(blocks))
+
+    def test_budget_and_exclude(self):
+        texts = [f"Texto del escrito número {i} sobre el embargo de bienes del demandado. " * 6 for i in range(6)]
+        with tempfile.TemporaryDirectory() as tmp:
+            db = self._db(tmp, [(f"{i}_1.pdf", 0, t, None) for i, t in enumerate(texts)])
+            with sqlite3.connect(db) as con:
+                hits = [(i + 1, t, 1.0 - i / 10) for i, t in enumerate(texts)]
+                blocks = pack_context(con, hits, "embargo", max_tokens=300, snippet_chars=2000)
+                self.assertLessEqual(sum(estimate_tokens(b.header()) + 2 + estimate_tokens(b.text) for b in blocks), 300)
+                self.assertEqual(blocks[0].chunk_ids, [1])
+                again = pack_context(con, hits, "embargo", max_tokens=300, exclude={b.chunk_ids[0] for b in blocks})
+        self.assertFalse({b.chunk_ids[0] for b in blocks} & {b.chunk_ids[0] for b in again})
+
+
+CASE_FILING = """PROCEDIMIENTO: EJECUTIVO
+MATERIA: COBRO DE PAGARÉ
+DEMANDANTE: BANCO DEL ESTADO DE CHILE
+RUT: 97.030.000-7
+ABOGADO PATROCINANTE Y APODERADO: MARÍA SOTO
+RUT: 11.111.111-1
+DEMANDADO: JUAN PÉREZ GONZÁLEZ, RUT 12.345.678-k, domiciliado en Santiago
+CUANTÍA: $ 5.000.000
+
+EN LO PRINCIPAL: demanda ejecutiva.
+Que con fecha 15 de marzo de 2023 el demandado suscribió un pagaré por la suma de $ 4.800.000, más intereses
+de $ 200.000, con vencimiento el 01/06/2023.
+"""
+CASE_DETALLE = [
+    {"folio": "2", "etapa": "Excepciones", "tramite": "Escrito", "desctramite": "Opone excepciones", "foja": "5"},
+    {"folio": "1", "etapa": "Ingreso", "tramite": "Resolución", "desctramite": "Despáchese mandamiento 20/07/2023"},
+]
+
+
+class CaseCardTests(DemandDBTestCase):
+    def test_build_from_filing_and_detalle(self):
+        card = build_case_card(CASE_FILING, CASE_DETALLE, title="Causa C-1-2023", source="/tmp/demanda.pdf")
+        partes = {p["rol"]: (p["nombre"], p["rut"]) for p in card["partes"]}
+        self.assertEqual(partes["demandante"], ("BANCO DEL ESTADO DE CHILE", "97.030.000-7"))
+        self.assertEqual(partes["demandado"], ("JUAN PÉREZ GONZÁLEZ", "12.345.678-K"))
+        self.assertEqual(card["monto_demandado"], {"moneda": "CLP", "valor": 5000000})  # la cuantía manda
+        self.assertEqual(card["fechas"], ["2023-03-15", "2023-06-01"])
+        self.assertEqual([t["folio"] for t in card["tramites"]], ["1", "2"])
+        self.assertEqual(card["tramites"][0]["fecha"], "2023-07-20")
+        self.assertEqual(card["etapa"], "Excepciones")
+        text = render_case_card(card)
+        self.assertTrue(text.startswith("[ficha de la causa]"))
+        self.assertIn("Monto demandado: $5.000.000", text)
+        self.assertIsNone(build_case_card("", None))
+        # sin detalle: se conservan los trámites de la ficha anterior
+        self.assertEqual(build_case_card(CASE_FILING, None, tramites=card["tramites"])["etapa"], "Excepciones")
+
+    def test_direct_answers_only_narrow_questions(self):
+        card = build_case_card(CASE_FILING, CASE_DETALLE)
+        self.assertIn("12.345.678-K", answer_from_card(card, "¿Quiénes son las partes?"))
+        self.assertEqual(answer_from_card(card, "¿Cuál es el monto demandado?"), "Monto demandado: $5.000.000.")
+        self.assertIn("Opone excepciones", answer_from_card(card, "¿Cuál fue el último trámite?"))
+        self.assertIsNone(answer_from_card(card, "¿Por qué el demandado no pagó el pagaré?"))
+        self.assertIsNone(answer_from_card(card, "¿Cuánto se demanda y por qué?"))
+        self.assertIsNone(answer_from_card(card, "¿Quién es el demandado y cuál es su domicilio?"))
+        self.assertIsNone(answer_from_card(card, "¿quién es el demandado y por qué lo demandan?"))
+        self.assertIsNone(answer_from_card(card, "¿quién demanda y cuánto pide?"))
+        self.assertIsNone(answer_from_card(None, "¿En qué etapa está la causa?"))
+        # solo la pregunta entera: una precisión al final ya no la responde la ficha
+        for q in ("¿Cuánto debe pagar en costas?", "¿Cuánto se debe hoy después del abono de 2024?",
+                  "¿Cuál fue la última resolución sobre la excepción de prescripción?",
+                  "¿En qué etapa quedó el incidente de nulidad?", "¿Contra quién se dirige la tercería?"):
+            self.assertIsNone(card_intent(q), q)
+        for q, intent in (("¿En qué etapa está la causa?", "etapa"), ("¿Cuál es el estado procesal actual?", "etapa"),
+                          ("¿Cuánto se debe?", "monto"), ("¿Contra quién se dirige la demanda?", "partes"),
+                          ("¿Cuál es la última resolución de la causa?", "ultimo_tramite")):
+            self.assertEqual(card_intent(q), intent, q)
+
+    def test_stored_per_demand_and_copied_to_corpus(self):
+        card = build_case_card(CASE_FILING, CASE_DETALLE)
+        with sqlite3.connect(self.db_path) as con:
+            self.assertIsNone(load_case_card(con))
+            save_case_card(con, 7, card)
+        with sqlite3.connect(self.db_path) as con:
+            self.assertEqual(load_case_card(con), card)
+        corpus = os.path.join(self.tmp.name, "corpus.db")
+        import_demand_db(corpus, 7, self.db_path)
+        import_demand_db(corpus, 8, self.db_path)
+        con = connect(corpus, 8)
+        self.assertEqual(load_case_card(con)["etapa"], "Excepciones")
+        con.close()
+        drop_demand(corpus, 7)
+        con7, con8 = connect(corpus, 7), connect(corpus, 8)
+        self.assertIsNone(load_case_card(con7))
+        self.assertIsNotNone(load_case_card(con8))
+        con7.close()
+        con8.close()
@@ -1,4 +1,5 @@
-from openai import OpenAI, BadRequestError
+from openai import BadRequestError
+from civil.lib.openai_clients import get_client, DEFAULT_ENDPOINT
 import time
 import json
 from datetime import datetime
@@ -10,12 +11,12 @@ import logging
 OPENAI_API_KEY  = os.getenv("OPENAI_API_KEY", None)
 ASSISTANT_ID    = os.getenv("ASSISTANT_ID", None)
 
-client  = OpenAI(api_key=OPENAI_API_KEY)
 tools   = load_tools_config()
 
 logger  = logging.getLogger('mcp')
 
 def send_message(messages, functions=None, assistant_id=None):
+    client = get_client(OPENAI_API_KEY, DEFAULT_ENDPOINT)  # siempre api.openai.com: OPENAI_BASE_URL es para embeddings/RAG
     respuesta = client.chat.completions.create(
         #model="gpt-3.5-turbo",  # Usamos GPT-3.5 para este ejemplo
         model="gpt-4",
@@ -34,6 +35,7 @@ class DateTimeEncoder(json.JSONEncoder):
         return super(DateTimeEncoder, self).default(obj)
 
 def send_message_with_assistant(request, messages, functions, progress_key):
+    client = get_client(OPENAI_API_KEY, DEFAULT_ENDPOINT)
     try:
         # Revisa si ya existe un thread en la sesión
         thread_id = request.session.get("openai_thread_id")
@@ -54,6 +54,24 @@ def upload_file_to_azure_file_share(
     print(f"✅ Archivo subido correctamente a: {share_name}/{remote_file_path}")
 
 
+def replace_file_in_azure_file_share(
+    connection_string: str,
+    share_name: str,
+    local_file_path: str,
+    remote_file_path: str,
+):
+    """
+    Sube a <remote_file_path>.tmp y luego renombra sobre remote_file_path: quien lee el archivo
+    (p.ej. el corpus SQLite) nunca ve una subida a medias.
+    """
+    tmp_remote = f"{remote_file_path}.tmp"
+    upload_file_to_azure_file_share(connection_string, share_name, local_file_path, tmp_remote)
+    service_client = ShareServiceClient.from_connection_string(connection_string)
+    file_client = service_client.get_share_client(share_name).get_file_client(tmp_remote)
+    file_client.rename_file(remote_file_path, overwrite=True)
+    print(f"✅ Archivo reemplazado en: {share_name}/{remote_file_path}")
+
+
 if __name__ == "__main__":
     # Ejemplo de uso
     try:
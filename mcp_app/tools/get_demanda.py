@@ -2,17 +2,23 @@ from civil.lib.causas import ConsultaCausas
 from civil.models import Competencia, Corte, Tribunal, Causa, LibroTipo
 import logging, traceback
 from django.conf import settings
+from django.core.cache import cache
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from typing import Dict, Any, List
 from pjud.celeryy import app
 from datetime import datetime, timedelta
-import os
+import os, shutil, tempfile, time
 from pathlib import Path
 from chatbot.services.progress import new_progress, set_state, get_state
 
 logger = logging.getLogger('mcp_app')
 
+# RAG_STORE=corpus: espera antes de publicar la copia del corpus tras una ingesta (las que lleguen entretanto se suman)
+RAG_CORPUS_PUBLISH_DELAY = int(os.getenv("RAG_CORPUS_PUBLISH_DELAY", "300"))
+CORPUS_PUBLISH_KEY = "rag:corpus:publish_pending"
+CORPUS_PUBLISHED_AT_KEY = "rag:corpus:published_at"
+
 def send_step(user_id, message):
     channel_layer = get_channel_layer()
     async_to_sync(channel_layer.group_send)(
@@ -180,6 +186,58 @@ def execute(arguments: Dict[str, Any]) -> Dict[str, Any]:
         logger.error(traceback.format_exc())
         return {"status": "error", "message": str(e)}
 
+def schedule_corpus_publish() -> None:
+    """Programa publish_corpus si no hay uno pendiente: las ingestas de la ventana comparten una sola publicación."""
+    try:
+        if cache.add(CORPUS_PUBLISH_KEY, 1, RAG_CORPUS_PUBLISH_DELAY * 2 + 600):
+            publish_corpus.apply_async(countdown=RAG_CORPUS_PUBLISH_DELAY)
+    except Exception as e:
+        logger.error(f"Error al programar la publicación del corpus: {e}")
+
+@app.task
+def publish_corpus() -> Dict[str, Any]:
+    """
+    Publica en el share una copia consistente del corpus (backup sin -wal) que reemplaza a la anterior con un rename,
+    más los índices ANN (corpus.d<id>.ivf.npz) escritos desde la publicación anterior.
+    Corre en el host escritor (misma cola que get_demanda); cuesta O(corpus), por eso va diferida y no por ingesta.
+    """
+    from civil.rag.corpus_store import corpus_path, snapshot_corpus
+    from civil.rag.bulk_writer import RAG_INGEST_TMP
+    from civil.rag.sqlite_db import RAG_CORPUS_FILE
+    from mcp_app.lib.azure_utils import replace_file_in_azure_file_share, upload_file_to_azure_file_share
+    # se libera antes de copiar: una ingesta que termine durante la copia programa la siguiente publicación
+    cache.delete(CORPUS_PUBLISH_KEY)
+    started = time.time()
+    since = cache.get(CORPUS_PUBLISHED_AT_KEY, 0)
+    local = Path(corpus_path())
+    snap_dir = tempfile.mkdtemp(prefix="corpus_snapshot_", dir=RAG_INGEST_TMP)
+    try:
+        snapshot = snapshot_corpus(str(local), os.path.join(snap_dir, os.path.basename(RAG_CORPUS_FILE)))
+        logger.info(f"Publicando corpus en Azure File Share: {RAG_CORPUS_FILE}")
+        replace_file_in_azure_file_share(
+            connection_string=os.getenv("AZURE_STORAGE_CONNECTION_STRING"),
+            share_name=os.getenv("AZURE_FILE_SHARE_NAME"),
+            local_file_path=snapshot,
+            remote_file_path=RAG_CORPUS_FILE
+        )
+        # índices ANN después del corpus: uno más nuevo que la copia publicada solo tendría ids que aún no están
+        indexes = [p for p in local.parent.glob(f"{local.stem}.d*.ivf.npz") if p.stat().st_mtime >= since]
+        for ann in indexes:
+            upload_file_to_azure_file_share(
+                connection_string=os.getenv("AZURE_STORAGE_CONNECTION_STRING"),
+                share_name=os.getenv("AZURE_FILE_SHARE_NAME"),
+                local_file_path=ann,
+                remote_file_path=os.path.join(os.path.dirname(RAG_CORPUS_FILE), ann.name)
+            )
+        cache.set(CORPUS_PUBLISHED_AT_KEY, started, None)
+        return {"status": "success", "message": f"Corpus publicado en {RAG_CORPUS_FILE} ({len(indexes)} índices ANN)"}
+    except Exception as e:
+        logger.error(f"Error al publicar el corpus en Azure File Share: {e}")
+        logger.error(traceback.format_exc())
+        return {"status": "error", "message": str(e)}
+    finally:
+        shutil.rmtree(snap_dir, ignore_errors=True)
+
 @app.task
 def update_demanda(task_id: str, data: Dict[str, Any], status: str) -> Dict[str, Any]:
     try:
@@ -306,31 +364,51 @@ def get_demanda(task_id: str, causa_id: int, user_id: int = None, data: Dict[str
             "pdf_dir": str(download_dir),
             "create_if_missing": True,
             "created_by": user_id,
-            "chunk_size": 1200,
-            "overlap": 150,
             "batch": 64,
+            "detalle": table_detalle,  # trámites para la ficha de la causa
         }
 
         ingest_demand(None, **options)
 
         # upload sqlite to azure
         from mcp_app.lib.azure_utils import upload_file_to_azure_file_share
+        from civil.rag.ann import ann_path
+        from civil.rag.sqlite_db import RAG_STORE
 
         date_yyyymmdd = datetime.now().strftime("%Y-%m-%d") # create directory per day
 
         local_db_path = Path(os.getenv("SQLITE_LOCAL_PATH")) / date_yyyymmdd / f"demand_{causa.id}.db"
         
-        try:
-            logger.info(f"Subiendo archivo a Azure File Share: {local_db_path}")
-            upload_file_to_azure_file_share(
-                connection_string=os.getenv("AZURE_STORAGE_CONNECTION_STRING"),
-                share_name=os.getenv("AZURE_FILE_SHARE_NAME"),
-                local_file_path=local_db_path,
-                remote_file_path=f"{date_yyyymmdd}/demand_{causa.id}.db"
-            )
-        except Exception as e:
-            logger.error(f"Error al subir archivo a Azure File Share: {e}")
-            traceback.print_exc()
+        if RAG_STORE == "corpus":
+            # el corpus se escribe en SQLITE_LOCAL_PATH (WAL: un solo host escritor, nunca sobre el share SMB);
+            # la copia para los lectores (corpus e índices ANN de las demandas nuevas) se publica en diferido
+            schedule_corpus_publish()
+        else:
+            try:
+                logger.info(f"Subiendo archivo a Azure File Share: {local_db_path}")
+                upload_file_to_azure_file_share(
+                    connection_string=os.getenv("AZURE_STORAGE_CONNECTION_STRING"),
+                    share_name=os.getenv("AZURE_FILE_SHARE_NAME"),
+                    local_file_path=local_db_path,
+                    remote_file_path=f"{date_yyyymmdd}/demand_{causa.id}.db"
+                )
+            except Exception as e:
+                logger.error(f"Error al subir archivo a Azure File Share: {e}")
+                traceback.print_exc()
+
+            # índice ANN (demand_<id>.ivf.npz) junto a la base; opcional, rag_query cae a escaneo exacto si falta
+            local_ann_path = Path(ann_path(str(local_db_path)))
+            if local_ann_path.exists():
+                try:
+                    upload_file_to_azure_file_share(
+                        connection_string=os.getenv("AZURE_STORAGE_CONNECTION_STRING"),
+                        share_name=os.getenv("AZURE_FILE_SHARE_NAME"),
+                        local_file_path=local_ann_path,
+                        remote_file_path=f"{date_yyyymmdd}/{local_ann_path.name}"
+                    )
+                except Exception as e:
+                    logger.error(f"Error al subir índice ANN a Azure File Share: {e}")
+                    traceback.print_exc()
 
         logger.info(f"Tarea get_demanda {task_id} completada para RIT {RIT}. Actualizando estado a 'ready'.")
 
@@ -1,7 +1,7 @@
 # =========================
 # MCP tool interface
 # =========================
-import os, sqlite3, textwrap, re, logging, time, json, uuid
+import os, sqlite3, textwrap, logging, time, json, uuid
 from typing import Dict, Any, List
 import numpy as np
 from dotenv import load_dotenv
@@ -10,9 +10,17 @@ import django
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "server.settings")
 django.setup()
 from civil.models import Causa
-from civil.rag.sqlite_db import hybrid_search
+from civil.rag.sqlite_db import hybrid_search, SEARCH_MODES, is_corpus_path, fts_layout, embedder_for
+from civil.rag.text_norm import normalize_for_fts
+from civil.rag.snippets import RAG_SNIPPET_CHARS, RAG_MORE_SNIPPET_CHARS
+from civil.rag.context_pack import pack_context, render_context, RAG_CONTEXT_TOKENS, RAG_MORE_CONTEXT_TOKENS, BLOCK_SEP
+from civil.rag.case_card import load_case_card, render_case_card, answer_from_card, RAG_CASE_CARD, RAG_CASE_CARD_DIRECT
+from civil.rag.embed_batcher import estimate_tokens
 from civil.rag.utils_embed import embed_texts
-from openai import OpenAI
+from civil.rag.matrix_cache import matrix_cache
+from civil.rag.query_cache import QueryEmbedder
+from civil.rag.conn_pool import read_pool
+from civil.lib.openai_clients import get_client
 import datetime as dt
 import logging
 
@@ -22,66 +30,67 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
 OPENAI_CHAT_MODEL = os.getenv("OPENAI_CHAT_MODEL", "gpt-4o-mini")
+RAG_SEARCH_MODE = os.getenv("RAG_SEARCH_MODE", "union")  # "bm25" | "union" (BM25 ∪ ANN) | "rrf" (fusión de rankings)
 logger = logging.getLogger("mcp_app.tools.rag_query")
 
 SYSTEM_PROMPT = """Eres un abogado analista de textos judiciales.\nSi el contexto es suficiente, responde con:\nFINAL_ANSWER: <tu respuesta concluyente y breve>\n\nSi NO es suficiente, responde SOLO con:\nNEED_MORE_CONTEXT: <hasta 3 consultas o palabras clave concretas separadas por punto y coma>\n\nCuando debas pedir más contexto, en NEED_MORE_CONTEXT usa solo palabras clave limpias (sin puntos, guiones ni signos), en minúsculas, sin fechas ni RUTs.\nEjemplos válidos: \"pagare; ley 20027; banco internacional\"\nEjemplos inválidos: \"97.011.000-3; Ley 20.027; EN LO PRINCIPAL:\"\n"""
-FTS_SAFE_CHARS = r"0-9A-Za-zÁÉÍÓÚÜÑáéíóúüñ"
 
 def _client():
-    return OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL) if OPENAI_BASE_URL else OpenAI(api_key=OPENAI_API_KEY)
+    return get_client(OPENAI_API_KEY, OPENAI_BASE_URL)
 
 def embed_query(q: str):
     return embed_texts([q])[0]
 
 def fts_sanitize(q: str) -> str:
-    q2 = re.sub(fr"[^{FTS_SAFE_CHARS}]+", " ", q or "")
-    q2 = " ".join(q2.split())
-    return q2
+    # misma normalización que chunks.content_norm: sin signos, tildes ni stopwords, con stem liviano y RUT/números canónicos
+    return normalize_for_fts(q or "")
 
 def fts_prefixify(q: str) -> str:
     toks = q.split()
     return " ".join(f"{t}*" for t in toks)
 
-def _more_context(con, demand_id: int, query_text: str, k: int = 4) -> str:
-    t0 = time.perf_counter()
+def _context_rows(con, query_text: str, k: int = 4, strategy: str = RAG_SEARCH_MODE, embed_fn=embed_query,
+                  fts_query: str = None) -> list:
+    # fts_query: consulta FTS ya armada (seed con prefijos); query_text es lo que se embebe
     q_orig = (query_text or "").strip()
-    q_safe = fts_sanitize(q_orig)
-    logger.debug("[CTX] more_context original_q='%s' safe_q='%s'", q_orig, q_safe)
+    q_safe = fts_query or fts_sanitize(q_orig)
+    logger.debug("[CTX] context_rows original_q='%s' safe_q='%s'", q_orig, q_safe)
     if not q_safe:
         logger.debug("[CTX] Consulta vacía tras sanitizar; no agrego contexto.")
-        return ""
+        return []
+    if strategy == "rrf":
+        # rrf arma su propia consulta FTS segura y cae a búsqueda densa: no necesita reintentos
+        rows = hybrid_search(con, q_orig, embed_fn, rerank_k=k, mode="rrf", fts_query=q_safe)
+        logger.debug("[CTX] hybrid_search rrf rows=%d (q_safe='%s')", len(rows or []), q_safe)
+        return rows or []
     try:
-        rows = hybrid_search(con, q_safe, embed_texts, rerank_k=k)
+        rows = hybrid_search(con, q_orig, embed_fn, rerank_k=k, mode=strategy, fts_query=q_safe)
         logger.debug("[CTX] hybrid_search rows=%d (q_safe='%s')", len(rows or []), q_safe)
     except sqlite3.OperationalError as e:
         logger.warning("[CTX] FTS error con q_safe='%s': %s. Intento fallback con prefijo.", q_safe, e)
         q_safe2 = fts_prefixify(q_safe)
         try:
-            rows = hybrid_search(con, q_safe2, embed_texts, rerank_k=k)
+            rows = hybrid_search(con, q_orig, embed_fn, rerank_k=k, mode=strategy, fts_query=q_safe2)
             logger.debug("[CTX] hybrid_search (fallback) rows=%d (q_safe2='%s')", len(rows or []), q_safe2)
         except sqlite3.OperationalError as e2:
             logger.error("[CTX] FTS fallo incluso con fallback q_safe2='%s': %s", q_safe2, e2)
-            return ""
-    if not rows:
-        logger.debug("[CTX] Sin filas de contexto para q='%s'", q_safe)
-        return ""
-    parts = []
-    for idx, r in enumerate(rows):
-        try:
-            cid, content, score = r
-        except Exception:
-            cid, content = r[0], r[1]
-            score = -1.0
-        snippet = (content or "")[:1200]
-        parts.append(f"[chunk:{cid} score={score:.3f}]\n{snippet}")
-        if idx < 5:
-            logger.debug("[CTX] +chunk id=%s score=%.3f len=%d", cid, score, len(snippet))
-    ctx = "\n---\n".join(parts)
-    t1 = time.perf_counter()
-    logger.info("[CTX] Contexto agregado (%d chunks, %.1f KB) en %.3fs", len(parts), len(ctx)/1024.0, t1 - t0)
+            return []
+    return rows or []
+
+def _pack(con, rows: list, query_text: str, max_tokens: int, snippet_chars: int, sent: set) -> str:
+    # sin repetidos (ni de rondas anteriores: sent), vecinos unidos y sin solape, hasta max_tokens por score
+    t0 = time.perf_counter()
+    blocks = pack_context(con, rows, query_text, max_tokens=max_tokens, snippet_chars=snippet_chars, exclude=sent)
+    for b in blocks:
+        sent.update(b.chunk_ids)
+    ctx = render_context(blocks)
+    logger.info("[CTX] Contexto armado (%d filas -> %d bloques, %.1f KB) en %.3fs", len(rows), len(blocks),
+                len(ctx) / 1024.0, time.perf_counter() - t0)
     return ctx
 
-def _chat_until_conclusive(client, messages, con, demand_id: int, max_rounds: int = 3):
+def _chat_until_conclusive(client, messages, con, demand_id: int, max_rounds: int = 3, strategy: str = RAG_SEARCH_MODE,
+                           embed_fn=embed_query, sent: set = None):
+    sent = set() if sent is None else sent  # chunk ids ya enviados al modelo
     logger.info("[LLM] Inicio loop con max_rounds=%d, modelo=%s", max_rounds, OPENAI_CHAT_MODEL)
     for round_idx in range(1, max_rounds + 1):
         t0 = time.perf_counter()
@@ -107,12 +116,9 @@ def _chat_until_conclusive(client, messages, con, demand_id: int, max_rounds: in
             raw_queries = txt.split(":", 1)[1] if ":" in txt else ""
             queries = [q.strip() for q in raw_queries.split(";") if q.strip()]
             logger.info("[LLM] Pide más contexto en ronda %d. queries=%s", round_idx, queries)
-            extra_ctx_parts = []
-            for q in queries:
-                ctx_piece = _more_context(con, demand_id, q, k=4)
-                if ctx_piece:
-                    extra_ctx_parts.append(ctx_piece)
-            extra_ctx = "\n\n".join(extra_ctx_parts).strip()
+            # las filas de todas las consultas se arman juntas: un presupuesto por ronda
+            rows = [r for q in queries for r in _context_rows(con, q, k=4, strategy=strategy, embed_fn=embed_fn)]
+            extra_ctx = _pack(con, rows, " ".join(queries), RAG_MORE_CONTEXT_TOKENS, RAG_MORE_SNIPPET_CHARS, sent) if rows else ""
             if not extra_ctx:
                 logger.warning("[LLM] No se pudo obtener contexto adicional (queries=%s). Detengo.", queries)
                 break
@@ -133,26 +139,38 @@ def _write_trace(trace: dict, out_dir: str = "traces") -> str:
     logger.info("[TRACE] guardado en %s", fpath)
     return fpath
 
-def safe_hybrid_search(con, raw_query: str, embed_fn, bm25_k=40, rerank_k=8):
+def safe_hybrid_search(con, raw_query: str, embed_fn, bm25_k=40, rerank_k=8, strategy: str = RAG_SEARCH_MODE):
+    if strategy == "rrf":
+        return hybrid_search(con, raw_query, embed_fn, bm25_k=bm25_k, rerank_k=rerank_k, mode="rrf")
     try:
-        return hybrid_search(con, raw_query, embed_fn, bm25_k=bm25_k, rerank_k=rerank_k)
+        return hybrid_search(con, raw_query, embed_fn, bm25_k=bm25_k, rerank_k=rerank_k, mode=strategy)
     except sqlite3.OperationalError as e1:
         logger.warning("[RAG] FTS error con query original: %s. Reintento con saneado…", e1)
         q_safe = fts_sanitize(raw_query)
         if not q_safe:
             return []
         try:
-            return hybrid_search(con, q_safe, embed_fn, bm25_k=bm25_k, rerank_k=rerank_k)
+            return hybrid_search(con, raw_query, embed_fn, bm25_k=bm25_k, rerank_k=rerank_k, mode=strategy, fts_query=q_safe)
         except sqlite3.OperationalError as e2:
             logger.warning("[RAG] FTS error con q_safe='%s': %s. Reintento con prefijo…", q_safe, e2)
             q_pref = fts_prefixify(q_safe)
             try:
-                return hybrid_search(con, q_pref, embed_fn, bm25_k=bm25_k, rerank_k=rerank_k)
+                return hybrid_search(con, raw_query, embed_fn, bm25_k=bm25_k, rerank_k=rerank_k, mode=strategy, fts_query=q_pref)
             except sqlite3.OperationalError as e3:
                 logger.error("[RAG] FTS fallo incluso con prefijo q_pref='%s': %s", q_pref, e3)
                 return []
 
-def rag_answer(demand_id: int, question: str, k: int = 8):
+def demand_db_path(demand: Causa) -> str:
+    WEBSITE_SITE_NAME = os.environ.get('WEBSITE_SITE_NAME', '')
+    if 'azurewebsites.net' in WEBSITE_SITE_NAME:
+        return f'{os.getenv("SQLITE_PATH")}{demand.sqlite_path}'
+    return f'{os.getenv("SQLITE_LOCAL_PATH")}{demand.sqlite_path}'
+
+def demand_scope_for(demand_id: int, db_path: str):
+    # en el corpus consolidado la conexión se acota a la demanda; en demand_<id>.db no hace falta
+    return demand_id if is_corpus_path(db_path) else None
+
+def rag_answer(demand_id: int, question: str, k: int = 8, strategy: str = RAG_SEARCH_MODE):
     t_start = time.perf_counter()
     logger.info("[RAG] demand_id=%s question=%r model=%s base_url=%s", demand_id, question, OPENAI_CHAT_MODEL, OPENAI_BASE_URL or "(default)")
     try:
@@ -164,14 +182,7 @@ def rag_answer(demand_id: int, question: str, k: int = 8):
         logger.error("[RAG] %s", msg)
         raise RuntimeError(msg)
     
-    WEBSITE_SITE_NAME = os.environ.get('WEBSITE_SITE_NAME', '')
-    SQLITE_PATH = os.getenv("SQLITE_PATH")
-
-    if 'azurewebsites.net' in WEBSITE_SITE_NAME:
-        db_path = f'{SQLITE_PATH}{demand.sqlite_path}'
-    else:
-        SQLITE_LOCAL_PATH = os.getenv("SQLITE_LOCAL_PATH")
-        db_path = f'{SQLITE_LOCAL_PATH}{demand.sqlite_path}'
+    db_path = demand_db_path(demand)
 
     logger.info("[RAG] Ruta SQLite determinada: %s", db_path)
     
@@ -181,33 +192,68 @@ def rag_answer(demand_id: int, question: str, k: int = 8):
         logger.error("[RAG] %s path=%r", msg, db_path)
         raise RuntimeError(msg)
     logger.info("[RAG] SQLite path=%s size=%.1f MB", db_path, (os.path.getsize(db_path) / (1024*1024.0)))
-    seed_q = fts_prefixify(fts_sanitize(question or ""))
-    seed_ctx = ""
+    # ficha de la causa (armada en la ingesta): responde sola partes/monto/etapa/último trámite; si no, va primera en el contexto
+    card = None
+    if RAG_CASE_CARD or RAG_CASE_CARD_DIRECT:
+        try:
+            with read_pool.connection(db_path, demand_scope_for(demand_id, db_path)) as con:
+                card = load_case_card(con)
+        except sqlite3.Error as e:
+            logger.warning("[RAG] no se pudo leer la ficha de la causa: %s", e)
+    card_text = render_case_card(card) if card and RAG_CASE_CARD else ""
+    direct = answer_from_card(card, question) if RAG_CASE_CARD_DIRECT else None
+    if direct:
+        elapsed = time.perf_counter() - t_start
+        logger.info("[RAG] Respondida desde la ficha de la causa en %.3fs", elapsed)
+        trace = {
+            "demand_id": demand_id,
+            "question": question,
+            "model": None,
+            "answered_from": "case_card",
+            "llm_rounds": 0,
+            "db_path": db_path,
+            "context_len": len(card_text),
+            "top_chunks": [],
+            "answer": direct,
+            "ts": dt.datetime.now().isoformat(),
+        }
+        try:
+            _write_trace(trace)
+        except Exception as e:
+            logger.warning("[TRACE] no se pudo escribir: %s", e)
+        return direct, trace, card_text, [], db_path, elapsed
+    # con rrf la búsqueda inicial ya cubre lo que aporta el seed (prefijos + denso): se omite
+    seed_q = fts_prefixify(fts_sanitize(question or "")) if strategy != "rrf" else ""
+    seed_rows = []
+    # un embedder por pregunta: seed, búsqueda inicial y NEED_MORE_CONTEXT reutilizan los embeddings
+    # (con el backend y modelo registrados en la base, no necesariamente el de RAG_EMBEDDER)
+    embedder = None
+    fts = None
     try:
-        with sqlite3.connect(db_path) as con:
+        with read_pool.connection(db_path, demand_scope_for(demand_id, db_path)) as con:
+            embedder = QueryEmbedder(embedder_for(con))
+            fts = fts_layout(con)
+            if fts != "normalized":
+                logger.warning("[RAG] %s usa el FTS anterior (%s); migrar con manage.py rag_fts", db_path, fts)
             if seed_q:
-                seed_ctx = _more_context(con, demand_id, seed_q, k=4)
+                # se embebe la pregunta (la misma que la búsqueda inicial: un solo embedding), el FTS usa los prefijos
+                seed_rows = _context_rows(con, question, k=4, strategy=strategy, embed_fn=embedder, fts_query=seed_q)
     except Exception as e:
         logger.exception("[RAG] Error generando seed context: %s", e)
     t0 = time.perf_counter()
-    with sqlite3.connect(db_path) as con:
-        results = safe_hybrid_search(con, question, embed_query, bm25_k=40, rerank_k=k)
-    dtm = time.perf_counter() - t0
-    logger.info("[RAG] hybrid_search inicial -> %d resultados en %.3fs (k=%d)", len(results), dtm, k)
-    context_blocks = []
-    for idx, row in enumerate(results):
-        try:
-            cid, content, score = row
-        except Exception:
-            cid, content = row[0], row[1]
-            score = -1.0
-        snippet = (content or "")[:800]
-        context_blocks.append(f"[chunk:{cid} score={score:.3f}]\n{snippet}")
-        if idx < 10:
-            logger.debug("[RAG] top%d: cid=%s score=%.3f snippet_len=%d", idx+1, cid, score, len(snippet))
-    context_text = "\n\n---\n\n".join(context_blocks) if context_blocks else "(sin resultados)"
-    if seed_ctx:
-        context_text = f"{context_text}\n\n---\n\n[seed]\n{seed_ctx}"
+    with read_pool.connection(db_path, demand_scope_for(demand_id, db_path)) as con:
+        embedder = embedder or QueryEmbedder(embedder_for(con))
+        results = safe_hybrid_search(con, question, embedder, bm25_k=40, rerank_k=k, strategy=strategy)
+        dtm = time.perf_counter() - t0
+        logger.info("[RAG] hybrid_search inicial -> %d resultados en %.3fs (k=%d)", len(results), dtm, k)
+        for idx, row in enumerate(results[:10]):
+            logger.debug("[RAG] top%d: cid=%s score=%s", idx + 1, row[0], row[2] if len(row) > 2 else None)
+        # resultados + seed: un solo armado (el seed suele repetir chunks de la búsqueda inicial)
+        sent = set()
+        # la ficha descuenta su tamaño del presupuesto
+        packed = _pack(con, list(results) + list(seed_rows), question or "",
+                       RAG_CONTEXT_TOKENS - (estimate_tokens(card_text) if card_text else 0), RAG_SNIPPET_CHARS, sent)
+        context_text = BLOCK_SEP.join(x for x in (card_text, packed) if x) or "(sin resultados)"
     logger.info("[RAG] context_len=%.1f KB", len(context_text)/1024.0)
     messages = [
         {"role": "system", "content": SYSTEM_PROMPT},
@@ -215,8 +261,9 @@ def rag_answer(demand_id: int, question: str, k: int = 8):
     ]
     client = _client()
     try:
-        with sqlite3.connect(db_path) as con:
-            answer = _chat_until_conclusive(client, messages, con, demand_id, max_rounds=3)
+        with read_pool.connection(db_path, demand_scope_for(demand_id, db_path)) as con:
+            answer = _chat_until_conclusive(client, messages, con, demand_id, max_rounds=3, strategy=strategy,
+                                            embed_fn=embedder, sent=sent)
     except Exception as e:
         logger.exception("[RAG] Error en loop LLM: %s", e)
         answer = f"Error en loop LLM: {e}"
@@ -225,6 +272,11 @@ def rag_answer(demand_id: int, question: str, k: int = 8):
         "demand_id": demand_id,
         "question": question,
         "model": OPENAI_CHAT_MODEL,
+        "search_mode": strategy,
+        "fts_layout": fts,
+        "case_card": bool(card_text),
+        # rondas LLM = 1 + veces que pidió NEED_MORE_CONTEXT y se le agregó contexto (rag_bench traces las promedia)
+        "llm_rounds": 1 + sum(1 for m in messages if m["role"] == "system" and m["content"].startswith("Contexto adicional")),
         "db_path": db_path,
         "context_len": len(context_text),
         "top_chunks": [
@@ -232,6 +284,9 @@ def rag_answer(demand_id: int, question: str, k: int = 8):
             for r in results[:8]
         ],
         "answer": answer,
+        "matrix_cache": matrix_cache.stats(),
+        "query_embeddings": embedder.stats(),
+        "sqlite_pool": read_pool.stats(),
         "ts": dt.datetime.now().isoformat(),
     }
     try:
@@ -244,7 +299,8 @@ def rag_answer(demand_id: int, question: str, k: int = 8):
 def execute(arguments: Dict[str, Any]) -> Dict[str, Any]:
     """
     MCP tool entrypoint for RAG query. Receives arguments dict and returns JSON result.
-    arguments: dict with keys: demand_id (int), question (str), conversation_id (str, optional), log_level (str, optional), k (int, optional)
+    arguments: dict with keys: demand_id (int), question (str), conversation_id (str, optional), log_level (str, optional), k (int, optional),
+               strategy (str, optional: "bm25" | "union" | "rrf")
     """
     demand_id = arguments.get("demand_id")
     question = arguments.get("question")
@@ -253,9 +309,12 @@ def execute(arguments: Dict[str, Any]) -> Dict[str, Any]:
     print(f"RAG execute called with demand_id={demand_id} question={question!r} conversation_id={conversation_id}")
     
     k = arguments.get("k", 8)
+    strategy = arguments.get("strategy") or RAG_SEARCH_MODE
+    if strategy not in SEARCH_MODES:
+        raise ValueError(f"strategy debe ser una de {SEARCH_MODES}, no {strategy!r}")
     t0 = time.perf_counter()
     try:
-        answer, trace, context_text, results, db_path, elapsed_inner = rag_answer(demand_id, question, k=k)
+        answer, trace, context_text, results, db_path, elapsed_inner = rag_answer(demand_id, question, k=k, strategy=strategy)
     except Exception as e:
         logger.exception("Error fatal en rag_answer: %s", e)
         answer = f"Error: {e}"
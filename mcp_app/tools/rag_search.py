@@ -5,8 +5,10 @@ import os, argparse, sqlite3
 #os.environ.setdefault("DJANGO_SETTINGS_MODULE", "server.settings")
 #django.setup()
 from civil.models import Causa
-from civil.rag.sqlite_db import hybrid_search
+from civil.rag.sqlite_db import hybrid_search, is_corpus_path, embedder_for
 from civil.rag.utils_embed import embed_texts
+from civil.rag.matrix_cache import matrix_cache
+from civil.rag.conn_pool import read_pool
 import logging
 from typing import Dict, Any, List
 import re
@@ -46,12 +48,14 @@ def execute(arguments: Dict[str, Any]) -> Dict[str, Any]:
     if not os.path.exists(demand.sqlite_path):
         raise SystemExit("SQLite path missing on disk.")
 
-    with sqlite3.connect(demand.sqlite_path) as con:
+    scope = demand.id if is_corpus_path(demand.sqlite_path) else None
+    with read_pool.connection(demand.sqlite_path, scope) as con:
+        embedder = embedder_for(con)  # mismo backend/modelo con que se ingestó la base
+        embed_query = lambda q: embedder.embed([q])[0]
         try:
             # Intento 1: usar pregunta original para FTS
             logger.info(f"[RAG] Ejecutando búsqueda híbrida con query original: {query!r}")
-            embed_query_vector = embed_query(query)
-            rows = hybrid_search(con, query, embed_query_vector, rerank_k=k)
+            rows = hybrid_search(con, query, embed_query, rerank_k=k)
         except sqlite3.OperationalError as e:
             logger.warning(
                 f"[RAG] FTS error con query original: {e}. "
@@ -69,6 +73,7 @@ def execute(arguments: Dict[str, Any]) -> Dict[str, Any]:
         "results": [{"chunk_id": cid, "content": content, "score": score} for cid, content, score in rows],
         "db_path": demand.sqlite_path,
         "elapsed": None,
+        "matrix_cache": matrix_cache.stats(),
     }
     return result
 
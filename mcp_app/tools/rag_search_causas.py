@@ -0,0 +1,67 @@
+from __future__ import annotations
+import os
+import logging
+from typing import Dict, Any, List
+from civil.models import Causa
+from civil.rag.federated import federated_search
+from civil.rag.query_cache import QueryEmbedder
+from civil.rag.sqlite_db import SEARCH_MODES
+from mcp_app.tools.rag_query import demand_db_path, RAG_SEARCH_MODE
+
+logger = logging.getLogger('mcp')
+
+def execute(arguments: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Búsqueda sobre todas las causas listas del usuario (o las demand_ids indicadas).
+    arguments: question (str), user_id (int, lo agrega ai_client), demand_ids (list[int], opcional),
+               k (int, opcional), strategy (str, opcional), min_score (float, opcional)
+    """
+    question = arguments.get("question")
+    user_id = arguments.get("user_id")
+    demand_ids = arguments.get("demand_ids") or []
+    k = int(arguments.get("k", 8))
+    strategy = arguments.get("strategy") or RAG_SEARCH_MODE
+    min_score = arguments.get("min_score")
+
+    if not question:
+        raise ValueError("Missing required argument: question")
+    if strategy not in SEARCH_MODES:
+        raise ValueError(f"strategy debe ser una de {SEARCH_MODES}, no {strategy!r}")
+    if not user_id and not demand_ids:
+        raise ValueError("Se requiere user_id o demand_ids")
+
+    causas = Causa.objects.filter(status="ready").exclude(sqlite_path="")
+    if user_id:
+        causas = causas.filter(usuarios__id=user_id)
+    if demand_ids:
+        causas = causas.filter(id__in=demand_ids)
+    # las más recientes primero: con min_score, la terminación temprana las favorece
+    causas = list(causas.order_by("-updated_at").distinct())
+
+    targets, missing = [], []
+    for c in causas:
+        db_path = demand_db_path(c)
+        (targets if os.path.exists(db_path) else missing).append((c.id, db_path))
+    if missing:
+        logger.warning("[FED] %d causas sin SQLite en disco: %s", len(missing), [m[0] for m in missing])
+
+    hits, report = federated_search(targets, question, QueryEmbedder(), k=k, mode=strategy,
+                                    min_score=float(min_score) if min_score is not None else None)
+    titles = {c.id: c.titulo for c in causas}
+    results: List[Dict[str, Any]] = [
+        {
+            "demand_id": h.demand_id,
+            "titulo": titles.get(h.demand_id),
+            "chunk_id": h.chunk_id,
+            "score": h.score,
+            "content": h.content,
+        }
+        for h in hits
+    ]
+    return {
+        "results": results,
+        "demands_total": len(causas),
+        "missing_sqlite": [m[0] for m in missing],
+        "search": report.as_dict(),
+        "strategy": strategy,
+    }